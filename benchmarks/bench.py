@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #The benchmarks import the modules of the ray tracer from the directory above
+import matplotlib
+matplotlib.use('Agg') #The benchmarks run headless, without a display
+import raytracer as rt
+import optics2 as op
+import plotting as pt
+import optimise
+import sweep
+
+"""
+Reproducible benchmarks of the tracing pipeline, for beams of 10^2 to 10^6 rays. Every benchmark is run a number of times and the fastest time is kept,
+then run once more under tracemalloc to find its peak memory, so the benchmarks need Python 3. The results are written as JSON, and two result files can be compared to flag regressions.
+    
+    python benchmarks/bench.py run --output results.json
+    python benchmarks/bench.py compare benchmarks/baseline.json results.json --threshold 0.25
+"""
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+MULTIPLIER = 6 #The number of rays in the first ring of every beam
+DIAMETERS = [2, 4, 6, 8] #The beam diameters of the planoconvex sweep
+
+def ringsFor(rays):
+    """Returns the number of rings of a concentric ring beam with at least the given number of rays"""
+    
+    return max(int(np.ceil((-1 + np.sqrt(1 + 8.0 * (rays - 1) / MULTIPLIER)) / 2)), 1)
+
+def beam(rays, rmax=5):
+    """Returns a Bundle with at least the given number of rays"""
+    
+    return rt.Bundle(ringsFor(rays), rmax, MULTIPLIER)
+
+def lenses():
+    """Returns the two surfaces of the planoconvex lens that is traced by the benchmarks"""
+    
+    return [op.SphericalRefraction(100, 20, 0.02, 1, 1.5168), op.SphericalRefraction(105, 20, 0, 1.5168, 1)]
+
+def axialRay():
+    return rt.Ray([0, 0, 0], [0, 0, 1])
+
+#Every benchmark is a function of the ray count which returns (setup, run): setup is called before every repetition, untimed, and its result is passed to run
+
+def benchBundle(rays):
+    bundle = beam(rays)
+    return (lambda: None), (lambda state: bundle.getBundle(axialRay(), history='none'))
+
+def benchSingleSurface(rays):
+    lens = lenses()[0]
+    bundle = beam(rays)
+    return (lambda: bundle.getBundle(axialRay(), history='none')), lens.propagateBundle
+
+def benchMultiSurface(rays):
+    system = op.OpticalSystem(lenses() + [op.OutputPlane(200)])
+    bundle = beam(rays)
+    return (lambda: bundle.getBundle(axialRay(), history='none')), system.propagateBatch
+
+def benchOutputPlane(rays):
+    output = op.OutputPlane(200)
+    bundle = beam(rays)
+    return (lambda: bundle.getBundle(axialRay(), history='none')), output.propagateBundle
+
+def benchPlotRMS(rays):
+    batch = beam(rays).getBundle(axialRay(), history='none')
+    op.OpticalSystem(lenses() + [op.OutputPlane(200)]).propagateBatch(batch)
+    return (lambda: pt.Plot(batch)), (lambda plot: plot.rms())
+
+def benchOptimalRMS(rays):
+    curvatures = iter(np.linspace(0.01, 0.02, 10000)) #Every repetition uses new curvatures, so that the cache of the objective is never hit
+    setup = lambda: next(curvatures)
+    objective = optimise.Objective([op.SphericalRefraction(100, 20, 0, 1, 1.5168), op.SphericalRefraction(105, 20, 0, 1.5168, 1)], output=200, bundle=beam(rays))
+    return setup, (lambda curvature: objective.value([curvature, -curvature]))
+
+def benchPlanoConvex(rays):
+    base = sweep.design(lenses(), n=ringsFor(rays), rmax=5, m=MULTIPLIER, output=None)
+    grid = {'bundle.rmax': np.array(DIAMETERS, dtype='float') / 2}
+    return (lambda: None), (lambda state: sweep.Sweep(base).run(grid, workers=1))
+
+#The benchmarks, with the number of traces of the beam that each repetition makes, so that the rays per second count every ray traced
+BENCHMARKS = [
+    ('bundle', benchBundle, 1),
+    ('singleSurface', benchSingleSurface, 1),
+    ('multiSurface', benchMultiSurface, 1),
+    ('outputPlane', benchOutputPlane, 1),
+    ('plotRMS', benchPlotRMS, 1),
+    ('optimalRMS', benchOptimalRMS, 1),
+    ('planoConvex', benchPlanoConvex, len(DIAMETERS))]
+
+def measure(function, rays, repeats=20, budget=1.0):
+    """Times a benchmark for a ray count, returning the fastest time of at least 3 and up to the given number of repetitions (fewer once the time budget
+    is spent), the peak memory of one further traced repetition, and the number of repetitions"""
+    
+    setup, run = function(rays)
+    times = []
+    while len(times) < min(3, repeats) or (len(times) < repeats and sum(times) < budget):
+        state = setup()
+        begin = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - begin)
+    state = setup()
+    tracemalloc.start() #Numpy reports its arrays to tracemalloc, so the peak includes the ray arrays
+    run(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak, len(times)
+
+def environment():
+    """Returns a description of the machine that ran the benchmarks, since results are only comparable on the same machine"""
+    
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'processor': platform.processor(),
+            'system': platform.system(), 'cpus': os.cpu_count()}
+
+def run(sizes=SIZES, names=None, repeats=20):
+    """Runs the benchmarks for every ray count, and returns the results"""
+    
+    np.random.seed(0)
+    results = []
+    for name, function, traces in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for size in sizes:
+            rays = beam(size).size() #The actual number of rays in the beam, which is the ray count rounded up to a whole number of rings
+            best, peak, count = measure(function, size, repeats)
+            results.append({'name': name, 'size': size, 'rays': rays, 'seconds': best, 'raysPerSecond': rays * traces / best, 'peakBytes': peak,
+                            'repeats': count})
+            print('%-14s %8d rays  %10.4f s  %12.0f rays/s  %8.1f MB' % (name, rays, best, rays * traces / best, peak / 1e6))
+    return {'environment': environment(), 'results': results}
+
+def compare(baseline, current, threshold=0.25, memoryThreshold=0.25):
+    """Compares two sets of results. A benchmark has regressed if its rays per second fell, or its peak memory rose, by more than the threshold fraction.
+    Returns a list of the regressions, each as a message."""
+    
+    reference = dict(((result['name'], result['size']), result) for result in baseline['results'])
+    regressions = []
+    for result in current['results']:
+        base = reference.get((result['name'], result['size']))
+        if base is None:
+            continue
+        speed = result['raysPerSecond'] / base['raysPerSecond'] - 1
+        memory = result['peakBytes'] / float(max(base['peakBytes'], 1)) - 1
+        flag = ''
+        if speed < -threshold:
+            flag = 'SLOWER'
+            regressions.append('%s at %d rays is %.0f%% slower' % (result['name'], result['size'], -100 * speed))
+        if memory > memoryThreshold:
+            flag = (flag + ' MEMORY').strip()
+            regressions.append('%s at %d rays uses %.0f%% more memory' % (result['name'], result['size'], 100 * memory))
+        print('%-14s %8d  speed %+7.1f%%  memory %+7.1f%%  %s' % (result['name'], result['size'], 100 * speed, 100 * memory, flag))
+    return regressions
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def command(arguments=None):
+    """The command line interface of the benchmarks. Returns the exit status, which is 1 if a comparison found regressions."""
+    
+    parser = argparse.ArgumentParser(description='Benchmarks of the ray tracer')
+    commands = parser.add_subparsers(dest='command')
+    runParser = commands.add_parser('run', help='run the benchmarks and write the results')
+    runParser.add_argument('--output', default='benchmark.json', help='the file the results are written to')
+    runParser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='the ray counts to benchmark')
+    runParser.add_argument('--only', nargs='+', choices=[name for name, function, traces in BENCHMARKS], help='the benchmarks to run')
+    runParser.add_argument('--repeats', type=int, default=20, help='the most repetitions of each benchmark')
+    runParser.add_argument('--compare', help='a baseline to compare the new results against')
+    runParser.add_argument('--threshold', type=float, default=0.25, help='the fractional slow down (and memory increase) counted as a regression')
+    compareParser = commands.add_parser('compare', help='compare results against a baseline')
+    compareParser.add_argument('baseline')
+    compareParser.add_argument('current')
+    compareParser.add_argument('--threshold', type=float, default=0.25, help='the fractional slow down (and memory increase) counted as a regression')
+    options = parser.parse_args(arguments)
+    
+    if options.command == 'run':
+        current = run(options.sizes, options.only, options.repeats)
+        with open(options.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        if options.compare is None:
+            return 0
+        baseline = load(options.compare)
+    elif options.command == 'compare':
+        baseline, current = load(options.baseline), load(options.current)
+    else:
+        parser.print_help()
+        return 2
+    regressions = compare(baseline, current, options.threshold, options.threshold)
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(command())
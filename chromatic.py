@@ -0,0 +1,69 @@
+import numpy as np
+import raytracer as rt
+import optics2 as op
+import glass as gl
+import paraxial as px
+
+"""
+Chromatic analysis of a lens system, which traces every wavelength in one stacked pass
+"""
+
+def paraxialFoci(system, wavelengths):
+    """Returns the z positions of the paraxial focus of the system at every wavelength, from the ray transfer matrices of the system with the indices at each wavelength.
+    They are NaN where the system does not bring parallel rays to a real focus after its last lens."""
+    
+    n1, n2 = system.dispersedIndices(wavelengths)
+    constants = system.getConstants()
+    z0, curvature = [np.broadcast_to(constants[name], n1.shape) for name in ('z0', 'curvature')]
+    properties = px.firstOrder(z0, curvature, n1, n2) #Every wavelength is a separate system in one batched matrix product
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isfinite(properties['focus']) & (properties['backFocalDistance'] > 0), properties['focus'], np.nan)
+    
+def chiefHeights(system, wavelengths, field, output, start=0.0):
+    """Returns the height (x) at the output plane of the chief ray of a field at the given angle (in degrees) at every wavelength.
+    The chief ray passes through the vertex of the first surface, which acts as the aperture stop."""
+    
+    angle = np.radians(field)
+    z0 = system.getConstants()['z0'][0]
+    point = [-(z0 - start) * np.tan(angle), 0, start]
+    points, directions, alive = system.traceWavelengths([point], [np.sin(angle), 0, np.cos(angle)], wavelengths, output)
+    return points[:, 0, 0]
+    
+def chromaticAnalysis(system, wavelengths, bundle=None, output=None, weights=None, field=0.0, reference=gl.REFERENCE):
+    """Traces a bundle through the system at every wavelength at once and returns a dictionary of:
+    the RMS spot radius at each wavelength, the polychromatic RMS spot radius of all the wavelengths together (weighted by the given weights),
+    the paraxial focus at each wavelength and the longitudinal colour (its shift from the focus at the reference wavelength),
+    and the lateral colour (the shift in the height of the chief ray of the given field, in degrees, from its height at the reference wavelength).
+    The spot is measured on the output plane of the system, the given output z, or otherwise at the paraxial focus at the reference wavelength."""
+    
+    if not(isinstance(system, op.OpticalSystem)):
+        system = op.OpticalSystem(system)
+    wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype='float'))
+    weights = np.ones(len(wavelengths)) if weights is None else np.asarray(weights, dtype='float')
+    stack = np.append(wavelengths, reference) #The reference wavelength is traced as the last row of every stack
+    
+    foci = paraxialFoci(system, stack)
+    if output is None:
+        output = system.getOutput()
+    if output is None:
+        output = foci[-1]
+    if bundle is None:
+        bundle = rt.Bundle(10, 5, 10)
+    start = min(0.0, system.getConstants()['z0'][0])
+    points, directions, alive = system.traceWavelengths(bundle.points([0, 0, start]), [0, 0, 1], stack, output)
+    
+    #Every spot is measured about the chief ray at the reference wavelength, or about the centroid of all the spots if it was terminated
+    xy = points[:, :, :2]
+    if alive[-1, 0]:
+        centre = xy[-1, 0]
+    else:
+        centre = np.array([xy[:-1, :, 0][alive[:-1]].mean(), xy[:-1, :, 1][alive[:-1]].mean()])
+    radiusSquare = np.where(alive, ((xy - centre)**2).sum(axis=2), 0.0)[:-1]
+    counts = alive[:-1].sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms = np.sqrt(radiusSquare.sum(axis=1) / counts)
+        polychromatic = np.sqrt((weights * radiusSquare.sum(axis=1)).sum() / (weights * counts).sum())
+        
+    heights = chiefHeights(system, stack, field, output, start)
+    return {'wavelengths': wavelengths, 'rms': rms, 'polychromaticRMS': polychromatic, 'paraxialFocus': foci[:-1], 'longitudinalColour': foci[:-1] - foci[-1],
+            'lateralColour': heights[:-1] - heights[-1], 'output': output, 'vignetting': 1.0 - counts / float(points.shape[1])}
@@ -0,0 +1,219 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import raytracer as rt
+import optics2 as op
+import spots
+import paraxial as px
+import sweep
+
+"""
+A non-interactive command line interface, which runs a trace, a sweep or an optimisation from a description file and writes the results to a directory:
+    
+    python cli.py system.json --output results
+
+The description is a JSON, YAML (.yaml or .yml) or TOML (.toml) file with these entries, of which only surfaces is required:
+    
+    mode       'trace' (the default), 'sweep' or 'optimise'
+    surfaces   A list of lenses, each with z0, aperture, curvature, n1 and n2, and for an aspheric lens a conic constant and coefficients (of r^4, r^6...).
+               An index is a number or the name of a material in glass.MATERIALS.
+    output     The z position of the output plane, or 'paraxial' (the default) to place it at the paraxial focus.
+    rays       A list of single rays, each with a point and a direction.
+    bundles    A list of beams, each with a centre, direction, n, rmax, m and optionally sampling and seed (see raytracer.Bundle).
+    history    The history kept for traced rays: 'vertices' (the default) or 'full', which are written as a ray set (see rayfile), or 'none',
+               which only writes the initial and final states of the rays to rays.npz.
+    precision  The working precision of a trace: 'float64' (the default), 'float32' or 'mixed' (see raytracer.PRECISIONS).
+    sweep      The grid of a sweep (see sweep.gridPoints), with optional n, rmax, m, sampling, workers and chunksize.
+    optimise   The bounds of the optimised curvatures, with optional surfaces (indices of the varied lenses), starts, count, seed and n, rmax, m.
+
+Matplotlib and scipy are only imported by the modes which need them, so that short jobs start quickly.
+"""
+
+def load(filename):
+    """Reads a description file, choosing its format from its extension"""
+    
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise Exception('Reading YAML descriptions needs the PyYAML package')
+        with open(filename) as f:
+            return yaml.safe_load(f)
+    if extension == '.toml':
+        try:
+            import tomllib as toml
+        except ImportError:
+            try:
+                import tomli as toml
+            except ImportError:
+                raise Exception('Reading TOML descriptions needs Python 3.11 or the tomli package')
+        with open(filename, 'rb') as f:
+            return toml.load(f)
+    with open(filename) as f:
+        return json.load(f)
+
+def lenses(description):
+    """Builds the lenses of a description"""
+    
+    surfaces = description.get('surfaces')
+    if not surfaces:
+        raise Exception('The description must contain at least one surface')
+    return [sweep.buildLens(surface) for surface in surfaces]
+
+def outputPosition(description, elements):
+    """Returns the z position of the output plane of a description, finding the paraxial focus if it is asked for"""
+    
+    output = description.get('output', 'paraxial')
+    if output == 'paraxial':
+        output = px.paraxialFocus(elements)
+        if output is None:
+            raise Exception('The system has no paraxial focus, so the output plane must be given')
+    return float(output)
+
+def rayBatch(description, history='none', precision='float64'):
+    """Creates a single batch of every ray and beam in a description"""
+    
+    points, directions = [], []
+    for ray in description.get('rays', []):
+        points.append(np.array(ray['point'], dtype='float', ndmin=2))
+        directions.append(np.array(ray['direction'], dtype='float', ndmin=2))
+    for beam in description.get('bundles', []):
+        bundle = rt.Bundle(int(beam['n']), beam['rmax'], int(beam['m']), beam.get('sampling', 'rings'), beam.get('seed'))
+        centre = rt.Ray(beam.get('centre', [0, 0, 0]), beam.get('direction', [0, 0, 1]))
+        points.append(bundle.points(centre.p()))
+        directions.append(np.repeat(centre.k()[np.newaxis], len(points[-1]), axis=0))
+    if not points:
+        raise Exception('The description must contain at least one ray or bundle to trace')
+    return rt.RayBatch(np.concatenate(points), np.concatenate(directions), history, precision=precision)
+
+def chiefRay(batch, z0):
+    """Returns the index of the chief ray of a batch, which is the ray that passes closest to the centre of the first surface (the aperture stop) at z0"""
+    
+    start, directions = batch.start(), batch.startDirections()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        length = (z0 - start[:, 2]) / directions[:, 2]
+        offset = start[:, :2] + length[:, np.newaxis] * directions[:, :2]
+        distance = np.where(directions[:, 2] > 0, np.hypot(offset[:, 0], offset[:, 1]), np.inf) #Rays which never reach the stop cannot be the chief ray
+    return int(np.argmin(distance))
+
+def bundleOf(settings):
+    """Returns the Bundle given by the n, rmax, m, sampling and seed of a sweep or optimise section"""
+    
+    return rt.Bundle(int(settings.get('n', 10)), settings.get('rmax', 5), int(settings.get('m', 10)), settings.get('sampling', 'rings'), settings.get('seed'))
+
+def trace(description, directory, plot=False):
+    """Traces the rays of a description, writing the traced rays as a ray set, the spot statistics as metrics.json and, if asked, the plots.
+    The spot is measured about the chief ray (see chiefRay), whose index is reported as chiefRay."""
+    
+    import rayfile
+    elements = lenses(description)
+    output = outputPosition(description, elements)
+    system = op.OpticalSystem(elements + [op.OutputPlane(output)])
+    history = 'vertices' if plot else description.get('history', 'vertices') #The plots need the path of every ray
+    batch = rayBatch(description, history, description.get('precision', 'float64'))
+    system.propagateBatch(batch)
+    if history == 'none':
+        #Without the intercepts at every surface only the initial and final states of the rays can be written
+        np.savez(os.path.join(directory, 'rays.npz'), start=batch.start(), end=batch.p(), direction=batch.k(), status=batch.status())
+    else:
+        with rayfile.RayFileWriter(os.path.join(directory, 'rays'), system) as writer:
+            writer.write(batch)
+    chief = chiefRay(batch, elements[0].getz0())
+    statistics = spots.spotStatistics(batch.p(), batch.alive(), chief)
+    properties = px.systemProperties(elements)
+    metrics = {'mode': 'trace', 'output': output, 'paraxialFocus': px.paraxialFocus(elements), 'focalLength': properties['focalLength'],
+               'backFocalDistance': properties['backFocalDistance'], 'rearPrincipal': properties['rearPrincipal'], 'frontPrincipal': properties['frontPrincipal'],
+               'chiefRay': chief}
+    metrics.update(statistics)
+    if plot:
+        import matplotlib
+        matplotlib.use('Agg') #The plots are only saved, so no display is needed
+        import plotting as pt
+        metrics['plots'] = pt.Plot(batch, chief=chief).savePlots(os.path.join(directory, 'plot'))
+    return metrics
+
+def sweepMode(description, directory):
+    """Sweeps the design of a description over its grid, writing each row of the results as a line of JSON in sweep.jsonl"""
+    
+    settings = description.get('sweep', {})
+    if 'grid' not in settings:
+        raise Exception('A sweep must be given a grid')
+    output = description.get('output', 'paraxial')
+    base = sweep.design(lenses(description), settings.get('n', 10), settings.get('rmax', 5), settings.get('m', 10), settings.get('sampling', 'rings'),
+                        None if output == 'paraxial' else float(output))
+    results = sweep.Sweep(base).run(settings['grid'], settings.get('workers'), settings.get('chunksize', 16), results=os.path.join(directory, 'sweep.jsonl'))
+    metrics = {'mode': 'sweep', 'points': len(results)}
+    for name in sweep.METRICS:
+        if np.isfinite(results[name]).any():
+            metrics[name] = {'min': np.nanmin(results[name]), 'max': np.nanmax(results[name])}
+    if np.isfinite(results['rms']).any():
+        best = int(np.nanargmin(results['rms'])) #The point of the grid with the smallest RMS spot radius
+        metrics['best'] = dict((field, results[field][best]) for field in results.dtype.names)
+    return metrics
+
+def optimiseMode(description, directory):
+    """Optimises the curvatures of a description for the smallest RMS spot radius"""
+    
+    import optimise
+    settings = description.get('optimise', {})
+    if 'bounds' not in settings:
+        raise Exception('An optimisation must be given the bounds of the curvatures')
+    elements = lenses(description)
+    output = outputPosition(description, elements)
+    objective = optimise.Objective(elements, settings.get('surfaces'), output, bundleOf(settings))
+    result = objective.optimise(settings['bounds'], settings.get('starts'), settings.get('count', 1), settings.get('seed'))
+    metrics = {'mode': 'optimise', 'output': output, 'curvatures': result['curvatures'], 'rms': result['rms'], 'results': result['results']}
+    metrics.update(objective.report())
+    return metrics
+
+MODES = {'trace': trace, 'sweep': sweepMode, 'optimise': optimiseMode}
+
+def plain(value):
+    """Converts numpy values in the metrics into plain Python values, so that they can be written as JSON"""
+    
+    if isinstance(value, dict):
+        return dict((str(key), plain(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return plain(value.tolist())
+    if isinstance(value, np.generic):
+        return plain(value.item())
+    if isinstance(value, float) and not(np.isfinite(value)):
+        return None #JSON has no NaN or infinity
+    return value
+
+def run(description, directory, mode=None, plot=False):
+    """Runs a description in the given mode (or the mode it names) and writes its metrics to metrics.json in the directory. Returns the metrics."""
+    
+    mode = mode or description.get('mode', 'trace')
+    if mode not in MODES:
+        raise Exception('The mode must be one of: %s' % ', '.join(sorted(MODES)))
+    if not(os.path.isdir(directory)):
+        os.makedirs(directory)
+    if mode == 'trace':
+        metrics = trace(description, directory, plot)
+    else:
+        metrics = MODES[mode](description, directory)
+    metrics = plain(metrics)
+    with open(os.path.join(directory, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=2)
+    return metrics
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Runs the ray tracer from a system description file, without any prompts')
+    parser.add_argument('description', help='a JSON, YAML or TOML file describing the rays, surfaces and output plane')
+    parser.add_argument('--output', default='results', help='the directory the results are written to')
+    parser.add_argument('--mode', choices=sorted(MODES), help='overrides the mode given in the description')
+    parser.add_argument('--plot', action='store_true', help='saves the plots of a trace')
+    options = parser.parse_args(arguments)
+    metrics = run(load(options.description), options.output, options.mode, options.plot)
+    print(json.dumps(dict((key, value) for key, value in metrics.items() if not(isinstance(value, (list, dict)))), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
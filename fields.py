@@ -0,0 +1,169 @@
+import numpy as np
+import raytracer as rt
+import optics2 as op
+import paraxial as px
+
+"""
+Field sweeps, which trace a beam for every field of view at once as a single (fields x rays x 3) stack.
+
+A field is given either as an angle of incidence (in degrees, which tilts the beam towards y in the y-z plane, a rotation about the x axis,
+or an (x, y) pair of angles which tilt it towards x and towards y) for an object at infinity, or as an object point.
+Every beam is laid out on the plane of the first lens vertex, and centred so that its chief ray passes through the centre of the aperture stop. The chief rays of
+all the fields are aimed together by Newton's method, with each Jacobian found from two extra rays per field traced in the same stack.
+"""
+
+def fieldDirections(angles):
+    """Returns the (F,3) unit directions of beams at field angles, in degrees, given as (F,) angles in the y-z plane (rotations about the x axis)
+    or (F,2) pairs of angles which tilt the beams towards x and towards y"""
+    
+    angles = np.radians(np.asarray(angles, dtype='float'))
+    if angles.ndim < 2:
+        angles = np.stack([np.zeros(angles.size), angles.ravel()], axis=1) #A single angle tilts the beam in the y-z plane
+    directions = np.stack([np.tan(angles[:, 0]), np.tan(angles[:, 1]), np.ones(len(angles))], axis=1)
+    return directions / np.sqrt(np.einsum('ij,ij->i', directions, directions))[:, np.newaxis]
+
+class FieldSweep:
+    """A class which traces beams at many fields through a system of spherical lenses in a single stacked pass, and reports the spot of each field"""
+    
+    def __init__(self, lenses, bundle=None, stop=0, output=None):
+        #The stop is the index of the lens which acts as the aperture stop. The output plane is at the given z, or at the paraxial focus.
+        system = op.OpticalSystem(lenses)
+        if not(system.isSpherical()):
+            raise Exception('Field sweeps can only trace systems of spherical lenses')
+        self.__constants = system.getConstants()
+        if len(self.__constants['z0']) == 0:
+            raise Exception('A field sweep needs at least one lens')
+        self.__stop = int(stop) % len(self.__constants['z0'])
+        if output is None:
+            output = px.paraxialFocus(system)
+            if output is None:
+                raise Exception('The system has no paraxial focus, so the output plane must be given')
+        self.__output = float(output)
+        self.__bundle = rt.Bundle(10, 5, 10) if bundle is None else bundle
+        self.__launch = self.__constants['z0'][0] #The beams are laid out on the plane of the first vertex
+    
+    def getOutput(self):
+        return self.__output
+    
+    def getStop(self):
+        return self.__stop
+    
+    def rays(self, centres, directions=None, objects=None):
+        """Returns the (F,N,3) positions and directions of the beams centred on an (F,2) array of points on the launch plane, travelling in (F,3) directions,
+        or, for object points, leaving an (F,3) array of objects towards every point of the beam"""
+        
+        launch = np.zeros((len(centres), 3))
+        launch[:, :2] = centres
+        launch[:, 2] = self.__launch
+        targets = self.__bundle.stackPoints(launch)
+        if objects is None:
+            return targets, np.repeat(directions[:, np.newaxis, :], targets.shape[1], axis=1)
+        directions = targets - objects[:, np.newaxis, :]
+        points = np.repeat(objects[:, np.newaxis, :], targets.shape[1], axis=1)
+        return points, directions / np.sqrt(np.einsum('fni,fni->fn', directions, directions))[:, :, np.newaxis]
+    
+    def traceTo(self, points, directions, surfaces, output=None):
+        """Traces an (F,N,3) stack of rays through the first few lenses of the system, and optionally onto an output plane"""
+        
+        shape = (len(points), surfaces) #Every field is traced through the same lenses
+        z0, curvature, aperture, relativeIndex = [np.broadcast_to(self.__constants[name][:surfaces], shape) for name in ('z0', 'curvature', 'aperture', 'relativeIndex')]
+        return op.traceStack(points, directions, z0, curvature, aperture, relativeIndex, output)
+    
+    def aim(self, directions=None, objects=None, tolerance=1e-9, maxIterations=20, step=1e-6):
+        """Finds the centres of the beams on the launch plane for which the chief ray of each field passes through the centre of the stop, for all the fields at once.
+        Returns the (F,2) centres and a boolean array which is False for fields whose chief ray could not be aimed (they keep the straight line guess)."""
+        
+        count = len(directions) if objects is None else len(objects)
+        stopZ = self.__constants['z0'][self.__stop]
+        #The first guess is the straight line through the centre of the stop, ignoring the lenses before it
+        if objects is None:
+            centres = -directions[:, :2] / directions[:, 2:] * (stopZ - self.__launch)
+        else:
+            centres = objects[:, :2] * (stopZ - self.__launch) / (stopZ - objects[:, 2:])
+        converged = np.zeros(count, dtype='bool')
+        aperture = self.__constants['aperture'][:self.__stop + 1].min()
+        for iteration in range(maxIterations):
+            #The chief ray of every field is traced along with one ray stepped in x and one stepped in y, to find the Jacobian of its position at the stop
+            trial = np.repeat(centres[:, np.newaxis, :], 3, axis=1)
+            trial[:, 1, 0] += step * max(aperture, 1.0)
+            trial[:, 2, 1] += step * max(aperture, 1.0)
+            launch = np.concatenate([trial, np.full((count, 3, 1), self.__launch)], axis=2)
+            if objects is None:
+                points, rayDirections = launch, np.repeat(directions[:, np.newaxis, :], 3, axis=1)
+            else:
+                points = np.repeat(objects[:, np.newaxis, :], 3, axis=1)
+                rayDirections = launch - points
+                rayDirections = rayDirections / np.sqrt(np.einsum('fni,fni->fn', rayDirections, rayDirections))[:, :, np.newaxis]
+            hits = self.traceTo(points, rayDirections, self.__stop + 1)[0][:, :, :2]
+            error = hits[:, 0]
+            converged = np.sqrt(np.einsum('fi,fi->f', error, error)) <= tolerance
+            if converged.all() or iteration == maxIterations - 1:
+                break
+            jacobian = np.stack([hits[:, 1] - hits[:, 0], hits[:, 2] - hits[:, 0]], axis=2) / (step * max(aperture, 1.0))
+            with np.errstate(invalid='ignore'):
+                usable = ~converged & np.isfinite(jacobian).all(axis=(1, 2)) & np.isfinite(error).all(axis=1) & (np.abs(np.linalg.det(np.where(np.isfinite(jacobian), jacobian, 0.0))) > 0)
+            if not usable.any():
+                break
+            centres[usable] -= np.linalg.solve(jacobian[usable], error[usable][:, :, np.newaxis])[:, :, 0]
+        return centres, converged
+    
+    def paraxialChief(self, directions=None, objects=None):
+        """Returns the (F,2) heights at the output plane of the paraxial chief rays of the fields, which pass through the centre of the stop.
+        At the paraxial focus of a field at infinity this is f tan(angle), and at the conjugate image of an object it is the magnification times the object height."""
+        
+        c = self.__constants
+        stop = px.systemMatrix(c['z0'][:self.__stop + 1], c['curvature'][:self.__stop + 1], c['n1'][:self.__stop + 1], c['n2'][:self.__stop + 1])
+        output = np.matmul(px.transferMatrices(self.__output - c['z0'][-1]), px.systemMatrix(c['z0'], c['curvature'], c['n1'], c['n2']))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            #The height and slope of each chief ray on the launch plane are chosen so that its height at the stop, stop[0,0]*height + stop[0,1]*slope, is zero
+            if objects is None:
+                slope = directions[:, :2] / directions[:, 2:]
+                height = -stop[0, 1] * slope / stop[0, 0]
+            else:
+                distance = self.__launch - objects[:, 2:]
+                slope = -stop[0, 0] * objects[:, :2] / (stop[0, 0] * distance + stop[0, 1])
+                height = objects[:, :2] + distance * slope
+        return output[0, 0] * height + output[0, 1] * slope
+    
+    def run(self, angles=None, objects=None, aimChief=True):
+        """Traces a beam for every field, given as field angles in degrees (see fieldDirections) or as an (F,3) array of object points, in a single stacked pass.
+        Returns a dictionary of (F,) or (F,2) arrays of:
+            rms           The RMS spot radius of each field about its chief ray (or its centroid, if the chief ray is lost).
+            chief         The position of the chief ray at the output plane.
+            centroid      The centroid of the spot.
+            distortion    The fractional distortion of the chief ray height from the height of the paraxial chief ray at the output plane.
+            vignetting    The fraction of the rays of each beam which were lost.
+            centres       The centre of each beam on the plane of the first lens, and aimed, which is False for fields whose chief ray could not be aimed.
+        along with the (F,N,3) end points and (F,N) alive mask of every ray."""
+        
+        if (angles is None) == (objects is None):
+            raise Exception('Either field angles or object points must be given')
+        if objects is None:
+            directions = fieldDirections(angles)
+        else:
+            directions = None
+            objects = np.array(objects, dtype='float', ndmin=2)
+            if np.any(objects[:, 2] >= self.__launch):
+                raise Exception('The object points must lie before the first lens')
+        if aimChief:
+            centres, aimed = self.aim(directions, objects)
+        else:
+            count = len(directions) if objects is None else len(objects)
+            centres, aimed = np.zeros((count, 2)), np.zeros(count, dtype='bool')
+        points, rayDirections = self.rays(centres, directions, objects)
+        end, alive = self.traceTo(points, rayDirections, len(self.__constants['z0']), self.__output)
+        
+        count = alive.sum(axis=1)
+        xy = np.where(alive[:, :, np.newaxis], end[:, :, :2], 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroid = xy.sum(axis=1) / count[:, np.newaxis]
+            chief = np.where(alive[:, :1], xy[:, 0, :], np.nan)
+            centre = np.where(alive[:, :1], xy[:, 0, :], centroid)
+            offset = np.where(alive[:, :, np.newaxis], xy - centre[:, np.newaxis, :], 0.0)
+            rms = np.sqrt(np.einsum('fni,fni->f', offset, offset) / count)
+            ideal = self.paraxialChief(directions, objects)
+            idealHeight = np.sqrt(np.einsum('fi,fi->f', ideal, ideal))
+            height = np.sqrt(np.einsum('fi,fi->f', chief, chief))
+            distortion = np.where(idealHeight > 0, (height - idealHeight) / idealHeight, np.nan)
+        return {'rms': rms, 'chief': chief, 'centroid': centroid, 'distortion': distortion, 'vignetting': 1.0 - count / float(alive.shape[1]),
+                'centres': centres, 'aimed': aimed, 'points': end, 'alive': alive}
@@ -0,0 +1,88 @@
+import numpy as np
+
+"""
+Refractive index models of optical glasses. Wavelengths are given in mm, like every other length in the simulation.
+"""
+
+REFERENCE = 588e-6 #The reference wavelength of 588nm, at which the index of a glass is used when no wavelength is given
+
+class Glass:
+    """A class which allows dispersive materials to be created. The index at each wavelength is only calculated once and is then cached."""
+    
+    def __init__(self, name=''):
+        self.name = name
+        self.__cache = {}
+        
+    def __repr__(self):
+        return "%s(%s, n = %g)" % (self.__class__.__name__, self.name, self.index(REFERENCE))
+        
+    def formula(self, wavelength):
+        """Calculates the refractive index at an array of wavelengths in microns"""
+        
+        raise NotImplementedError()
+        
+    def index(self, wavelength=REFERENCE):
+        """Returns the refractive index at a wavelength, or an array of indices for an array of wavelengths"""
+        
+        wavelengths = np.atleast_1d(np.asarray(wavelength, dtype='float'))
+        missing = [value for value in wavelengths.tolist() if value not in self.__cache]
+        if missing:
+            indices = self.formula(np.array(missing) * 1e3) #The formulas use wavelengths in microns
+            self.__cache.update(zip(missing, indices.tolist()))
+        indices = np.array([self.__cache[value] for value in wavelengths.tolist()])
+        return indices[0] if np.ndim(wavelength) == 0 else indices.reshape(np.shape(wavelength))
+        
+class Constant(Glass):
+    """A subclass of Glass with the same refractive index at every wavelength, which is used for plain numerical indices"""
+    
+    def __init__(self, n, name=''):
+        Glass.__init__(self, name)
+        self.n = float(n)
+        
+    def formula(self, wavelength):
+        return np.full(len(wavelength), self.n)
+        
+class Sellmeier(Glass):
+    """A subclass of Glass whose index follows the Sellmeier equation n^2 = 1 + sum(B * L^2 / (L^2 - C)), with the wavelength L in microns"""
+    
+    def __init__(self, B, C, name=''):
+        Glass.__init__(self, name)
+        self.B = np.array(B, dtype='float')
+        self.C = np.array(C, dtype='float')
+        if self.B.shape != self.C.shape:
+            raise Exception('A Sellmeier glass needs the same number of B and C coefficients')
+            
+    def formula(self, wavelength):
+        square = (wavelength**2)[:, np.newaxis]
+        return np.sqrt(1 + (self.B * square / (square - self.C)).sum(axis=1))
+        
+class Cauchy(Glass):
+    """A subclass of Glass whose index follows Cauchy's equation n = A + B/L^2 + C/L^4, with the wavelength L in microns"""
+    
+    def __init__(self, A, B, C=0.0, name=''):
+        Glass.__init__(self, name)
+        self.A = float(A)
+        self.B = float(B)
+        self.C = float(C)
+        
+    def formula(self, wavelength):
+        return self.A + self.B / wavelength**2 + self.C / wavelength**4
+        
+def material(n):
+    """Returns a Glass for a refractive index, which is either a Glass already, the name of one of the materials below, or a number"""
+    
+    if isinstance(n, Glass):
+        return n
+    if isinstance(n, str):
+        if n not in MATERIALS:
+            raise Exception('Unknown material %s, which must be one of: %s' % (n, ', '.join(sorted(MATERIALS))))
+        return MATERIALS[n]
+    return Constant(n)
+    
+#A few common materials
+AIR = Constant(1.0, 'Air')
+BK7 = Sellmeier([1.03961212, 0.231792344, 1.01046945], [0.00600069867, 0.0200179144, 103.560653], 'N-BK7')
+F2 = Sellmeier([1.34533359, 0.209073176, 0.937357162], [0.00997743871, 0.0470450767, 111.886764], 'F2')
+SF11 = Sellmeier([1.73759695, 0.313747346, 1.89878101], [0.013188707, 0.0623068142, 155.23629], 'N-SF11')
+
+MATERIALS = {'AIR': AIR, 'BK7': BK7, 'F2': F2, 'SF11': SF11} #The materials which can be given by name, such as in a system description file
@@ -0,0 +1,132 @@
+import numpy as np
+import raytracer as rt
+import optics2 as op
+import optimise
+import sweep
+
+"""
+Incremental re-tracing of a fixed set of rays while a design is changed one surface at a time.
+
+The state of the rays after every lens is kept, so changing a lens only re-traces the rays from the state before it, and moving the output plane re-traces
+nothing at all: the rays are only extrapolated from the state after the last lens. Many output planes can be evaluated in one broadcast, which gives a
+through-focus curve of the RMS spot radius for the price of a single trace.
+"""
+
+class IncrementalTrace:
+    """A class which traces rays through a lens system whose lenses and output plane can be changed, re-tracing only from the first lens which has changed"""
+    
+    def __init__(self, lenses, points, directions, output=None):
+        self.__lenses = list(lenses)
+        self.__system = op.OpticalSystem(self.__lenses)
+        start = rt.RayBatch(points, directions, history='none')
+        count = len(start)
+        #The state of the rays before the first lens and after every lens: their positions, directions, alive mask and status codes
+        self.__states = [(start.p(), start.k(), np.ones(count, dtype='bool'), np.zeros(count, dtype='int8'))]
+        self.__dirty = 0 #The index of the first lens whose state is out of date
+        self.__output = None if output is None else float(output)
+        self.__traced = 0
+        self.__reused = 0
+    
+    def __len__(self):
+        return len(self.__lenses)
+    
+    def getLenses(self):
+        return list(self.__lenses)
+    
+    def getOutput(self):
+        return self.__output
+    
+    def getSystem(self):
+        """Returns the lenses, and the output plane if there is one, as an OpticalSystem"""
+        
+        return op.OpticalSystem(self.__lenses + ([] if self.__output is None else [op.OutputPlane(self.__output)]))
+    
+    def dirty(self):
+        """Returns the index of the first lens which will be re-traced, which is the number of lenses if every state is up to date"""
+        
+        return self.__dirty
+    
+    def setLens(self, index, lens):
+        """Replaces a lens, so that the rays are re-traced from it onwards"""
+        
+        lenses = list(self.__lenses)
+        lenses[index] = lens
+        self.__system = op.OpticalSystem(lenses) #The new system checks that the lenses are still in order
+        self.__lenses = lenses
+        self.__dirty = min(self.__dirty, index % len(lenses))
+    
+    def setParameters(self, index, **parameters):
+        """Changes the arguments of a lens (z0, aperture, curvature, n1, n2, or the conic and coefficients of an aspheric lens), such as setParameters(1, curvature=-0.01)"""
+        
+        arguments = sweep.lensParameters(self.__lenses[index])
+        for name in parameters:
+            if name not in arguments and name not in ('conic', 'coefficients'):
+                raise Exception('Unknown lens parameter: %s' % name)
+        arguments.update(parameters)
+        self.setLens(index, sweep.buildLens(arguments))
+    
+    def setOutput(self, z):
+        """Moves the output plane, which never needs the lenses to be re-traced"""
+        
+        self.__output = float(z)
+    
+    def update(self):
+        """Re-traces the rays through every lens from the first one which has changed, and returns the state after the last lens"""
+        
+        self.__reused += self.__dirty
+        p, k, alive, status = self.__states[self.__dirty]
+        del self.__states[self.__dirty + 1:]
+        for surface in range(self.__dirty, len(self.__lenses)):
+            intercepts, refracted, passed, codes = self.__system.traceSurface(surface, p, k)
+            terminated = alive & ~passed
+            status = np.where(terminated, codes, status).astype('int8')
+            alive = alive & passed
+            p, k = intercepts, refracted
+            p[~alive] = np.nan #Terminated rays are NaN, as in a RayBatch
+            k[~alive] = np.nan
+            self.__states.append((p, k, alive, status))
+            self.__traced += 1
+        self.__dirty = len(self.__lenses)
+        return self.__states[-1]
+    
+    def state(self, index=None):
+        """Returns the positions, directions, alive mask and status codes of the rays after the lens with the given index (by default the last lens), or before the first lens for index -1"""
+        
+        self.update()
+        return self.__states[len(self.__lenses) if index is None else index + 1]
+    
+    def endPoints(self, output=None):
+        """Returns the (N,3) positions of the rays at the output plane (or the given z) and the (N,) alive mask, found from the state after the last lens"""
+        
+        output = self.__output if output is None else output
+        if output is None:
+            raise Exception('An output plane must be set before the end points can be found')
+        p, k, alive, status = self.update()
+        return op.planeIntercepts(p, k, float(output)), alive
+    
+    def rms(self, output=None):
+        """Returns the RMS spot radius at the output plane (or the given z), about the chief ray (the first ray) or the centroid if the chief ray was lost"""
+        
+        points, alive = self.endPoints(output)
+        return float(optimise.stackRMS(points[np.newaxis], alive[np.newaxis])[0])
+    
+    def throughFocus(self, positions):
+        """Evaluates the spot at many output planes at once, broadcasting the rays from the state after the last lens onto a (Z,N,3) stack of end points.
+        Returns a dictionary of the positions, the RMS spot radius at each of them, and the position and RMS spot radius of the best focus among them."""
+        
+        positions = np.atleast_1d(np.asarray(positions, dtype='float'))
+        p, k, alive, status = self.update()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lengths = (positions[:, np.newaxis] - p[np.newaxis, :, 2]) / k[np.newaxis, :, 2]
+            points = p[np.newaxis] + lengths[:, :, np.newaxis] * k[np.newaxis]
+        rms = optimise.stackRMS(points, np.broadcast_to(alive, lengths.shape))
+        result = {'positions': positions, 'rms': rms, 'bestFocus': np.nan, 'bestRMS': np.nan}
+        if np.isfinite(rms).any():
+            best = int(np.nanargmin(rms))
+            result['bestFocus'], result['bestRMS'] = positions[best], rms[best]
+        return result
+    
+    def getStatistics(self):
+        """Returns the number of lens traces made, and the number saved by reusing the cached states"""
+        
+        return {'tracedSurfaces': self.__traced, 'reusedSurfaces': self.__reused}
@@ -0,0 +1,246 @@
+import os
+import numpy as np
+import optics2 as op
+import stream
+
+"""
+Image plane analysis: irradiance maps built by binning the weighted end points of the rays into a fixed 2D grid across the output plane.
+
+A map only holds its grid, so it can be filled from a stream of chunks of any size, and maps filled separately (by different processes, or from different
+traces) are merged by adding their grids. Encircled and ensquared energy curves are found from the map, and the maps are saved as arrays.
+Matplotlib is only imported when a map is plotted.
+"""
+
+def cumulativeEnergy(distance, energy):
+    """Sorts the bins by their distance from a centre, and returns the sorted distances along with the energy within each of them"""
+    
+    order = np.argsort(distance, axis=None, kind='mergesort')
+    return distance.ravel()[order], np.cumsum(energy.ravel()[order])
+
+def mapChunk(system, points, direction, extent, bins):
+    """Traces a chunk of rays through a system and returns the partial map of their end points, for the worker processes"""
+    
+    batch = system.trace(points, direction)
+    return IrradianceMap(extent, bins).add(batch.p(), batch.alive())
+
+def traceMap(system, chunks, extent, bins=256, direction=(0, 0, 1), workers=None):
+    """Traces chunks of initial positions (see stream.bundleChunks) through a system and bins their end points into a single map.
+    The chunks are traced on workers processes (None uses every core, and 0 or 1 traces in this process), each of which returns a partial map to be merged,
+    with at most two chunks per worker waiting at once so the memory used stays bounded however many rays are traced."""
+    
+    if not(isinstance(system, op.OpticalSystem)):
+        system = op.OpticalSystem(system)
+    direction = np.array(direction, dtype='float')
+    total = IrradianceMap(extent, bins)
+    if workers is not None and workers <= 1:
+        return stream.StreamTracer(system, direction).run(chunks, [total])['results'][0]
+    import concurrent.futures
+    limit = 2 * (workers or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for points in chunks:
+            pending.add(pool.submit(mapChunk, system, points, direction, extent, bins))
+            if len(pending) >= limit:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    total.merge(future.result())
+        for future in concurrent.futures.as_completed(pending):
+            total.merge(future.result())
+    return total
+
+class IrradianceMap:
+    """A class which accumulates the weighted end points of rays into a fixed 2D grid of bins across the output plane, and can be used as a reducer of a streamed trace"""
+    
+    def __init__(self, extent, bins=256):
+        #The extent is (xmin, xmax, ymin, ymax) of the grid, and bins is the number of bins along both axes or an (nx, ny) pair
+        self.__extent = tuple(float(edge) for edge in extent)
+        self.__bins = (int(bins), int(bins)) if np.ndim(bins) == 0 else (int(bins[0]), int(bins[1]))
+        if self.__extent[1] <= self.__extent[0] or self.__extent[3] <= self.__extent[2]:
+            raise Exception('The extent of a map must be given as (xmin, xmax, ymin, ymax)')
+        self.__energy = np.zeros(self.__bins) #The total weight in each bin, indexed by x then y
+        self.__counts = np.zeros(self.__bins, dtype='int64')
+        self.__outside = 0.0 #The weight of the rays which fell outside the grid
+        self.__rays = 0
+        self.__lost = 0 #The number of rays which did not reach the output plane
+    
+    def __repr__(self):
+        return 'IrradianceMap(Extent = %s, Bins = %s, Rays = %d)' % (self.__extent, self.__bins, self.__rays)
+    
+    def getExtent(self):
+        return self.__extent
+    
+    def getBins(self):
+        return self.__bins
+    
+    def edges(self):
+        """Returns the edges of the bins in x and in y"""
+        
+        xmin, xmax, ymin, ymax = self.__extent
+        return np.linspace(xmin, xmax, self.__bins[0] + 1), np.linspace(ymin, ymax, self.__bins[1] + 1)
+    
+    def centres(self):
+        """Returns the x and y positions of the centres of the bins"""
+        
+        xedges, yedges = self.edges()
+        return 0.5 * (xedges[1:] + xedges[:-1]), 0.5 * (yedges[1:] + yedges[:-1])
+    
+    def binArea(self):
+        xmin, xmax, ymin, ymax = self.__extent
+        return (xmax - xmin) * (ymax - ymin) / float(self.__bins[0] * self.__bins[1])
+    
+    def add(self, points, alive=None, weights=None):
+        """Adds a chunk of (N,3) ray end points, with an optional (N,) weight (power) for each ray, to the map. Terminated rays are left out."""
+        
+        points = np.asarray(points)
+        if alive is None:
+            alive = ~np.isnan(points[:, 0])
+        alive = np.asarray(alive, dtype='bool')
+        self.__rays += len(points)
+        self.__lost += int(len(points) - alive.sum())
+        x, y = points[alive, 0], points[alive, 1]
+        weights = np.ones(len(x)) if weights is None else np.broadcast_to(np.asarray(weights, dtype='float'), alive.shape)[alive]
+        xmin, xmax, ymin, ymax = self.__extent
+        nx, ny = self.__bins
+        #The bins are found by scaling rather than searching the edges, and filled with a single weighted bincount
+        i = np.floor((x - xmin) * (nx / (xmax - xmin))).astype('int64')
+        j = np.floor((y - ymin) * (ny / (ymax - ymin))).astype('int64')
+        inside = (i >= 0) & (i < nx) & (j >= 0) & (j < ny)
+        index = i[inside] * ny + j[inside]
+        self.__energy += np.bincount(index, weights[inside], minlength=nx * ny).reshape(nx, ny)
+        self.__counts += np.bincount(index, minlength=nx * ny).reshape(nx, ny)
+        self.__outside += float(weights[~inside].sum())
+        return self
+    
+    def addBatch(self, batch, weights=None):
+        """Adds the end points of a ray batch to the map"""
+        
+        return self.add(batch.p(), batch.alive(), weights)
+    
+    def merge(self, other):
+        """Adds the map filled by another accumulator, for example in a separate process, or the state of one, which must have the same grid"""
+        
+        state = other if isinstance(other, dict) else other.state()
+        if tuple(state['extent']) != self.__extent or tuple(state['bins']) != self.__bins:
+            raise Exception('Only maps with the same extent and bins can be merged')
+        self.__energy += state['energy']
+        self.__counts += state['counts']
+        self.__outside += state['outside']
+        self.__rays += state['rays']
+        self.__lost += state['lost']
+        return self
+    
+    def state(self):
+        """Returns the grid and running totals of the map"""
+        
+        return {'extent': self.__extent, 'bins': self.__bins, 'energy': self.__energy, 'counts': self.__counts, 'outside': self.__outside, 'rays': self.__rays,
+                'lost': self.__lost}
+    
+    def result(self):
+        """Returns the map, so that it can be used as a reducer of a streamed trace"""
+        
+        return self
+    
+    def totalEnergy(self):
+        """Returns the total weight of the rays which reached the output plane, including those outside the grid"""
+        
+        return float(self.__energy.sum()) + self.__outside
+    
+    def irradiance(self):
+        """Returns the (nx, ny) irradiance, the weight per unit area, of each bin"""
+        
+        return self.__energy / self.binArea()
+    
+    def centroid(self):
+        """Returns the energy-weighted centroid of the map"""
+        
+        energy = self.__energy.sum()
+        if energy == 0:
+            return np.array([np.nan, np.nan])
+        x, y = self.centres()
+        return np.array([np.dot(self.__energy.sum(axis=1), x), np.dot(self.__energy.sum(axis=0), y)]) / energy
+    
+    def distances(self, centre=None, square=False):
+        """Returns the distance of every bin centre from the centre (by default the centroid), or the half width of the smallest square about the centre containing it"""
+        
+        centre = self.centroid() if centre is None else np.asarray(centre, dtype='float')[:2]
+        x, y = self.centres()
+        dx, dy = np.abs(x - centre[0])[:, np.newaxis], np.abs(y - centre[1])[np.newaxis, :]
+        if square:
+            return np.maximum(dx, dy)
+        return np.sqrt(dx**2 + dy**2)
+    
+    def energyCurve(self, sizes=None, centre=None, square=False):
+        """Returns the encircled (or, if square is True, ensquared) energy as a fraction of the total energy at the output plane, for each radius (or half width).
+        By default the curve is given at every bin step out to the edge of the grid. The curve is accurate to the size of one bin."""
+        
+        distance, cumulative = cumulativeEnergy(self.distances(centre, square), self.__energy)
+        if sizes is None:
+            xmin, xmax, ymin, ymax = self.__extent
+            step = min((xmax - xmin) / self.__bins[0], (ymax - ymin) / self.__bins[1])
+            sizes = np.arange(1, int(np.ceil(distance[-1] / step)) + 1) * step
+        sizes = np.atleast_1d(np.asarray(sizes, dtype='float'))
+        total = self.totalEnergy()
+        inside = np.searchsorted(distance, sizes, side='right') #The number of bins whose centres lie within each size
+        fraction = np.where(inside > 0, cumulative[np.maximum(inside - 1, 0)], 0.0) / total if total > 0 else np.full(len(sizes), np.nan)
+        return sizes, fraction
+    
+    def encircledEnergy(self, radii=None, centre=None):
+        """Returns the radii and the fraction of the energy encircled within each of them (see energyCurve)"""
+        
+        return self.energyCurve(radii, centre)
+    
+    def ensquaredEnergy(self, halfWidths=None, centre=None):
+        """Returns the half widths and the fraction of the energy within squares of each of them (see energyCurve)"""
+        
+        return self.energyCurve(halfWidths, centre, square=True)
+    
+    def energyRadius(self, fraction, centre=None, square=False):
+        """Returns the smallest radius (or half width) which contains the given fraction of the energy, or infinity if the grid does not contain that much"""
+        
+        distance, cumulative = cumulativeEnergy(self.distances(centre, square), self.__energy)
+        index = np.searchsorted(cumulative, fraction * self.totalEnergy())
+        return float(distance[index]) if index < len(distance) else np.inf
+    
+    def save(self, filename):
+        """Saves the map as a .npz file of arrays, which load reads back"""
+        
+        np.savez(filename, energy=self.__energy, counts=self.__counts, extent=np.array(self.__extent), bins=np.array(self.__bins),
+                 totals=np.array([self.__outside, self.__rays, self.__lost], dtype='float'))
+    
+    def plot(self, filename=None, log=False, fractions=(0.5, 0.8)):
+        """Draws the irradiance map beside its encircled and ensquared energy curves, and saves the figure to a file if a filename is given.
+        Returns the figure."""
+        
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+        fig, (left, right) = plt.subplots(1, 2, figsize=(12, 5))
+        irradiance = self.irradiance()
+        norm = colors.LogNorm(vmin=max(irradiance[irradiance > 0].min(), 1e-300), vmax=irradiance.max()) if log and (irradiance > 0).any() else None
+        image = left.imshow(irradiance.T, origin='lower', extent=self.__extent, norm=norm, aspect='equal')
+        fig.colorbar(image, ax=left, label='Irradiance')
+        left.set_xlabel('x axis')
+        left.set_ylabel('y axis')
+        left.set_title('Image Plane Irradiance')
+        for square, label in ((False, 'Encircled'), (True, 'Ensquared')):
+            sizes, fraction = self.energyCurve(square=square)
+            right.plot(sizes, fraction, label=label)
+        for fraction in fractions:
+            right.axhline(fraction, color='grey', linestyle=':')
+        right.set_xlabel('Radius or half width')
+        right.set_ylabel('Energy fraction')
+        right.set_ylim(0, 1.05)
+        right.grid(True)
+        right.legend()
+        if filename is not None:
+            fig.savefig(filename)
+            plt.close(fig)
+        return fig
+
+def load(filename):
+    """Reads a map saved by IrradianceMap.save"""
+    
+    with np.load(filename) as arrays:
+        outside, rays, lost = arrays['totals']
+        result = IrradianceMap(arrays['extent'], arrays['bins'])
+        return result.merge({'extent': result.getExtent(), 'bins': result.getBins(), 'energy': arrays['energy'], 'counts': arrays['counts'], 'outside': float(outside),
+                             'rays': int(rays), 'lost': int(lost)})
@@ -1,52 +1,53 @@
+from __future__ import print_function
 import raytracer as rt
 import optics2 as op
 import plotting as pt
+import sweep
+import optimise
+import glass as gl
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.optimize as so
 
+try:
+    raw_input
+except NameError:
+    raw_input = input #The input interface also runs under Python 3
 
 class Main:
     """A class which utilises an input interface so that the user may select which parts of the simulation to use."""      
     
-    def plotRays(self, rayVectors):
-        """A function which shows all the various plots of the rays"""
+    def __init__(self):
+        self.__objective = None #The objective for the optimal biconvex lens, which is only built once
+        
+    def plotRays(self, rayVectors, prefix=None):
+        """A function which shows all the various plots of the rays, or saves them to files named after the prefix without showing them"""
         
         plot = pt.Plot(rayVectors)
+        if prefix is not None:
+            return plot.savePlots(prefix)
         plot.plotRays2D()
         plot.plotRays3D()
         plot.plotInput()
-        plot.plotOutput()
+        print('RMS: ', plot.plotOutput())
         plt.show()
         
     def planoConvex(self, lens1, lens2, diameters):
         """A function which calculates and plots the RMS spot radius for the range of diameters input"""
         
-        lenses = [lens1, lens2]
-        testRay = rt.Ray([0.1,0,0], [0,0,1])
+        lenses = op.OpticalSystem([lens1, lens2])
+        paraxialFocus = lenses.paraxialFocus() #The paraxial focus is found from the ray transfer matrices of the lens, without tracing a ray
+        print('Paraxial Focus: ', paraxialFocus)
+        wavelength = gl.REFERENCE #The wavelength of the light is 588nm (The units used in the simulation are mm)
+        design = sweep.design([lens1, lens2], n=10, m=10, output=paraxialFocus, wavelength=wavelength) #Setting the output plane at the paraxial focus of the setup
         
-        for lens in lenses:
-            lens.propagateRay(testRay)
-            
-        output = lenses[-1].paraxial(testRay) #Setting the output plane at the paraxial focus of the setup
-        lenses.append(output)
-        focalLength = output.getz() - ((lens1.getz0() + lens2.getz0())/2) #Calculating the focal length of the lens
-        wavelength = 588e-6 #The wavelength of the light is 588nm (The units used in the simulation are mm)
-        ray = rt.Ray([0,0,0], [0,0,1])
-        diameterList = []
-        RMSList = []
-        diffractionList = []
+        focalLength = paraxialFocus - ((lens1.getz0() + lens2.getz0())/2) #Calculating the focal length of the lens, from its paraxial focus to its centre
         
-        for i in diameters:
-            diameterList.append(i)
-            rays = rt.Bundle(10, i/2, 10).getBundle(ray) #Creating a bundle of rays for each diameter
-            for lens in lenses:
-                lens.propagateBundle(rays) #Propagating the rays through the lenses
-            plot = pt.Plot(rays)
-            RMS = plot.rms() #Calculating the RMS spot radius of the rays at the output for each diameter
-            RMSList.append(RMS)
-            diffractionLimit = (focalLength * wavelength)/i #Also calculating the diffraction scale for each diameter
-            diffractionList.append(diffractionLimit)
+        #A bundle of rays is traced for each diameter, and the sweep calculates the RMS spot radius for each one
+        results = sweep.Sweep(design).run({'bundle.rmax': np.array(diameters, dtype='float')/2}, workers=1)
+        diameterList = (2 * results['bundle.rmax']).tolist()
+        RMSList = results['rms'].tolist()
+        diffractionList = [(focalLength * wavelength)/i for i in diameterList] #Also calculating the diffraction scale for each diameter
             
         fig = plt.figure()
         ax = fig.add_subplot(111)
@@ -64,25 +65,22 @@ class Main:
         
         index = difference.index(min(difference))
         intersection = diameterList[index] #Finding the point on the graph where the difference between the two functions is a minimum, and taking this to be the intersection point of the two plots.
-        print 'Intersection is: ', intersection
+        print('Intersection is: ', intersection)
         
     def optimalRMS(self, curvatures):
         """A function which calculates and returns the log of the RMS spot radius for two given curvatures of a biconvex lens"""
         
-        lens1 = op.SphericalRefraction(100, 20, curvatures[0], 1, 1.5168)
-        lens2 = op.SphericalRefraction(105, 20, curvatures[1], 1.5168, 1)
-        output = op.OutputPlane(200) #The output plane is set at z=200mm
-        lenses = [lens1, lens2, output]
+        return self.biconvexObjective().value(curvatures)
         
-        ray = rt.Ray([0,0,0], [0,0,1])
-        rays = rt.Bundle(10, 5, 10).getBundle(ray) #A bundle of rays is created
+    def biconvexObjective(self):
+        """A function which returns the objective used to find the optimal biconvex lens. It calculates the log of the RMS spot radius, along with its gradient, for the two curvatures."""
         
-        for lens in lenses:
-            lens.propagateBundle(rays) #The rays are propagated through the biconvex lens
-        plot = pt.Plot(rays)
-        RMS = plot.rms() #Calculating the RMS spot radius of the rays at the output for the given curvatures
-        log = np.log(RMS)
-        return log
+        if self.__objective is None:
+            lens1 = op.SphericalRefraction(100, 20, 0, 1, 1.5168)
+            lens2 = op.SphericalRefraction(105, 20, 0, 1.5168, 1)
+            #The output plane is set at z=200mm, and the same bundle of rays is propagated through the biconvex lens for every pair of curvatures
+            self.__objective = optimise.Objective([lens1, lens2], output=200, bundle=rt.Bundle(10, 5, 10))
+        return self.__objective
         
     def run(self):
         """This function provides an input interface for the user when the module is imported into the terminal"""
@@ -133,8 +131,9 @@ class Main:
                 curvaturesInput = [float(coordinate) for coordinate in curvaturesInput]
                 
                 x0 = np.array([curvaturesInput[0], curvaturesInput[1]])
-                result = so.fmin_tnc(self.optimalRMS, x0, bounds=b, approx_grad=True)
-                print result
+                result = so.fmin_tnc(self.biconvexObjective(), x0, bounds=b) #The objective supplies its own gradient
+                print(result)
+                print(self.biconvexObjective().report())
             
         if terminate == False:
             allRays = [] #A list of all the rays created by the user
@@ -185,14 +184,14 @@ class Main:
                 if 'n' in addLensInput:
                     addLens = False
             
-            for lens in lenses:
-                lens.propagateBundle(allRays)
+            system = op.OpticalSystem(lenses)
+            system.propagateBundle(allRays)
             
-            testRay = rt.Ray([0.1, 0, 0], [0, 0, 1])
-            for lens in lenses:
-                lens.propagateRay(testRay)
-            output = lenses[-1].paraxial(testRay) #The output plane is set at the paraxial focus
-            if output is None: #If the rays do not converge, there is no paraxial focus, so the user is asked to input the position of the output plane
+            paraxialFocus = system.paraxialFocus()
+            if paraxialFocus is not None:
+                print('Paraxial Focus: ', paraxialFocus)
+                output = op.OutputPlane(paraxialFocus) #The output plane is set at the paraxial focus
+            if paraxialFocus is None: #If the rays do not converge, there is no paraxial focus, so the user is asked to input the position of the output plane
                 outputInput = raw_input("Your system does not have a paraxial focus. Enter the z coordinate for your Output plane.\n")
                 outputInput = outputInput.split()
                 outputInput = [float(coordinate) for coordinate in outputInput]
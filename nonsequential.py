@@ -0,0 +1,369 @@
+import numpy as np
+import raytracer as rt
+import optics2 as op
+
+"""
+Non-sequential tracing, in which every ray finds its nearest hit among all of the surfaces, in any order and travelling in either direction.
+Rays refract at lenses, reflect at mirrors and by total internal reflection, and stop at detectors (output planes), when they escape, or after the bounce limit.
+
+The surfaces are held in a bounding volume hierarchy of the boxes around their apertures, so each bounce only tests a ray against the surfaces whose boxes it
+passes through closer than its nearest hit so far, and the cost per bounce grows much more slowly than the number of surfaces.
+
+traceTree splits every ray which hits a lens into a transmitted and a reflected ray, weighted by the Fresnel equations, to follow ghost reflections.
+The rays are traced a generation (one bounce) at a time as a single vectorised pass, branches carrying less than the threshold intensity are pruned,
+and the deepest generation waiting in the queue is always traced first, in chunks of at most maxLive rays. Each chunk leaves at most 2*maxLive children in the
+next generation, so the rays held at once never exceed the input rays plus about 2*maxLive for every generation, rather than growing with the whole tree.
+"""
+
+#The final status of each ray
+DETECTED = 0 #The ray reached a detector
+ESCAPED = 1 #The ray left the system without hitting anything more
+CAPPED = 2 #The ray was still bouncing when the bounce limit was reached
+
+REFRACT = 0
+REFLECT = 1
+DETECT = 2
+
+def capIntercepts(points, directions, z0, curvature, apertureSquare, minimum=1e-9):
+    """Returns the distance along each of an (N,3) array of rays to its first hit with a spherical cap (or a plane, when the curvature is zero) from either side,
+    or infinity for rays which miss it. Hits closer than the minimum are ignored, so a ray leaving a surface does not hit it again at the same point.
+    The cap is the part of the sphere around its vertex at z0, out to the aperture and no further than the equator of the sphere."""
+    
+    x, y, z = points[:, 0], points[:, 1], points[:, 2] - z0
+    kx, ky, kz = directions[:, 0], directions[:, 1], directions[:, 2]
+    best = np.full(len(points), np.inf)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        #The roots of c|p + tk|^2 - 2(z + t kz) = 0, in a form which is accurate for both roots and finite for a plane
+        b = curvature * (x * kx + y * ky + z * kz) - kz
+        constant = curvature * (x**2 + y**2 + z**2) - 2 * z
+        factor = b**2 - curvature * constant
+        q = -(b + np.copysign(np.sqrt(np.where(factor >= 0, factor, np.nan)), b))
+        for t in (q / curvature, constant / q):
+            hz = z + t * kz
+            valid = np.isfinite(t) & (t > minimum) & ((x + t * kx)**2 + (y + t * ky)**2 <= apertureSquare) & (curvature * hz <= 1)
+            best = np.where(valid & (t < best), t, best)
+    return best
+
+def fresnelReflectance(cosine, ratio):
+    """Returns the fraction of unpolarised light reflected at a boundary, for rays with the given cosines of their angles of incidence and ratios n1/n2
+    of the index they are in to the index beyond the boundary. The reflectance is 1 for total internal reflection."""
+    
+    cosine = np.abs(cosine)
+    factor = 1 - ratio**2 * (1 - cosine**2)
+    transmitted = np.sqrt(np.maximum(factor, 0.0)) #The cosine of the angle of refraction
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s = (ratio * cosine - transmitted) / (ratio * cosine + transmitted)
+        p = (cosine - ratio * transmitted) / (cosine + ratio * transmitted)
+    return np.where(factor > 0, np.clip(0.5 * (s**2 + p**2), 0.0, 1.0), 1.0)
+
+def planeDistances(points, directions, z, minimum=1e-9):
+    """Returns the distance along each ray to the plane at z, or infinity for rays which are travelling away from it or parallel to it"""
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (z - points[:, 2]) / directions[:, 2]
+    return np.where(np.isfinite(t) & (t > minimum), t, np.inf)
+
+def boxDistances(low, high, points, directions):
+    """Returns the distances along each ray at which it enters and leaves the axis-aligned box from low to high (entry > exit if it misses the box)"""
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        inverse = 1 / directions
+        first = (low - points) * inverse
+        second = (high - points) * inverse
+        entry = np.nanmax(np.fmin(first, second), axis=1) #Components parallel to a face give NaN or infinite distances, which fmin and fmax handle
+        exit = np.nanmin(np.fmax(first, second), axis=1)
+    return entry, exit
+
+class NonSequentialSystem:
+    """A class which traces rays non-sequentially through a set of lenses, mirrors and detectors, which may be given in any order"""
+    
+    def __init__(self, elements, mirrors=(), leafSize=1):
+        #Lenses refract (or reflect, with total internal reflection), the lenses whose indices in the list of elements are given in mirrors always reflect,
+        #and output planes are detectors which stop the rays that reach them
+        self.__elements = list(elements)
+        surfaces = []
+        for i, element in enumerate(self.__elements):
+            if isinstance(element, op.AsphericRefraction):
+                raise Exception('Only spherical and planar surfaces can be traced non-sequentially')
+            if isinstance(element, op.SphericalRefraction):
+                n1, n2 = element.getIndices()
+                surfaces.append((REFLECT if i in mirrors else REFRACT, element.getz0(), element.getCurvature(), element.getAperture(), n1, n2))
+            elif isinstance(element, op.OutputPlane):
+                surfaces.append((DETECT, element.getz(), 0.0, np.inf, 1.0, 1.0))
+            else:
+                raise Exception('A non-sequential system must be made of lenses and output planes')
+        surfaces = np.array(surfaces, dtype='float').reshape(-1, 6)
+        self.__kind = surfaces[:, 0].astype('int8')
+        self.__z0 = surfaces[:, 1]
+        self.__curvature = surfaces[:, 2]
+        self.__aperture = surfaces[:, 3]
+        self.__apertureSquare = (self.__aperture + 5e-7)**2
+        self.__n1 = surfaces[:, 4]
+        self.__n2 = surfaces[:, 5]
+        self.__low, self.__high = self.bounds()
+        self.__leafSize = max(int(leafSize), 1)
+        self.buildTree()
+    
+    def bounds(self):
+        """Returns the (S,3) corners of the axis-aligned boxes around every surface, out to its aperture"""
+        
+        aperture = self.__aperture
+        with np.errstate(invalid='ignore'):
+            reach = np.minimum(np.abs(self.__curvature) * aperture, 1.0) #A cap wider than its sphere ends at the equator
+            sag = np.where(self.__curvature != 0, (1 - np.sqrt(1 - reach**2)) / np.where(self.__curvature != 0, np.abs(self.__curvature), 1.0), 0.0)
+        sag = np.where(self.__kind == DETECT, 0.0, sag)
+        low = np.stack([-aperture, -aperture, self.__z0 + np.where(self.__curvature < 0, -sag, 0.0)], axis=1)
+        high = np.stack([aperture, aperture, self.__z0 + np.where(self.__curvature > 0, sag, 0.0)], axis=1)
+        return low, high
+    
+    def buildTree(self):
+        """Builds the bounding volume hierarchy, splitting the surfaces at the median of the centres of their boxes along the axis where they are most spread out"""
+        
+        self.__nodeLow, self.__nodeHigh, self.__children, self.__leaves = [], [], [], []
+        
+        def build(surfaces):
+            node = len(self.__nodeLow)
+            self.__nodeLow.append(self.__low[surfaces].min(axis=0))
+            self.__nodeHigh.append(self.__high[surfaces].max(axis=0))
+            self.__children.append(None)
+            self.__leaves.append(None)
+            if len(surfaces) <= self.__leafSize:
+                self.__leaves[node] = surfaces
+                return node
+            with np.errstate(invalid='ignore'):
+                centres = np.nan_to_num(0.5 * (self.__low[surfaces] + self.__high[surfaces]))
+            axis = int(np.argmax(centres.max(axis=0) - centres.min(axis=0)))
+            order = surfaces[np.argsort(centres[:, axis], kind='mergesort')]
+            half = len(order) // 2
+            self.__children[node] = (build(order[:half]), build(order[half:]), axis)
+            return node
+        
+        if len(self.__kind) == 0:
+            raise Exception('A non-sequential system needs at least one surface')
+        build(np.arange(len(self.__kind)))
+        self.__nodeLow = np.array(self.__nodeLow)
+        self.__nodeHigh = np.array(self.__nodeHigh)
+    
+    def nodes(self):
+        return len(self.__nodeLow)
+    
+    def surfaceDistances(self, surface, points, directions):
+        """Returns the distance along each ray to a single surface, or infinity where it misses"""
+        
+        if self.__kind[surface] == DETECT:
+            return planeDistances(points, directions, self.__z0[surface])
+        return capIntercepts(points, directions, self.__z0[surface], self.__curvature[surface], self.__apertureSquare[surface])
+    
+    def nearest(self, points, directions):
+        """Finds the nearest surface hit by each of an (N,3) array of rays by walking the hierarchy. Only the rays which pass through a box closer than their
+        nearest hit so far go on to its children, and the nearer child is visited first so that the far one can be pruned.
+        Returns the distance to the hit (infinity for none), the index of the surface hit (-1 for none) and the number of ray-surface tests made."""
+        
+        count = len(points)
+        best = np.full(count, np.inf)
+        surface = np.full(count, -1, dtype='int64')
+        tests = 0
+        stack = [(0, np.arange(count))]
+        while stack:
+            node, rays = stack.pop()
+            entry, exit = boxDistances(self.__nodeLow[node], self.__nodeHigh[node], points[rays], directions[rays])
+            rays = rays[(exit >= np.maximum(entry, 0.0)) & (entry < best[rays])]
+            if len(rays) == 0:
+                continue
+            if self.__leaves[node] is not None:
+                for s in self.__leaves[node]:
+                    t = self.surfaceDistances(s, points[rays], directions[rays])
+                    tests += len(rays)
+                    closer = t < best[rays]
+                    best[rays[closer]] = t[closer]
+                    surface[rays[closer]] = s
+                continue
+            left, right, axis = self.__children[node]
+            #The children are split along an axis, so the one on the side the rays are mostly coming from is visited first
+            near, far = (left, right) if directions[rays, axis].sum() >= 0 else (right, left)
+            stack.append((far, rays))
+            stack.append((near, rays))
+        return best, surface, tests
+    
+    def facingNormals(self, surface, points, directions):
+        """Returns the unit normals of a lens at the points where rays hit it, turned to face the incoming rays, and which of the rays came from the n1 side"""
+        
+        curvature = self.__curvature[surface]
+        normals = np.empty_like(points) #The unit normal (cx, cy, cz - 1) points towards the n1 side, which is at -z near the vertex
+        normals[:, 0] = curvature * points[:, 0]
+        normals[:, 1] = curvature * points[:, 1]
+        normals[:, 2] = curvature * (points[:, 2] - self.__z0[surface]) - 1
+        cosine = np.einsum('ij,ij->i', directions, normals)
+        fromFront = cosine < 0 #Rays travelling against the normal come from the n1 side
+        normals[~fromFront] *= -1 #The normal is turned to face the incoming rays
+        return normals, fromFront
+    
+    def interact(self, surface, points, directions):
+        """Returns the new directions of rays which hit a surface, which are refracted, reflected (at a mirror or by total internal reflection) or unchanged at a detector"""
+        
+        kind = self.__kind[surface]
+        if kind == DETECT:
+            return directions, np.zeros(len(points), dtype='bool')
+        normals, fromFront = self.facingNormals(surface, points, directions)
+        reflected = np.einsum('ij,ij->i', directions, normals)[:, np.newaxis]
+        mirror = directions - 2 * reflected * normals
+        if kind == REFLECT:
+            return mirror, np.ones(len(points), dtype='bool')
+        ratio = np.where(fromFront, self.__n1[surface] / self.__n2[surface], self.__n2[surface] / self.__n1[surface])
+        refracted = np.empty_like(directions)
+        internal = np.zeros(len(points), dtype='bool')
+        for value in np.unique(ratio):
+            rays = ratio == value
+            refracted[rays], passed = op.snellRefraction(directions[rays], normals[rays], value)
+            internal[rays] = ~passed
+        refracted[internal] = mirror[internal] #Total internal reflection
+        return refracted, internal
+    
+    def split(self, surface, points, directions):
+        """Splits rays which hit a lens into transmitted and reflected rays. Returns the directions of both, and the Fresnel reflectance of each ray,
+        which is 1 at a mirror and for total internal reflection (where the transmitted directions are meaningless)."""
+        
+        normals, fromFront = self.facingNormals(surface, points, directions)
+        cosine = np.einsum('ij,ij->i', directions, normals)[:, np.newaxis]
+        reflected = directions - 2 * cosine * normals
+        if self.__kind[surface] == REFLECT:
+            return reflected, reflected, np.ones(len(points))
+        ratio = np.where(fromFront, self.__n1[surface] / self.__n2[surface], self.__n2[surface] / self.__n1[surface])
+        transmitted = reflected.copy()
+        for value in np.unique(ratio):
+            rays = ratio == value
+            refracted, passed = op.snellRefraction(directions[rays], normals[rays], value)
+            transmitted[rays] = np.where(passed[:, np.newaxis], refracted, reflected[rays])
+        return transmitted, reflected, fresnelReflectance(cosine[:, 0], ratio)
+    
+    def trace(self, points, directions, maxBounces=20):
+        """Traces (N,3) arrays of initial positions and directions (or a single direction) non-sequentially, for at most maxBounces surface hits per ray.
+        Returns a dictionary of:
+            points, directions  The (N,3) final positions and directions of the rays.
+            status              The (N,) final status of each ray: DETECTED, ESCAPED or CAPPED.
+            bounces             The (N,) number of surfaces each ray hit.
+            path                The (N, maxBounces + 1, 3) positions of each ray at its start and at every hit, NaN after its last hit.
+            surfaces            The (N, maxBounces) index of the element hit at each bounce, -1 after the last hit.
+            reflections         The (N,) number of reflections (at mirrors or by total internal reflection) of each ray.
+            tests               The number of ray-surface intersection tests made, against the N x S x bounces needed without the hierarchy."""
+        
+        batch = rt.RayBatch(points, directions, history='none') #The batch checks and normalises the rays
+        p = batch.p().copy()
+        k = batch.k().copy()
+        count = len(p)
+        path = np.full((count, maxBounces + 1, 3), np.nan)
+        path[:, 0] = p
+        surfaces = np.full((count, maxBounces), -1, dtype='int64')
+        status = np.full(count, CAPPED, dtype='int8')
+        bounces = np.zeros(count, dtype='int32')
+        reflections = np.zeros(count, dtype='int32')
+        tests = 0
+        bruteForce = 0
+        active = np.arange(count)
+        for bounce in range(maxBounces):
+            if len(active) == 0:
+                break
+            t, hit, made = self.nearest(p[active], k[active])
+            tests += made
+            bruteForce += len(active) * len(self.__kind)
+            escaped = hit < 0
+            status[active[escaped]] = ESCAPED
+            active, t, hit = active[~escaped], t[~escaped], hit[~escaped]
+            p[active] = p[active] + t[:, np.newaxis] * k[active]
+            path[active, bounce + 1] = p[active]
+            surfaces[active, bounce] = hit
+            bounces[active] += 1
+            for s in np.unique(hit):
+                rays = active[hit == s]
+                k[rays], reflected = self.interact(s, p[rays], k[rays])
+                reflections[rays] += reflected
+            detected = self.__kind[hit] == DETECT
+            status[active[detected]] = DETECTED
+            active = active[~detected]
+        return {'points': p, 'directions': k, 'status': status, 'bounces': bounces, 'path': path, 'surfaces': surfaces, 'reflections': reflections,
+                'tests': tests, 'bruteForceTests': bruteForce}
+    
+    def rayPath(self, result, index):
+        """Returns the (vertices, 3) positions of a single ray of a trace, from its start to its last hit"""
+        
+        return result['path'][index, :result['bounces'][index] + 1]
+    
+    def traceTree(self, points, directions, intensities=None, threshold=1e-6, maxGenerations=20, maxLive=100000):
+        """Traces the tree of rays formed by splitting every ray at every lens into Fresnel-weighted transmitted and reflected rays, from (N,3) arrays of initial
+        positions and directions with the given intensities (1 by default). Branches whose intensity falls below the threshold are pruned, rays are dropped
+        after maxGenerations bounces, and at most maxLive rays are traced in each pass. maxLive bounds the rays held per generation rather than in total,
+        so the peak is at most the N input rays plus 2*maxLive for each generation below maxGenerations.
+        Returns a dictionary of:
+            points, directions  The (D,3) positions and directions of the D rays which reached a detector.
+            intensities         The (D,) intensity each carried.
+            generations         The (D,) number of surfaces each hit on its way.
+            reflections         The (D,) number of reflections along its branch, so 0 for the direct image, 2 for a ghost from a double reflection.
+            ghosts              The (D,2) indices of the elements where the first two reflections took place, or -1.
+            energy              The total intensity which was detected, escaped, pruned or capped (left when the generations ran out), which add up to the input.
+            passes, traced      The number of vectorised passes, and the number of rays traced by all of them.
+            peakLive            The largest number of rays waiting in the queue or being traced at once."""
+        
+        batch = rt.RayBatch(points, directions, history='none')
+        count = len(batch.p())
+        intensities = np.ones(count) if intensities is None else np.broadcast_to(np.asarray(intensities, dtype='float'), (count,)).copy()
+        maxLive = max(int(maxLive), 1)
+        #The queue holds the rays waiting to be traced as batches of positions, directions, intensities, reflections and ghost surfaces for each generation
+        queue = [[] for generation in range(maxGenerations + 1)]
+        queue[0].append((batch.p().copy(), batch.k().copy(), intensities, np.zeros(count, dtype='int32'), np.full((count, 2), -1, dtype='int64')))
+        waiting = count
+        detected = []
+        energy = {'input': float(intensities.sum()), 'detected': 0.0, 'escaped': 0.0, 'pruned': 0.0, 'capped': 0.0}
+        passes, traced, peakLive = 0, 0, count
+        while waiting:
+            generation = max(g for g in range(maxGenerations + 1) if queue[g]) #The deepest generation first, so that the queue stays short
+            p, k, intensity, reflections, ghosts = queue[generation].pop()
+            if len(p) > maxLive:
+                queue[generation].append(tuple(value[maxLive:] for value in (p, k, intensity, reflections, ghosts)))
+                p, k, intensity, reflections, ghosts = [value[:maxLive] for value in (p, k, intensity, reflections, ghosts)]
+            waiting -= len(p)
+            if generation == maxGenerations:
+                energy['capped'] += intensity.sum()
+                continue
+            passes += 1
+            traced += len(p)
+            t, hit = self.nearest(p, k)[:2]
+            escaped = hit < 0
+            energy['escaped'] += intensity[escaped].sum()
+            keep = ~escaped
+            p, k, intensity, reflections, ghosts, t, hit = p[keep], k[keep], intensity[keep], reflections[keep], ghosts[keep], t[keep], hit[keep]
+            p = p + t[:, np.newaxis] * k
+            stopped = self.__kind[hit] == DETECT
+            if stopped.any():
+                detected.append((p[stopped], k[stopped], intensity[stopped], np.full(stopped.sum(), generation + 1, dtype='int32'), reflections[stopped], ghosts[stopped]))
+                energy['detected'] += intensity[stopped].sum()
+            children = []
+            for s in np.unique(hit[~stopped]):
+                rays = hit == s
+                transmitted, reflected, reflectance = self.split(s, p[rays], k[rays])
+                ghost = ghosts[rays].copy()
+                order = reflections[rays]
+                for column in (0, 1):
+                    ghost[order == column, column] = s #The first and second reflections of each branch are recorded
+                children.append((p[rays], transmitted, intensity[rays] * (1 - reflectance), order, ghosts[rays]))
+                children.append((p[rays], reflected, intensity[rays] * reflectance, order + 1, ghost))
+            for child in children:
+                strong = child[2] >= threshold
+                energy['pruned'] += child[2][~strong].sum()
+                if strong.any():
+                    queue[generation + 1].append(tuple(value[strong] for value in child))
+                    waiting += strong.sum()
+            peakLive = max(peakLive, waiting + len(p))
+        columns = list(zip(*detected)) if detected else [np.empty((0, 3)), np.empty((0, 3)), np.empty(0), np.empty(0, dtype='int32'), np.empty(0, dtype='int32'),
+                                                         np.empty((0, 2), dtype='int64')]
+        points, directions, intensities, generations, reflections, ghosts = [np.concatenate(column) if detected else column for column in columns]
+        return {'points': points, 'directions': directions, 'intensities': intensities, 'generations': generations, 'reflections': reflections,
+                'ghosts': ghosts, 'energy': dict((name, float(value)) for name, value in energy.items()), 'passes': passes, 'traced': traced, 'peakLive': peakLive}
+
+def ghostSummary(result):
+    """Returns the intensity reaching the detectors from the direct image and from each ghost of a traceTree result, as a dictionary keyed by the pair of
+    elements where the first two reflections took place ((-1, -1) for the direct image), in order of decreasing intensity"""
+    
+    totals = {}
+    for pair, intensity in zip(map(tuple, result['ghosts'].tolist()), result['intensities']):
+        totals[pair] = totals.get(pair, 0.0) + intensity
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
@@ -1,5 +1,200 @@
+from __future__ import print_function
 import numpy as np
+import raytracer as rt
+import glass as gl
 
+"""
+The vectorised kernels below act on (N,3) arrays of rays for a single surface. They are shared by the individual optical elements and by OpticalSystem, which
+calls them with constants that have been precomputed for every surface.
+"""
+
+def apertureSquare(aperture):
+    """Returns the squared aperture used by the intercept test. The tolerance reproduces rounding the intercept radius to 6 decimal places."""
+    
+    return (float(aperture) + 5e-7)**2
+    
+def sphereIntercepts(points, directions, z0, curvature, radius, apertureSquare):
+    """Calculates the intercepts of an (N,3) array of rays with a spherical surface of the given curvature and radius (1/curvature), which is planar if the curvature is zero.
+    Returns the intercepts along with a boolean array which is False for rays that miss the surface.
+    The offsets from the vertex are found at the precision of the points, and the rest of the calculation is done at the precision of the directions."""
+    
+    if np.any(points[:, 2] > z0):
+        #If the z component of a ray is greater than the intercept of the optical element on the optical axis, an exception is raised.
+        #This simulation only works with rays that start off to the left of the optical element (z < z0)
+        raise Exception('The z component of your ray position must be less than the intercept of the lens with the z-axis')
+    with np.errstate(invalid='ignore', divide='ignore'): #Terminated rays are NaN, so they never count as hitting the surface
+        x, y = points[:, 0].astype(directions.dtype), points[:, 1].astype(directions.dtype)
+        z = (points[:, 2] - z0).astype(directions.dtype) #The positions are taken relative to the vertex of the surface
+        kx, ky, kz = directions[:, 0], directions[:, 1], directions[:, 2]
+        #The sphere through the vertex is c(x^2 + y^2 + z^2) - 2z = 0. Unlike the offsets from the centre of the sphere, every term stays small for
+        #a weakly curved surface, and the root nearest the vertex is taken in whichever of its two forms avoids cancellation, which is finite for a plane.
+        b = curvature * (x * kx + y * ky + z * kz) - kz
+        constant = curvature * (x**2 + y**2 + z**2) - 2 * z
+        factor = b**2 - curvature * constant
+        hit = factor >= 0 #If the square root factor is less than zero, mathematically there is no intercept with the sphere
+        root = np.sqrt(np.where(hit, factor, 0.0))
+        length = np.where(b <= 0, constant / (root - b), (-b - root) / curvature)
+        intercepts = points + (length[:, np.newaxis] * directions)
+        hit &= directions[:, 2] > 0 #If the ray is travelling such that its z direction component is less than zero, it won't intersect with the lens
+        hit &= ((intercepts[:, 0])**2 + (intercepts[:, 1])**2) <= apertureSquare #There is no intersection if the intercept is greater than the aperture
+    return intercepts, hit
+    
+def sphereNormals(intercepts, curvature, centre):
+    """Calculates the unit vectors normal to a spherical surface at an (N,3) array of intercepts, where centre is the z position of the centre of the sphere"""
+    
+    if curvature != 0:
+        #Multiplying by the curvature both normalises the normal and points it back towards the incoming rays, for either sign of curvature
+        normals = intercepts * curvature
+        normals[:, 2] = (intercepts[:, 2] - centre) * curvature
+        return normals
+    else:
+        return np.broadcast_to(np.array([0, 0, -1], dtype=intercepts.dtype), intercepts.shape)
+        
+def snellRefraction(incident, normals, relativeIndex):
+    """Calculates the refracted unit directions of an (N,3) array of rays, where relativeIndex is n1/n2.
+    Returns the directions along with a boolean array which is False for rays that undergo total internal reflection."""
+    
+    with np.errstate(invalid='ignore'):
+        cosine = -np.einsum('ij,ij->i', incident, normals) #Cosine of the incident angle
+        trigFactor = ((relativeIndex)**2) * (1 - (cosine)**2)
+        refracted = trigFactor <= 1 #If the sine of the incident angle is greater than n2/n1 there is total internal reflection
+        refractedDirections = (relativeIndex * incident) + (((relativeIndex * cosine) - np.sqrt(np.where(refracted, 1 - trigFactor, 0.0)))[:, np.newaxis] * normals) #Calculating the refracted direction vectors
+        unitRefractedDirections = refractedDirections / np.sqrt(np.einsum('ij,ij->i', refractedDirections, refractedDirections))[:, np.newaxis] #The new direction vectors are normalised
+    return unitRefractedDirections, refracted
+    
+def planeIntercepts(points, directions, z):
+    """Calculates the intercepts of an (N,3) array of rays with the plane at z, ignoring any aperture"""
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        length = (z - points[:, 2]) / directions[:, 2]
+        return points + (length[:, np.newaxis] * directions)
+        
+def asphereSag(s, curvature, conic, coefficients):
+    """Calculates the sag of a conic surface with polynomial aspheric terms, and the derivative of the sag with respect to r^2, at an array of squared radii s = r^2.
+    The coefficients are those of r^4, r^6, r^8 and so on. The sag is NaN beyond the edge of the conic, where it has no real value."""
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        root = np.sqrt(1 - (1 + conic) * curvature**2 * s)
+        sag = curvature * s / (1 + root) #This form of the conic sag stays finite as the curvature tends to zero
+        slope = curvature / (2 * root)
+    power = s
+    for i, coefficient in enumerate(coefficients):
+        sag = sag + coefficient * power * s #The term in r^(2i + 4)
+        slope = slope + (i + 2) * coefficient * power
+        power = power * s
+    return sag, slope
+
+def asphereIntercepts(points, directions, z0, curvature, conic, coefficients, apertureSquare, tolerance=1e-10, maxIterations=20):
+    """Calculates the intercepts of an (N,3) array of rays with an aspheric surface by Newton-Raphson iteration on the distance along each ray.
+    The first guess is the exact intercept with the conic of the surface (the vertex sphere when the conic constant is 0), and only the rays that have not yet
+    converged, to within the tolerance on the sag, are iterated, for at most maxIterations steps.
+    Returns the intercepts, a boolean array which is False for rays that miss the surface, a boolean array which is False for rays that did not converge,
+    and the number of iterations taken by each ray."""
+    
+    if np.any(points[:, 2] > z0):
+        raise Exception('The z component of your ray position must be less than the intercept of the lens with the z-axis')
+    x, y, z = points[:, 0], points[:, 1], points[:, 2] - z0 #The positions are taken relative to the vertex of the surface
+    kx, ky, kz = directions[:, 0], directions[:, 1], directions[:, 2]
+    rounding = 8 * np.finfo(np.result_type(points, directions)).eps #At float32 the height above the surface cannot be found to better than a few parts in 10^7
+    with np.errstate(invalid='ignore', divide='ignore'):
+        #The conic c(x^2 + y^2) + c(1 + k)z^2 - 2z = 0 is solved in the form which gives the intercept nearest the vertex and stays finite for a plane
+        a = curvature * (kx**2 + ky**2 + (1 + conic) * kz**2)
+        b = curvature * (x * kx + y * ky + (1 + conic) * z * kz) - kz
+        constant = curvature * (x**2 + y**2 + (1 + conic) * z**2) - 2 * z
+        factor = b**2 - a * constant
+        length = np.where(factor >= 0, constant / (-b + np.sqrt(np.where(factor >= 0, factor, 0.0))), -z / kz) #Rays which miss the conic start from the vertex plane
+    
+    converged = np.zeros(len(points), dtype='bool')
+    iterations = np.zeros(len(points), dtype='int32')
+    active = np.flatnonzero(np.isfinite(length)) #Terminated rays are NaN, so they are never iterated
+    for iteration in range(maxIterations + 1):
+        if len(active) == 0:
+            break
+        t = length[active]
+        X = x[active] + t * kx[active]
+        Y = y[active] + t * ky[active]
+        sag, slope = asphereSag(X**2 + Y**2, curvature, conic, coefficients)
+        error = z[active] + t * kz[active] - sag #The height of the ray above the surface
+        with np.errstate(invalid='ignore'):
+            done = np.abs(error) <= np.maximum(tolerance, rounding * (1 + np.abs(z[active]) + np.abs(t * kz[active]) + np.abs(sag))) #The size of the terms sets the rounding error
+        converged[active[done]] = True
+        if iteration == maxIterations:
+            break
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = error / (kz[active] - 2 * slope * (X * kx[active] + Y * ky[active])) #The derivative of the height along the ray
+        moving = ~done & np.isfinite(step) #Rays which leave the edge of the surface give a NaN step, and are dropped
+        active = active[moving]
+        length[active] -= step[moving]
+        iterations[active] += 1
+    
+    intercepts = points + (length[:, np.newaxis] * directions)
+    with np.errstate(invalid='ignore'):
+        hit = converged & (kz > 0) & (((intercepts[:, 0])**2 + (intercepts[:, 1])**2) <= apertureSquare)
+    return intercepts, hit, converged, iterations
+
+def asphereNormals(intercepts, curvature, conic, coefficients):
+    """Calculates the unit vectors normal to an aspheric surface at an (N,3) array of intercepts, from the analytic derivative of its sag, pointing back towards the incoming rays"""
+    
+    x, y = intercepts[:, 0], intercepts[:, 1]
+    slope = asphereSag(x**2 + y**2, curvature, conic, coefficients)[1]
+    normals = np.empty_like(intercepts)
+    normals[:, 0] = 2 * x * slope
+    normals[:, 1] = 2 * y * slope
+    normals[:, 2] = -1.0
+    with np.errstate(invalid='ignore'):
+        return normals / np.sqrt(np.einsum('ij,ij->i', normals, normals))[:, np.newaxis]
+
+def traceStack(points, directions, z0, curvature, aperture, relativeIndex, output=None, returnDirections=False, decentre=None):
+    """Traces rays through a stack of M optical systems of S spherical surfaces at once, where z0, curvature, aperture and relativeIndex (n1/n2) are (M,S) arrays.
+    The rays are given as (N,3) arrays, which are shared by every system, or as (M,N,3) arrays. If output is given (a scalar or an (M,) array), the rays are finally propagated to the output plane.
+    Returns the (M,N,3) end points, which are NaN for terminated rays, along with the (M,N) array of rays that are still alive.
+    If returnDirections is True, the (M,N,3) final directions are returned between the two.
+    The surfaces can be decentred by an (M,S,2) array of x and y offsets of their axes (and apertures) from the optical axis."""
+    
+    z0, curvature, aperture, relativeIndex = np.broadcast_arrays(*[np.atleast_2d(np.asarray(constant, dtype='float')) for constant in (z0, curvature, aperture, relativeIndex)])
+    systems = z0.shape[0]
+    points = np.asarray(points, dtype='float')
+    directions = np.asarray(directions, dtype='float')
+    shape = (systems,) + points.shape[-2:]
+    p = np.array(np.broadcast_to(points, shape))
+    k = np.array(np.broadcast_to(directions, shape))
+    alive = ~np.isnan(p[:, :, 0])
+    offset = np.zeros((systems, z0.shape[1], 2)) if decentre is None else np.broadcast_to(np.asarray(decentre, dtype='float'), (systems, z0.shape[1], 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for s in range(z0.shape[1]):
+            c = curvature[:, s, np.newaxis]
+            dx, dy = offset[:, s, 0, np.newaxis], offset[:, s, 1, np.newaxis]
+            x, y, z = p[:, :, 0] - dx, p[:, :, 1] - dy, p[:, :, 2] - z0[:, s, np.newaxis] #The positions are taken relative to the vertex of the surface
+            #The sphere through the vertex is c(x^2 + y^2 + z^2) - 2z = 0, which is solved in a form that stays finite as the curvature tends to zero (a plane)
+            b = c * (x * k[:, :, 0] + y * k[:, :, 1] + z * k[:, :, 2]) - k[:, :, 2]
+            constant = c * (x**2 + y**2 + z**2) - 2 * z
+            factor = b**2 - c * constant
+            hit = (factor >= 0) & (k[:, :, 2] > 0)
+            length = constant / (-b + np.sqrt(np.where(hit, factor, 0.0))) #The intercept nearest the vertex, for either sign of curvature
+            p = p + length[:, :, np.newaxis] * k
+            hit &= ((p[:, :, 0] - dx)**2 + (p[:, :, 1] - dy)**2) <= (aperture[:, s, np.newaxis] + 5e-7)**2
+            
+            #The unit normal (cx, cy, cz - 1) points back towards the incoming rays
+            normals = np.empty_like(p)
+            normals[:, :, 0] = c * (p[:, :, 0] - dx)
+            normals[:, :, 1] = c * (p[:, :, 1] - dy)
+            normals[:, :, 2] = c * (p[:, :, 2] - z0[:, s, np.newaxis]) - 1
+            ratio = relativeIndex[:, s, np.newaxis]
+            cosine = -np.einsum('mni,mni->mn', k, normals)
+            trigFactor = ratio**2 * (1 - cosine**2)
+            refracted = trigFactor <= 1
+            k = ratio[:, :, np.newaxis] * k + ((ratio * cosine) - np.sqrt(np.where(refracted, 1 - trigFactor, 0.0)))[:, :, np.newaxis] * normals
+            k = k / np.sqrt(np.einsum('mni,mni->mn', k, k))[:, :, np.newaxis]
+            alive &= hit & refracted
+        if output is not None:
+            output = np.broadcast_to(np.asarray(output, dtype='float'), (systems,))[:, np.newaxis]
+            p = p + ((output - p[:, :, 2]) / k[:, :, 2])[:, :, np.newaxis] * k
+    p[~alive] = np.nan
+    if returnDirections:
+        k[~alive] = np.nan
+        return p, k, alive
+    return p, alive
+    
 class OpticalElement:
     """A class which allows optical elements/lens objects to be created"""
     
@@ -8,9 +203,17 @@ class OpticalElement:
         
         raise NotImplementedError()
         
+    def propagateBatch(self, batch):
+        """Propagate every ray in a ray batch through the optical element in a single vectorised pass"""
+        
+        raise NotImplementedError()
+        
     def propagateBundle(self, bundle):
         """Propagates each ray in a bundle through the optical element"""
         
+        if isinstance(bundle, rt.RayBatch):
+            self.propagateBatch(bundle) #A batch of rays is propagated all at once
+            return
         for ray in bundle:
             self.propagateRay(ray)
             
@@ -21,11 +224,18 @@ class SphericalRefraction(OpticalElement):
         self.__z0 = float(z0)
         self.__curvature = float(curvature)
         self.__aperture = float(aperture)
-        self.__n1 = float(n1)
-        self.__n2 = float(n2)
+        #The refractive indices may be numbers or dispersive glass.Glass models, whose indices at the reference wavelength are used unless another wavelength is given
+        self.__glass1 = gl.material(n1)
+        self.__glass2 = gl.material(n2)
+        self.__n1 = float(self.__glass1.index())
+        self.__n2 = float(self.__glass2.index())
         if curvature != 0:
             self.__radius = 1/float(curvature)
             self.__centre = np.array([0, 0, self.__z0 + self.__radius], dtype ='float')
+        else:
+            self.__radius = np.inf #A planar surface is a sphere with an infinite radius
+            self.__centre = np.array([0, 0, np.inf], dtype ='float')
+        self.__apertureSquare = apertureSquare(self.__aperture) #The aperture test compares squared radii, so no square root is needed per ray
         
     def __repr__(self):
         """Returns a representation of the lens object along with its parameters"""
@@ -40,97 +250,54 @@ class SphericalRefraction(OpticalElement):
     def getIntercept(self, ray):
         """Calculates the intercept of a ray with the optical element"""
         
-        rayPosition = ray.p()
-        rayDirection = ray.k()
-        if rayPosition[2] > self.__z0:
-            #If the z component of the ray is greater than the intercept of the optical element on the optical axis, an exception is raised.
-            #This simulation only works with rays that start off to the left of the optical element (z < z0)
-            raise Exception('The z component of your ray position must be less than the intercept of the lens with the z-axis')
-        if rayDirection[2] <= 0:
-            return None #If the ray is travelling such that its z direction component is less than zero, it won't intersect with the lens
-        if self.__curvature != 0:
-            r = rayPosition - self.__centre
-            factor = (np.dot(r, rayDirection))**2 - (np.dot(r, r) - (self.__radius)**2)
-            if factor < 0:
-                return None #If the square root factor is less than zero, mathematically there is no intercept with the sphere
-            else:
-                length1 = -(np.dot(r, rayDirection)) - np.sqrt(factor)
-                length2 = -(np.dot(r, rayDirection)) + np.sqrt(factor)
-                intercept1 = rayPosition + (float(length1) * rayDirection) #Calculating both possible intercepts of the ray with the sphere
-                intercept2 = rayPosition + (float(length2) * rayDirection)
-                intercept1Radius = np.round(np.sqrt((intercept1[0])**2 + (intercept1[1])**2), 6) #Also calculating the radial distance of the intercept from the optical axis
-                intercept2Radius = np.round(np.sqrt((intercept2[0])**2 + (intercept2[1])**2), 6)
-            if self.__curvature > 0:
-                intercept = intercept1 #This corresponds to z0 < centre of sphere. The first intercept is therefore required.
-                interceptRadius = intercept1Radius
-                if interceptRadius <= self.__aperture: #Checking to see that the intercept is less than the lens aperture
-                    return intercept
-                else:
-                    return None #There is no intersection if the intercept is greater than the aperture
-            elif self.__curvature < 0:
-                intercept = intercept2 #This corresponds to z0 > centre of sphere. The second intercept is required here.
-                interceptRadius = intercept2Radius
-                if interceptRadius <= self.__aperture:
-                    return intercept
-                else:
-                    return None               
-        elif self.__curvature == 0: #If the curvature is zero, the lens is a planar surface
-            planePosition = self.__z0
-            distance = planePosition - rayPosition[2]
-            length = float(distance) / rayDirection[2]
-            intercept = rayPosition + (length * rayDirection) #Calculating the position of the intercept
-            interceptRadius = np.sqrt((intercept[0])**2 + (intercept[1])**2)
-            if np.round(interceptRadius, 6) <= (self.__aperture)**2: #Checking if intercept is less than the aperture
-                return intercept
-            else:
-                return None
-                    
+        intercepts, hit = self.interceptBatch(ray.p()[np.newaxis], ray.k()[np.newaxis])
+        if hit[0]:
+            return intercepts[0]
+        else:
+            return None
+            
+    def interceptBatch(self, points, directions):
+        """Calculates the intercepts of an (N,3) array of rays with the optical element.
+        Returns the intercepts along with a boolean array which is False for rays that miss the lens."""
+        
+        return sphereIntercepts(points, directions, self.__z0, self.__curvature, self.__radius, self.__apertureSquare)
+        
+    def normalBatch(self, intercepts):
+        """Calculates the unit vectors normal to the surface at an (N,3) array of intercepts"""
+        
+        return sphereNormals(intercepts, self.__curvature, self.__centre[2])
+            
     def refractRay(self, incident, normal, n1, n2):
         """Calculates the refracted direction of a ray which intercepts with the optical element"""
         
-        cosine = -(np.dot(incident, normal)) #Cosine of the incident angle
-        incidentAngle = np.arccos(cosine)
-        sine = np.sin(incidentAngle) #Sine of incident angle
-        relativeIndex = n1/n2
-        
-        if sine > (1/relativeIndex): #This means that there is total internal reflection
-            return None
+        refractedDirections, refracted = self.refractBatch(np.array(incident, dtype='float', ndmin=2), np.array(normal, dtype='float', ndmin=2), n1, n2)
+        if refracted[0]:
+            return refractedDirections[0]
         else:
-            trigFactor = ((relativeIndex)**2) * (1 - (cosine)**2)
-            refractedDirection = (relativeIndex * incident) + (((relativeIndex * cosine) - np.sqrt(1 - trigFactor)) * normal) #Calculating the refracted direction vector
-            unitRefractedDirection = refractedDirection / np.linalg.norm(refractedDirection) #The new direction vector is normalised
-            return unitRefractedDirection
-           
+            return None
+            
+    def refractBatch(self, incident, normals, n1, n2):
+        """Calculates the refracted directions of an (N,3) array of rays which intercept with the optical element.
+        Returns the directions along with a boolean array which is False for rays that undergo total internal reflection."""
+        
+        return snellRefraction(incident, normals, n1/n2)
+        
     def propagateRay(self, ray):
         """Propagates a ray through the optical element by calculating the intercept then refracting it."""
         
-        intercept = self.getIntercept(ray)
-        rayDirection = ray.k()
-        
-        if intercept is None:
-            #If there is no intercept, the ray is terminated by making all components 'None'
-            rayDirection = [None, None, None]
-            rayPosition = [None, None, None]
-            ray.append(rayPosition, rayDirection)
-            return
-            
-        if self.__curvature > 0:
-            normal = intercept - self.__centre #Calculating the vector normal to the surface is dependent on the curvature
-        elif self.__curvature < 0:
-            normal = self.__centre - intercept
-        elif self.__curvature == 0:
-            normal = np.array([0, 0, -1], dtype ='float')
-            
-        unitNormal = normal / np.linalg.norm(normal) #The normal to the surface must be a unit vector
-        refractedDirection = self.refractRay(rayDirection, unitNormal, self.__n1, self.__n2) #Calculating the refracted direction
-        if refractedDirection is None:
-            #If there is no refracted direction i.e. TIR, the ray is terminated by making all components 'None'
-            rayDirection = [None, None, None]
-            rayPosition = [None, None, None]
-            ray.append(rayPosition, rayDirection)
-        else:
-            ray.append(intercept, refractedDirection) #Appending the intercept and refracted direction to the ray object that is being propagated through the lens
+        batch = ray.batch()
+        self.propagateBatch(batch)
+        if batch.alive()[0]:
             return ray
+            
+    def propagateBatch(self, batch):
+        """Propagates a batch of rays through the optical element by calculating the intercepts then refracting them, all in one vectorised pass.
+        Rays which miss the lens or undergo total internal reflection are terminated."""
+        
+        intercepts, hit = self.interceptBatch(batch.p(), batch.k())
+        unitNormals = self.normalBatch(intercepts) #The normals to the surface are unit vectors
+        refractedDirections, refracted = self.refractBatch(batch.k(), unitNormals, self.__n1, self.__n2) #Calculating the refracted directions
+        batch.append(intercepts, refractedDirections, hit & refracted, np.where(hit, rt.REFLECTED, rt.MISSED)) #Appending the intercepts and refracted directions to the batch that is being propagated through the lens
     
     def paraxial(self, ray):
         """Calculates the position of the paraxial focus for a given lens"""
@@ -143,7 +310,7 @@ class SphericalRefraction(OpticalElement):
             distance = rayPosition[0]
             length = float(distance) / rayDirection[0]
             paraxialFocus = rayPosition - (length * rayDirection) #The paraxial focus is where the paraxial ray x and y positions are at/close to zero
-            print 'Paraxial Focus: ', paraxialFocus
+            print('Paraxial Focus: ', paraxialFocus)
             output = OutputPlane(paraxialFocus[2]) #Setting the output plane at the paraxial focus
             return output
         
@@ -151,7 +318,105 @@ class SphericalRefraction(OpticalElement):
         """Returns the intercept of the lens with the z axis"""
         
         return self.__z0
+        
+    def getCurvature(self):
+        """Returns the curvature of the lens"""
+        
+        return self.__curvature
+        
+    def getAperture(self):
+        """Returns the aperture (maximum radius) of the lens"""
+        
+        return self.__aperture
+        
+    def getIndices(self, wavelength=None):
+        """Returns the refractive indices on either side of the lens, n1 then n2, at the reference wavelength or at the given wavelength(s)"""
+        
+        if wavelength is None:
+            return self.__n1, self.__n2
+        return self.__glass1.index(wavelength), self.__glass2.index(wavelength)
+        
+    def getGlasses(self):
+        """Returns the materials on either side of the lens as glass.Glass objects"""
+        
+        return self.__glass1, self.__glass2
              
+class AsphericRefraction(SphericalRefraction):
+    """A subclass of SphericalRefraction which allows conic and even aspheric refracting surfaces to be created.
+    The sag is cr^2/(1 + sqrt(1 - (1 + k)c^2r^2)) plus the polynomial terms, where k is the conic constant and the coefficients are those of r^4, r^6, r^8 and so on.
+    The intercepts are found by Newton-Raphson iteration, whose iteration counts are recorded for every call."""
+    
+    def __init__(self, z0, aperture, curvature, n1, n2, conic=0.0, coefficients=(), tolerance=1e-10, maxIterations=20):
+        SphericalRefraction.__init__(self, z0, aperture, curvature, n1, n2)
+        self.__conic = float(conic)
+        self.__coefficients = [float(coefficient) for coefficient in coefficients]
+        self.__tolerance = float(tolerance) #The largest error in the sag at which an intercept has converged
+        self.__maxIterations = int(maxIterations)
+        self.__apertureSquare = apertureSquare(aperture)
+        self.resetStatistics()
+    
+    def __repr__(self):
+        """Returns a representation of the lens object along with its parameters"""
+        
+        n1, n2 = self.getIndices()
+        return "%s(Intercept = %g, Curvature = %g, Conic = %g, Coefficients = %s, Aperture = %g, Refractive Indices = %g, %g )" % ("Aspheric Lens", self.getz0(), self.getCurvature(),
+                self.__conic, self.__coefficients, self.getAperture(), n1, n2)
+    
+    def interceptBatch(self, points, directions):
+        """Calculates the intercepts of an (N,3) array of rays with the aspheric surface.
+        Returns the intercepts along with a boolean array which is False for rays that miss the lens or whose intercept did not converge."""
+        
+        intercepts, hit, converged, iterations = asphereIntercepts(points, directions, self.getz0(), self.getCurvature(), self.__conic, self.__coefficients,
+                                                                   self.__apertureSquare, self.__tolerance, self.__maxIterations)
+        self.record(converged, iterations, np.isfinite(points[:, 0]))
+        return intercepts, hit
+    
+    def normalBatch(self, intercepts):
+        """Calculates the unit vectors normal to the surface at an (N,3) array of intercepts"""
+        
+        return asphereNormals(intercepts, self.getCurvature(), self.__conic, self.__coefficients)
+    
+    def record(self, converged, iterations, traced):
+        """Adds the iteration counts of the rays traced in one call to the statistics"""
+        
+        statistics = self.__statistics
+        statistics['calls'] += 1
+        statistics['rays'] += int(traced.sum())
+        statistics['iterations'] += int(iterations.sum())
+        statistics['unconverged'] += int((traced & ~converged).sum())
+        statistics['histogram'] += np.bincount(iterations[traced], minlength=self.__maxIterations + 1)[:self.__maxIterations + 1]
+    
+    def getStatistics(self):
+        """Returns a dictionary of the intercept calls and rays traced, the total and mean number of iterations per ray, the most iterations taken by any ray,
+        the number of rays whose intercept did not converge, and a histogram of the number of rays which took each number of iterations"""
+        
+        statistics = dict(self.__statistics)
+        histogram = statistics['histogram'].copy()
+        statistics['histogram'] = histogram
+        statistics['meanIterations'] = statistics['iterations'] / float(max(statistics['rays'], 1))
+        statistics['mostIterations'] = int(np.flatnonzero(histogram).max()) if histogram.any() else 0
+        return statistics
+    
+    def resetStatistics(self):
+        """Clears the iteration statistics"""
+        
+        self.__statistics = {'calls': 0, 'rays': 0, 'iterations': 0, 'unconverged': 0, 'histogram': np.zeros(self.__maxIterations + 1, dtype='int64')}
+    
+    def getConic(self):
+        """Returns the conic constant of the surface"""
+        
+        return self.__conic
+    
+    def getCoefficients(self):
+        """Returns the coefficients of the r^4, r^6, r^8... terms of the sag"""
+        
+        return list(self.__coefficients)
+    
+    def getTolerance(self):
+        """Returns the tolerance on the sag, and the most iterations, of the intercept iteration"""
+        
+        return self.__tolerance, self.__maxIterations
+
 class OutputPlane(OpticalElement):
     """A subclass which creates an output plane to view the rays which have been propagated through the optical elements."""
     
@@ -162,14 +427,15 @@ class OutputPlane(OpticalElement):
         """Calculates the intercept of the ray with the output plane"""
         
         rayPosition = ray.p()
-        rayDirection = ray.k()
         if np.isnan(rayPosition[0]):
             return None
         else:
-            distance = self.__plane - rayPosition[2]
-            length = float(distance) / rayDirection[2]
-            planeIntercept = rayPosition + (length * rayDirection)
-            return planeIntercept
+            return self.planeInterceptBatch(rayPosition[np.newaxis], ray.k()[np.newaxis])[0]
+            
+    def planeInterceptBatch(self, points, directions):
+        """Calculates the intercepts of an (N,3) array of rays with the output plane"""
+        
+        return planeIntercepts(points, directions, self.__plane)
         
     def propagateRay(self, ray):
         """Propagates the ray to the output plane"""
@@ -181,7 +447,195 @@ class OutputPlane(OpticalElement):
             rayDirection = ray.k()
             ray.append(planeIntercept, rayDirection)
             
+    def propagateBatch(self, batch):
+        """Propagates a batch of rays to the output plane. Terminated rays remain terminated."""
+        
+        batch.append(self.planeInterceptBatch(batch.p(), batch.k()), batch.k(), batch.alive())
+            
     def getz(self):
         """Returns the position of the output plane along the z axis"""
         
-        return self.__plane
\ No newline at end of file
+        return self.__plane
+        
+class OpticalSystem(OpticalElement):
+    """A subclass of OpticalElement which compiles a sequence of lenses, optionally followed by an output plane, into a single optical system.
+    The constants of every surface are precomputed once as arrays, so that a ray batch can be traced through the whole system in one call."""
+    
+    def __init__(self, elements):
+        self.__elements = list(elements)
+        lenses = self.__elements
+        self.__output = None
+        if len(lenses) > 0 and isinstance(lenses[-1], OutputPlane):
+            lenses = lenses[:-1]
+            self.__output = self.__elements[-1].getz() #The output plane may only be the final element of the system
+        for lens in lenses:
+            if not(isinstance(lens, SphericalRefraction)):
+                raise Exception('An optical system must be made of spherical lenses, optionally followed by a single output plane')
+        self.__lenses = lenses
+        self.__aspheres = [lens if isinstance(lens, AsphericRefraction) else None for lens in lenses] #Aspheric lenses find their own intercepts and normals
+                
+        self.__z0 = np.array([lens.getz0() for lens in lenses], dtype='float')
+        self.__curvature = np.array([lens.getCurvature() for lens in lenses], dtype='float')
+        self.__aperture = np.array([lens.getAperture() for lens in lenses], dtype='float')
+        indices = np.array([lens.getIndices() for lens in lenses], dtype='float').reshape(-1, 2)
+        self.__n1 = indices[:, 0]
+        self.__n2 = indices[:, 1]
+        
+        #The ordering of the lenses along the z axis is only checked once, when the system is compiled
+        if np.any(np.diff(self.__z0) < 0):
+            raise Exception('The lenses in an optical system must be ordered along the z axis')
+        if self.__output is not None and len(self.__z0) > 0 and self.__output < self.__z0[-1]:
+            raise Exception('The output plane must be placed after the final lens of the optical system')
+            
+        #The constants needed by the intercept, aperture and refraction calculations for each surface
+        with np.errstate(divide='ignore'):
+            self.__radius = np.where(self.__curvature != 0, 1/np.where(self.__curvature != 0, self.__curvature, 1.0), np.inf) #A planar surface has an infinite radius
+        self.__centre = self.__z0 + self.__radius #The z positions of the centres of the spheres
+        self.__apertureSquare = (self.__aperture + 5e-7)**2
+        self.__relativeIndex = self.__n1 / self.__n2
+        self.__surfaces = list(zip(self.__z0.tolist(), self.__curvature.tolist(), self.__radius.tolist(), self.__centre.tolist(), self.__apertureSquare.tolist(), self.__relativeIndex.tolist()))
+        
+    def __repr__(self):
+        """Returns a representation of the optical system along with its elements"""
+        
+        return "%s(%s)" % ("OpticalSystem", ", ".join([repr(element) for element in self.__elements]))
+        
+    def __len__(self):
+        return len(self.__elements)
+        
+    def getElements(self):
+        """Returns the list of optical elements which make up the system"""
+        
+        return list(self.__elements)
+        
+    def getOutput(self):
+        """Returns the position of the output plane along the z axis, or None if the system does not have one"""
+        
+        return self.__output
+    
+    def isSpherical(self):
+        """Returns True if every lens of the system is spherical, so that it can be traced by traceStack from its constants alone"""
+        
+        return all(asphere is None for asphere in self.__aspheres)
+    
+    def getConstants(self):
+        """Returns a dictionary of the arrays of surface constants (z0, curvature, aperture, n1, n2 and the relative index n1/n2) of the system"""
+        
+        return {'z0': self.__z0.copy(), 'curvature': self.__curvature.copy(), 'aperture': self.__aperture.copy(), 'n1': self.__n1.copy(), 'n2': self.__n2.copy(),
+                'relativeIndex': self.__relativeIndex.copy()}
+        
+    def dispersedIndices(self, wavelengths):
+        """Returns (W,S) arrays of the indices n1 and n2 of every surface at each of the W wavelengths, which are evaluated once per wavelength by the glass models"""
+        
+        wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype='float'))
+        n1, n2 = np.ones((len(wavelengths), len(self.__lenses))), np.ones((len(wavelengths), len(self.__lenses)))
+        for s, lens in enumerate(self.__lenses):
+            n1[:, s], n2[:, s] = lens.getIndices(wavelengths)
+        return n1, n2
+        
+    def relativeIndices(self, wavelengths):
+        """Returns a (W,S) array of the relative indices n1/n2 of every surface at each of the W wavelengths"""
+        
+        n1, n2 = self.dispersedIndices(wavelengths)
+        return n1 / n2
+        
+    def traceWavelengths(self, points, directions, wavelengths, output=None):
+        """Traces (N,3) arrays of rays through the system at every one of W wavelengths in a single stacked pass, onto the output plane of the system or the given output z.
+        Returns the (W,N,3) end points, the (W,N,3) final directions and the (W,N) array of rays that are still alive."""
+        
+        if not(self.isSpherical()):
+            raise Exception('Only systems of spherical lenses can be traced at several wavelengths at once')
+        if output is None:
+            output = self.__output
+        points = np.array(points, dtype='float', ndmin=2)
+        directions = np.array(directions, dtype='float', ndmin=2)
+        directions = directions / np.sqrt(np.einsum('ij,ij->i', directions, directions))[:, np.newaxis]
+        ratios = self.relativeIndices(wavelengths)
+        return traceStack(points, directions, self.__z0, self.__curvature, self.__aperture, ratios, output, returnDirections=True)
+        
+    def propagateRay(self, ray):
+        """Propagates a ray through every element of the optical system"""
+        
+        batch = ray.batch()
+        self.propagateBatch(batch)
+        if batch.alive()[0]:
+            return ray
+            
+    def propagateBatch(self, batch):
+        """Propagates a batch of rays through every lens of the system and then onto the output plane, if there is one"""
+        
+        batch.reserve(len(self.__elements)) #The history of the batch is allocated once for every surface of the system
+        self.traceSurfaces(batch)
+        if self.__output is not None:
+            batch.append(planeIntercepts(batch.p(), batch.k(), self.__output), batch.k(), batch.alive())
+            
+    def trace(self, points, directions, history='none', dtype='float', precision='float64'):
+        """Creates a batch of rays from (N,3) arrays of positions and directions (or a single direction), with the chosen history, and propagates it through the system.
+        With the 'none' history only the initial and final states of the rays are kept. The precision is the working precision of the trace (see raytracer.PRECISIONS)."""
+        
+        batch = rt.RayBatch(points, directions, history, dtype, len(self.__elements) + 1, precision)
+        self.propagateBatch(batch)
+        return batch
+        
+    def comparePrecision(self, points, directions, precision='float32', tolerance=1e-4):
+        """Traces the same rays at float64 and at a lower precision, and reports how far apart the results are: the largest and RMS distances between the end points
+        of rays which survive both traces, the number of rays which only survive one of them, the RMS spot radius of each and the time each took.
+        The lower precision is acceptable ('withinTolerance') if no ray changes its fate and no end point or RMS spot radius moves by more than the tolerance."""
+        
+        import time
+        import spots
+        results = {}
+        for name in ('float64', precision):
+            began = time.time()
+            batch = self.trace(points, directions, precision=name)
+            results[name] = (batch, time.time() - began)
+        reference, referenceTime = results['float64']
+        other, otherTime = results[precision]
+        both = reference.alive() & other.alive()
+        offset = reference.p()[both] - other.p()[both].astype('float64')
+        distance = np.sqrt(np.einsum('ij,ij->i', offset, offset))
+        rms = spots.spotStatistics(reference.p(), reference.alive())['rms']
+        otherRMS = spots.spotStatistics(other.p(), other.alive())['rms']
+        report = {'precision': precision, 'rays': len(both), 'compared': int(both.sum()), 'changedFate': int(np.count_nonzero(reference.alive() != other.alive())),
+                  'maxDeviation': float(distance.max()) if len(distance) > 0 else 0.0, 'rmsDeviation': float(np.sqrt(np.mean(distance**2))) if len(distance) > 0 else 0.0,
+                  'rms': rms, 'precisionRMS': otherRMS, 'rmsDifference': abs(otherRMS - rms), 'seconds': referenceTime, 'precisionSeconds': otherTime,
+                  'speedup': referenceTime / otherTime if otherTime > 0 else np.inf}
+        report['withinTolerance'] = bool(report['changedFate'] == 0 and report['maxDeviation'] <= tolerance and not(report['rmsDifference'] > tolerance))
+        return report
+        
+    def traceSurfaces(self, batch):
+        """Propagates a batch of rays through every lens of the system using the precomputed surface constants"""
+        
+        for surface in range(len(self.__surfaces)):
+            batch.append(*self.traceSurface(surface, batch.p(), batch.k()))
+        return batch
+        
+    def traceSurface(self, surface, points, directions):
+        """Traces (N,3) arrays of rays through a single lens of the system, given by its index.
+        Returns the intercepts, the refracted directions, a boolean array which is False for rays that miss the lens or are totally internally reflected, and their status codes."""
+        
+        z0, curvature, radius, centre, apertureSquare, relativeIndex = self.__surfaces[surface]
+        asphere = self.__aspheres[surface]
+        if asphere is not None:
+            intercepts, hit = asphere.interceptBatch(points, directions)
+            unitNormals = asphere.normalBatch(intercepts)
+        else:
+            intercepts, hit = sphereIntercepts(points, directions, z0, curvature, radius, apertureSquare)
+            unitNormals = sphereNormals(intercepts, curvature, centre)
+        refractedDirections, refracted = snellRefraction(directions, unitNormals, relativeIndex)
+        return intercepts, refractedDirections, hit & refracted, np.where(hit, rt.REFLECTED, rt.MISSED)
+        
+    def paraxialFocus(self):
+        """Returns the z position of the paraxial focus of the system, from its ray transfer matrices (see paraxial.paraxialFocus), or None if it has no real focus"""
+        
+        import paraxial as px #The paraxial module is built on this one, so it is imported when it is used
+        return px.paraxialFocus(self)
+        
+    def effectiveFocalLength(self):
+        """Returns the effective (image side) focal length of the system, which is negative for a diverging system, or None if it has no lenses or is afocal"""
+        
+        import paraxial as px
+        if len(self.__z0) == 0:
+            return None
+        focalLength = px.systemProperties(self)['focalLength']
+        return focalLength if np.isfinite(focalLength) else None
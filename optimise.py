@@ -0,0 +1,132 @@
+import collections
+import time
+import numpy as np
+import raytracer as rt
+import optics2 as op
+
+"""
+Optimisation of lens curvatures for the smallest RMS spot radius
+"""
+
+def stackRMS(points, alive):
+    """Calculates the RMS spot radius of each system in an (M,N,3) stack of end points, about the chief ray (index 0) or the centroid if the chief ray was terminated"""
+    
+    count = alive.sum(axis=1)
+    xy = np.where(alive[:, :, np.newaxis], points[:, :, :2], 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid = xy.sum(axis=1) / count[:, np.newaxis]
+        centre = np.where(alive[:, :1], xy[:, 0, :], centroid)
+        offset = np.where(alive[:, :, np.newaxis], xy - centre[:, np.newaxis, :], 0.0)
+        return np.sqrt(np.einsum('mni,mni->m', offset, offset) / count) #Systems which lose every ray have an RMS of NaN
+        
+class Objective:
+    """A class which calculates the log of the RMS spot radius, and its gradient, as a function of the curvatures of chosen surfaces of a lens system.
+    The pupil sample is built once and reused for every evaluation, the gradient is found by central differences which are all traced in one stacked batch,
+    and recent evaluations are kept in a least-recently-used cache."""
+    
+    def __init__(self, lenses, surfaces=None, output=200, bundle=None, start=(0, 0, 0), step=1e-6, cacheSize=256):
+        system = op.OpticalSystem(lenses)
+        if not(system.isSpherical()):
+            raise Exception('The objective can only optimise systems of spherical lenses')
+        self.__constants = system.getConstants()
+        self.__surfaces = list(range(len(self.__constants['z0']))) if surfaces is None else list(surfaces) #The indices of the surfaces whose curvatures are varied
+        self.__output = float(output)
+        if bundle is None:
+            bundle = rt.Bundle(10, 5, 10)
+        self.__points = bundle.points(start) #The pupil sample is only generated once
+        self.__direction = np.array([0, 0, 1], dtype='float')
+        #The lenses before the first varied one never change, so the pupil sample is traced through them once and every evaluation starts from there
+        self.__first = min(self.__surfaces) if self.__surfaces else len(self.__constants['z0'])
+        if self.__first > 0:
+            fixed = dict((name, self.__constants[name][:self.__first]) for name in ('z0', 'curvature', 'aperture', 'relativeIndex'))
+            points, directions, alive = op.traceStack(self.__points, self.__direction, fixed['z0'], fixed['curvature'], fixed['aperture'], fixed['relativeIndex'],
+                                                      returnDirections=True)
+            self.__points, self.__direction = points[0], directions[0]
+        self.__step = float(step)
+        self.__cache = collections.OrderedDict()
+        self.__cacheSize = cacheSize
+        self.__evaluations = 0
+        self.__hits = 0
+        self.__tracedSystems = 0
+        self.__time = 0.0
+        
+    def __call__(self, curvatures):
+        """Returns the log of the RMS spot radius and its gradient, in the form expected by scipy.optimize.fmin_tnc"""
+        
+        return self.evaluate(curvatures, gradient=True)
+        
+    def value(self, curvatures):
+        """Returns the log of the RMS spot radius for the given curvatures"""
+        
+        return self.evaluate(curvatures, gradient=False)[0]
+        
+    def gradient(self, curvatures):
+        """Returns the gradient of the log of the RMS spot radius with respect to the curvatures"""
+        
+        return self.evaluate(curvatures, gradient=True)[1]
+        
+    def evaluate(self, curvatures, gradient=True):
+        """Returns the log of the RMS spot radius and, if gradient is True, its gradient (otherwise None), using the cache where possible"""
+        
+        self.__evaluations += 1
+        key = tuple(float(curvature) for curvature in np.ravel(curvatures))
+        if key in self.__cache and (self.__cache[key][1] is not None or not(gradient)):
+            self.__hits += 1
+            self.__cache[key] = self.__cache.pop(key) #Moving the entry to the end marks it as the most recently used
+            return self.__cache[key]
+            
+        began = time.time()
+        x = np.array(key, dtype='float')
+        stack = [x]
+        if gradient:
+            #Every forward and backward step of the central differences is traced alongside the unperturbed system
+            for i in range(len(x)):
+                for sign in (1, -1):
+                    stepped = x.copy()
+                    stepped[i] += sign * self.__step
+                    stack.append(stepped)
+        logRMS = np.log(self.traceRMS(np.array(stack)))
+        value = logRMS[0]
+        derivative = None
+        if gradient:
+            derivative = (logRMS[1::2] - logRMS[2::2]) / (2 * self.__step)
+        self.__time += time.time() - began
+        
+        self.__cache[key] = (value, derivative)
+        if len(self.__cache) > self.__cacheSize:
+            self.__cache.popitem(last=False) #The least recently used evaluation is discarded
+        return value, derivative
+        
+    def traceRMS(self, curvatures):
+        """Traces the pupil sample through a stack of systems, given as an (M,K) array of the varied curvatures, and returns the RMS spot radius of each"""
+        
+        curvature = np.repeat(self.__constants['curvature'][np.newaxis, :], len(curvatures), axis=0)
+        curvature[:, self.__surfaces] = curvatures
+        first = self.__first
+        points, alive = op.traceStack(self.__points, self.__direction, self.__constants['z0'][first:], curvature[:, first:], self.__constants['aperture'][first:],
+                                      self.__constants['relativeIndex'][first:], self.__output)
+        self.__tracedSystems += len(curvatures)
+        return stackRMS(points, alive)
+        
+    def report(self):
+        """Returns a dictionary of the number of evaluations, the cache hit rate and the rate of evaluation"""
+        
+        return {'evaluations': self.__evaluations, 'cacheHits': self.__hits, 'hitRate': self.__hits / float(max(self.__evaluations, 1)),
+                'tracedSystems': self.__tracedSystems, 'evaluationsPerSecond': (self.__evaluations - self.__hits) / self.__time if self.__time > 0 else np.inf}
+                
+    def optimise(self, bounds, starts=None, count=1, seed=None):
+        """Minimises the log of the RMS spot radius within the bounds, a (lower, upper) pair for each varied curvature, using scipy.optimize.fmin_tnc.
+        The optimisation is run from each of the starting curvatures given, or from count starting points drawn uniformly within the bounds using the seed.
+        Returns a dictionary of the best curvatures and RMS spot radius, along with the result of every start."""
+        
+        import scipy.optimize as so #Scipy is slow to import, so it is only imported once an optimisation is run
+        bounds = [(float(lower), float(upper)) for lower, upper in bounds]
+        if starts is None:
+            random = np.random.RandomState(seed)
+            starts = [[random.uniform(lower, upper) for lower, upper in bounds] for i in range(count)]
+        results = []
+        for start in starts:
+            x, evaluations, code = so.fmin_tnc(self, np.array(start, dtype='float'), bounds=bounds, disp=0)
+            results.append({'start': np.array(start, dtype='float'), 'curvatures': x, 'rms': np.exp(self.value(x)), 'evaluations': evaluations, 'code': code})
+        best = min(results, key=lambda result: result['rms'] if np.isfinite(result['rms']) else np.inf)
+        return {'curvatures': best['curvatures'], 'rms': best['rms'], 'results': results}
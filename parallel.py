@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import numpy as np
+import raytracer as rt
+import optics2 as op
+
+"""
+Parallel tracing of a single large beam. The rays are held in shared memory blocks (multiprocessing.shared_memory), which every worker process maps,
+so neither the rays nor the results are pickled: each task is only the range of rows of one shard, and the worker writes its results straight into
+the shared output arrays. The optical system is sent once to each worker when the pool starts.
+
+Every ray is traced on its own, and the rays are always split into the same shards whatever the number of workers, so sequential and parallel traces
+give bitwise-identical results.
+"""
+
+#The shared arrays of a trace: their names, columns and dtypes. Inputs are filled before the trace, outputs are written by the workers.
+COLUMNS = [('points', 3, 'float64'), ('directions', 3, 'float64'), ('end', 3, 'float64'), ('endDirections', 3, 'float64'), ('status', 0, 'int8')]
+
+worker = {} #The state of a worker process: its optical system and the shared arrays it has mapped
+
+def allocate(count, create=True, names=None):
+    """Creates (or, given their names, maps) the shared memory blocks of a trace of count rays.
+    Returns the blocks and a dictionary of the numpy arrays which view them."""
+    
+    from multiprocessing import shared_memory
+    blocks, arrays = [], {}
+    #Only the process which creates the blocks may unlink them. From Python 3.13 the blocks mapped by a worker are not tracked at all, and before then
+    #the workers share the resource tracker of the parent (see ParallelTracer.pool), so mapping a block only repeats the registration the parent owns.
+    attach = {'track': False} if sys.version_info >= (3, 13) else {}
+    for i, (name, columns, dtype) in enumerate(COLUMNS):
+        shape = (count, columns) if columns else (count,)
+        size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size) if create else shared_memory.SharedMemory(name=names[i], **attach)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
+
+def release(blocks, unlink=False):
+    """Closes shared memory blocks, and frees them if unlink is True"""
+    
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
+
+def traceShard(system, arrays, start, stop):
+    """Traces the rays in rows start to stop of the arrays through the system, and writes their final positions, directions and status into the output arrays"""
+    
+    batch = system.trace(arrays['points'][start:stop], arrays['directions'][start:stop], history='none')
+    arrays['end'][start:stop] = batch.p()
+    arrays['endDirections'][start:stop] = batch.k()
+    arrays['status'][start:stop] = batch.status()
+    return stop - start
+
+def initialiseWorker(system):
+    """Stores the optical system in a new worker process, so it is only sent once"""
+    
+    worker['system'] = system
+    worker['names'] = None
+
+def traceTask(names, count, start, stop):
+    """Traces one shard in a worker process, mapping the shared arrays of the trace the first time one of its shards is seen"""
+    
+    if worker['names'] != names:
+        if worker['names'] is not None:
+            worker['arrays'] = None #The views must go before the blocks they look at can be closed
+            release(worker['blocks'])
+        worker['blocks'], worker['arrays'] = allocate(count, False, names)
+        worker['names'] = names
+    return traceShard(worker['system'], worker['arrays'], start, stop)
+
+class ParallelTracer:
+    """A class which traces large beams through an optical system on a pool of worker processes, sharing the rays between them in shared memory"""
+    
+    def __init__(self, system, workers=None, shardsize=65536):
+        if not(isinstance(system, op.OpticalSystem)):
+            system = op.OpticalSystem(system)
+        self.__system = system
+        self.__workers = os.cpu_count() if workers is None else int(workers) #0 or 1 worker traces in this process
+        self.__shardsize = int(shardsize) #The number of rays in each shard, which sets the shards independently of the number of workers
+        self.__pool = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exception):
+        self.close()
+    
+    def close(self):
+        """Shuts down the pool of worker processes"""
+        
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+    
+    def workers(self):
+        return self.__workers
+    
+    def shards(self, count):
+        """Returns the (start, stop) rows of the shards of a beam of count rays"""
+        
+        return [(start, min(start + self.__shardsize, count)) for start in range(0, count, self.__shardsize)]
+    
+    def pool(self):
+        """Returns the pool of worker processes, which is started the first time it is needed. Every worker is started at once, and each receives the optical system once.
+        The resource tracker of this process is started first, so that the workers share it rather than each starting a tracker which would unlink the
+        shared arrays of this process when the worker exits."""
+        
+        if self.__pool is None:
+            import concurrent.futures
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+            self.__pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.__workers, initializer=initialiseWorker, initargs=(self.__system,))
+            list(self.__pool.map(abs, range(self.__workers))) #Submitting a task for each worker starts all of them before the first trace
+        return self.__pool
+    
+    def trace(self, points, directions):
+        """Traces (N,3) arrays of initial positions and directions (or a single direction) through the system, shard by shard.
+        Returns a dictionary of the final positions, directions (both NaN for terminated rays), status codes and alive mask of the rays,
+        along with the time taken and the throughput in rays per second."""
+        
+        points = np.array(points, dtype='float', ndmin=2)
+        directions = np.array(directions, dtype='float', ndmin=2)
+        count = len(points)
+        shards = self.shards(count)
+        began = time.time()
+        if self.__workers <= 1:
+            #The rays are held in contiguous arrays laid out like the shared ones, since the kernels can round differently on a strided view
+            arrays = {'points': points, 'directions': np.ascontiguousarray(np.broadcast_to(directions, points.shape)), 'end': np.empty_like(points),
+                      'endDirections': np.empty_like(points), 'status': np.empty(count, dtype='int8')}
+            for start, stop in shards:
+                traceShard(self.__system, arrays, start, stop)
+            result = dict((name, arrays[name]) for name in ('end', 'endDirections', 'status'))
+        else:
+            blocks, arrays = allocate(count)
+            try:
+                arrays['points'][:] = points
+                arrays['directions'][:] = directions
+                names = tuple(block.name for block in blocks)
+                futures = [self.pool().submit(traceTask, names, count, start, stop) for start, stop in shards]
+                for future in futures:
+                    future.result() #Waiting for every shard, and raising any exception from a worker
+                result = dict((name, np.array(arrays[name])) for name in ('end', 'endDirections', 'status')) #The results are copied out before the shared memory is freed
+            finally:
+                arrays = None
+                release(blocks, unlink=True)
+        elapsed = time.time() - began
+        return {'points': result['end'], 'directions': result['endDirections'], 'status': result['status'], 'alive': result['status'] == rt.ALIVE,
+                'rays': count, 'shards': len(shards), 'workers': max(self.__workers, 1), 'seconds': elapsed,
+                'raysPerSecond': count / elapsed if elapsed > 0 else np.inf}
+
+def identical(first, second):
+    """Returns True if two traces gave bitwise-identical results, including the NaN values of terminated rays"""
+    
+    for name in ('points', 'directions', 'status'):
+        a, b = np.ascontiguousarray(first[name]), np.ascontiguousarray(second[name])
+        if a.shape != b.shape or a.tobytes() != b.tobytes():
+            return False
+    return True
+
+def scaling(system, points, directions, workers=None, shardsize=65536):
+    """Traces the same beam with each number of workers (by default doubling up to the number of cores) and reports the speed up over the sequential trace
+    and the scaling efficiency (the speed up divided by the number of workers), and checks that every trace matches the sequential one bit for bit.
+    The time of each parallel trace excludes starting its pool."""
+    
+    cores = os.cpu_count() or 1
+    if workers is None:
+        workers = [1]
+        while workers[-1] * 2 <= cores:
+            workers.append(workers[-1] * 2)
+        if workers[-1] != cores:
+            workers.append(cores)
+    reference = ParallelTracer(system, 1, shardsize).trace(points, directions)
+    report = {'cores': cores, 'rays': len(reference['points']), 'runs': []}
+    for count in workers:
+        with ParallelTracer(system, count, shardsize) as tracer:
+            if count > 1:
+                tracer.pool() #Starting the pool, so that it is not timed
+            result = reference if count <= 1 else tracer.trace(points, directions)
+        speedup = reference['seconds'] / result['seconds']
+        report['runs'].append({'workers': count, 'seconds': result['seconds'], 'raysPerSecond': result['raysPerSecond'], 'speedup': speedup,
+                               'efficiency': speedup / count, 'coreFraction': count / float(cores), 'identical': identical(reference, result)})
+    return report
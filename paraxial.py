@@ -0,0 +1,134 @@
+import numpy as np
+import optics2 as op
+
+"""
+First-order (paraxial) optics with 2x2 ray transfer (ABCD) matrices, acting on rays given by their height y and angle u to the optical axis.
+
+Refraction at a surface of curvature c from index n1 to n2 is [[1, 0], [-(n2 - n1)c/n2, n1/n2]], and a gap of length d is [[1, d], [0, 1]].
+The matrix of a system runs from the vertex of its first surface to the vertex of its last. Every function accepts the surface constants as (S,) arrays
+for one system or (M,S) arrays for M systems at once, which are all multiplied together in a single batched matrix product per surface.
+"""
+
+def refractionMatrices(curvature, n1, n2):
+    """Returns the (...,2,2) refraction matrices of surfaces with the given curvatures and indices"""
+    
+    curvature, n1, n2 = np.broadcast_arrays(*[np.asarray(value, dtype='float') for value in (curvature, n1, n2)])
+    matrices = np.zeros(curvature.shape + (2, 2))
+    matrices[..., 0, 0] = 1.0
+    matrices[..., 1, 0] = -(n2 - n1) * curvature / n2
+    matrices[..., 1, 1] = n1 / n2
+    return matrices
+
+def transferMatrices(distance):
+    """Returns the (...,2,2) matrices of propagation through gaps of the given lengths"""
+    
+    distance = np.asarray(distance, dtype='float')
+    matrices = np.zeros(distance.shape + (2, 2))
+    matrices[..., 0, 0] = 1.0
+    matrices[..., 0, 1] = distance
+    matrices[..., 1, 1] = 1.0
+    return matrices
+
+def constants(system):
+    """Returns the z0, curvature, n1 and n2 arrays of an OpticalSystem (or a list of lenses)"""
+    
+    if not(isinstance(system, op.OpticalSystem)):
+        system = op.OpticalSystem(system)
+    constants = system.getConstants()
+    return constants['z0'], constants['curvature'], constants['n1'], constants['n2']
+
+def systemMatrix(z0, curvature, n1, n2):
+    """Returns the (M,2,2) matrices, from the first vertex to the last, of M systems of S surfaces given as (M,S) arrays (or (2,2) for (S,) arrays)"""
+    
+    z0, curvature, n1, n2 = np.broadcast_arrays(*[np.asarray(value, dtype='float') for value in (z0, curvature, n1, n2)])
+    single = z0.ndim == 1
+    z0, curvature, n1, n2 = [np.atleast_2d(value) for value in (z0, curvature, n1, n2)]
+    refractions = refractionMatrices(curvature, n1, n2)
+    transfers = transferMatrices(np.diff(z0, axis=1))
+    matrix = np.broadcast_to(np.eye(2), (len(z0), 2, 2))
+    for s in range(z0.shape[1]):
+        if s > 0:
+            matrix = np.matmul(transfers[:, s - 1], matrix)
+        matrix = np.matmul(refractions[:, s], matrix)
+    return matrix[0] if single else matrix
+
+def firstOrder(z0, curvature, n1, n2):
+    """Calculates the first-order properties of one system, given as (S,) arrays, or of M systems at once, given as (M,S) arrays.
+    Returns a dictionary of arrays (or numbers for a single system) of:
+        matrix             The ABCD matrix from the first vertex to the last.
+        focalLength        The effective (image side) focal length, negative for a diverging system and infinite for an afocal one.
+        frontFocalLength   The object side focal length, which differs from the focal length by the ratio of the indices at the two ends.
+        power              The optical power, 1/focalLength.
+        backFocalDistance  The distance from the last vertex to the rear focal point.
+        frontFocalDistance The distance from the front focal point to the first vertex.
+        focus              The z position of the rear (paraxial) focal point.
+        frontFocus         The z position of the front focal point.
+        rearPrincipal      The z position of the rear principal plane.
+        frontPrincipal     The z position of the front principal plane."""
+    
+    z0 = np.asarray(z0, dtype='float')
+    matrix = systemMatrix(z0, curvature, n1, n2)
+    A, B, C, D = matrix[..., 0, 0], matrix[..., 0, 1], matrix[..., 1, 0], matrix[..., 1, 1]
+    first, last = z0[..., 0], z0[..., -1]
+    with np.errstate(divide='ignore', invalid='ignore'): #An afocal system (C = 0) has infinite focal lengths
+        focalLength = -1 / C
+        frontFocalLength = -(A * D - B * C) / C
+        backFocalDistance = -A / C
+        frontFocalDistance = -D / C
+        properties = {'matrix': matrix, 'focalLength': focalLength, 'frontFocalLength': frontFocalLength, 'power': -C, 'backFocalDistance': backFocalDistance,
+                      'frontFocalDistance': frontFocalDistance, 'focus': last + backFocalDistance, 'frontFocus': first - frontFocalDistance,
+                      'rearPrincipal': last + backFocalDistance - focalLength, 'frontPrincipal': first - frontFocalDistance + frontFocalLength}
+    if matrix.ndim == 2:
+        properties = dict((name, value if name == 'matrix' else float(value)) for name, value in properties.items())
+    return properties
+
+def imagePlane(z0, curvature, n1, n2, objectZ):
+    """Finds the image of an object on the axis at objectZ (before the first surface) through one or M systems.
+    Returns the z position of the image and the lateral magnification, which are infinite when the object is at the front focal point."""
+    
+    z0 = np.asarray(z0, dtype='float')
+    matrix = systemMatrix(z0, curvature, n1, n2)
+    A, B, C, D = matrix[..., 0, 0], matrix[..., 0, 1], matrix[..., 1, 0], matrix[..., 1, 1]
+    distance = z0[..., 0] - np.asarray(objectZ, dtype='float') #The distance from the object to the first vertex
+    with np.errstate(divide='ignore', invalid='ignore'):
+        image = -(A * distance + B) / (C * distance + D) #The distance after the last vertex at which the matrix from object to image has no B term
+        magnification = A + image * C
+    return z0[..., -1] + image, magnification
+
+def systemProperties(system):
+    """Returns the first-order properties (see firstOrder) of an OpticalSystem or a list of lenses"""
+    
+    return firstOrder(*constants(system))
+
+def paraxialFocus(system):
+    """Returns the z position of the paraxial focus of an OpticalSystem (or a list of lenses), or None if the system does not bring parallel rays to a real focus after its last lens"""
+    
+    z0, curvature, n1, n2 = constants(system)
+    if len(z0) == 0:
+        return None
+    properties = firstOrder(z0, curvature, n1, n2)
+    if not(np.isfinite(properties['focus'])) or properties['backFocalDistance'] <= 0:
+        return None
+    return properties['focus']
+
+def outputPlane(system):
+    """Returns an OutputPlane placed at the paraxial focus of a system, or None if it has no real focus"""
+    
+    focus = paraxialFocus(system)
+    if focus is None:
+        return None
+    return op.OutputPlane(focus)
+
+def screen(z0, curvature, n1, n2, focalLength=None, tolerance=0.05, maximumLength=None):
+    """Pre-screens M candidate systems, given as (M,S) arrays, before they are traced. A candidate passes if it has a real focus after its last surface,
+    its focal length is within the fractional tolerance of the given focal length (if one is given), and its focus lies within maximumLength of its first vertex (if given).
+    Returns an (M,) boolean array of the candidates which pass, along with their first-order properties."""
+    
+    properties = firstOrder(z0, curvature, n1, n2)
+    with np.errstate(invalid='ignore'):
+        passed = np.isfinite(properties['focus']) & (properties['backFocalDistance'] > 0)
+        if focalLength is not None:
+            passed &= np.abs(properties['focalLength'] - focalLength) <= tolerance * abs(focalLength)
+        if maximumLength is not None:
+            passed &= properties['focus'] - np.asarray(z0, dtype='float')[..., 0] <= maximumLength
+    return passed, properties
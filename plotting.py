@@ -1,112 +1,193 @@
+from __future__ import print_function
 import numpy as np
 import raytracer as rt
+import spots
 import matplotlib.pyplot as plt
-from mpl_toolkits import mplot3d
+from matplotlib.collections import LineCollection
 
 class Plot():
     """A class which allows the rays to be plotted in various formats"""
     
-    def __init__(self, rays):
+    def __init__(self, rays, maxRays=1000, densityThreshold=20000, bins=200, chief=0):
         self.__rays = rays
-        if not(isinstance(rays, list)):
+        self.__chief = chief #The index of the chief ray, about which the spot is measured
+        self.__batch = None
+        self.__maxRays = maxRays #The most ray trajectories drawn; above this the rays are decimated evenly across the rings of the pupil
+        self.__densityThreshold = densityThreshold #Above this many points, the input and output planes are drawn as density images rather than scatter plots
+        self.__bins = bins
+        self.__figures = {}
+        if isinstance(rays, rt.RayBatch):
+            self.__batch = rays #The end points of a batch can be read directly from its arrays, and iterating over it gives each ray as a Ray object
+        elif not(isinstance(rays, list)):
             self.__rays = [rays]
     
     def rms(self):
-        """Calculates the RMS spot radius for a bundle of rays at the output"""
+        """Calculates the RMS spot radius for a bundle of rays at the output, about the chief ray (or the centroid if the chief ray was terminated)"""
         
-        radiusSquareSum = 0.0
-        numberOfPoints = len(self.__rays)
-        centralRay = self.__rays[0].p()
+        return self.spotStatistics()['rms']
+        
+    def spotStatistics(self):
+        """Calculates the full set of spot statistics (see spots.spotStatistics) for the rays at the output"""
+        
+        if self.__batch is not None:
+            return spots.spotStatistics(self.__batch.p(), self.__batch.alive(), self.__chief)
+        points = np.array([ray.p() for ray in self.__rays], dtype='float').reshape(-1, 3)
+        return spots.spotStatistics(points, chief=self.__chief) #Terminated rays have NaN end points, so they are left out of the statistics
+        
+    def paths(self):
+        """Returns the vertices of every ray which reaches the output. For a batch they are read as one (N, vertices, 3) array from its history."""
+        
+        if self.__batch is not None:
+            return self.__batch.vertices()[self.__batch.alive()]
+        paths = []
         for ray in self.__rays:
-            rayPosition = ray.p()
-            x = rayPosition[0]
-            y = rayPosition[1]
-            radiusSquare = (float(x) - float(centralRay[0]))**2 + (float(y) - float(centralRay[1]))**2 
-            radiusSquareSum += radiusSquare
-        radiusSquareMean = radiusSquareSum/float(numberOfPoints)
-        RMS = np.sqrt(radiusSquareMean)
-        return RMS
+            points = ray.vertices()
+            if not(np.isnan(points[-1][0])): #Checking to see if any rays have been terminated
+                paths.append(points)
+        return paths
+        
+    def inputPoints(self):
+        """Returns an (N,3) array of the initial positions of all the rays"""
+        
+        if self.__batch is not None:
+            return self.__batch.start()
+        return np.array([ray.vertices()[0] for ray in self.__rays], dtype='float').reshape(-1, 3)
+        
+    def outputPoints(self):
+        """Returns an (N,3) array of the final positions of the rays which reach the output"""
+        
+        if self.__batch is not None:
+            return self.__batch.p()[self.__batch.alive()]
+        return np.array([points[-1] for points in self.paths()], dtype='float').reshape(-1, 3)
+        
+    def decimate(self, starts):
+        """Returns the indices of at most maxRays of the rays with the given (N,3) initial positions. The rays are divided into rings by their distance
+        from the first ray in the pupil, and each ring keeps its share of the rays, spaced evenly through it, so that the whole pupil stays represented."""
+        
+        count = len(starts)
+        if count <= self.__maxRays:
+            return np.arange(count)
+        radius = np.hypot(starts[:, 0] - starts[0, 0], starts[:, 1] - starts[0, 1])
+        rings = max(int(np.sqrt(self.__maxRays)), 1)
+        ring = np.digitize(radius, np.linspace(0.0, radius.max(), rings + 1)[1:-1])
+        ring = np.unique(ring, return_inverse=True)[1].ravel() #Only the rings which hold rays are kept
+        sizes = np.bincount(ring)
+        #Every ring keeps one ray, and the rest of maxRays are shared out in proportion to the other rays in each ring by the largest remainder method,
+        #so that the quotas add up to exactly maxRays
+        spare = self.__maxRays - len(sizes)
+        quotas = (sizes - 1) * spare / float(count - len(sizes))
+        takes = 1 + np.floor(quotas).astype('int64')
+        remainder = spare - (takes - 1).sum()
+        takes[np.argsort(-(quotas - np.floor(quotas)), kind='mergesort')[:remainder]] += 1
+        selected = []
+        for r, take in enumerate(takes):
+            members = np.flatnonzero(ring == r)
+            selected.append(members[np.round(np.linspace(0, len(members) - 1, take)).astype('int64')])
+        return np.sort(np.concatenate(selected))
+        
+    def shownPaths(self):
+        """Returns the paths of the rays that are drawn, after decimation"""
+        
+        paths = self.paths()
+        if len(paths) == 0:
+            return paths
+        starts = np.array([points[0] for points in paths], dtype='float') if isinstance(paths, list) else paths[:, 0]
+        indices = self.decimate(starts)
+        if isinstance(paths, list):
+            return [paths[i] for i in indices]
+        return paths[indices]
+        
+    def scatterOrDensity(self, fig, ax, x, y):
+        """Draws points as a scatter plot, or as a 2D histogram image once there are more of them than the density threshold"""
+        
+        if len(x) > self.__densityThreshold:
+            counts, xedges, yedges, image = ax.hist2d(x, y, bins=self.__bins, cmap='viridis')
+            fig.colorbar(image, ax=ax, label='Rays per bin')
+        else:
+            ax.scatter(x, y)
+            
+    def savePlots(self, prefix, extension='png'):
+        """Draws all four plots and saves them as files named after the prefix, without showing them, so that plots can be made by batch jobs.
+        Returns the names of the files that were written."""
+        
+        self.plotRays2D()
+        self.plotRays3D()
+        self.plotInput()
+        self.plotOutput()
+        filenames = []
+        for name in ('rays2D', 'rays3D', 'input', 'output'):
+            filename = '%s_%s.%s' % (prefix, name, extension)
+            self.__figures[name].savefig(filename)
+            plt.close(self.__figures.pop(name)) #The figures are closed once they are saved, so that none are left open
+            filenames.append(filename)
+        return filenames
             
     def plotRays2D(self):
         """Plots the trajectories of the rays in 2D"""
         
         fig = plt.figure()
+        self.__figures['rays2D'] = fig
         ax = fig.add_subplot(111)
-        for ray in self.__rays:
-            points = ray.vertices()
-            if np.isnan(points[-1][0]): #Checking to see if any rays have been terminated
-                pass
-            else:
-                x, z = [], []
-                for i in points:
-                    x.append(i[0])
-                    z.append(i[2])
-                ax.set_xlabel('z axis')
-                ax.set_ylabel('x axis')
-                ax.set_title('RayTracer 2D')
-                plt.grid(True)
-                ax.plot(z, x, 'darkcyan')
-            
-    
+        ax.set_xlabel('z axis')
+        ax.set_ylabel('x axis')
+        ax.set_title('RayTracer 2D')
+        ax.grid(True)
+        #Only the rays which have not been terminated are plotted, all in a single collection of lines
+        ax.add_collection(LineCollection([np.asarray(points)[:, [2, 0]] for points in self.shownPaths()], colors='darkcyan'))
+        ax.autoscale()
+        
+
     def plotRays3D(self):
         """Plots the trajectories of the rays in 3D"""
         
+        from mpl_toolkits.mplot3d.art3d import Line3DCollection #The 3D toolkit is only imported when a 3D plot is drawn
         fig = plt.figure()
-        ax = plt.axes(projection='3d')
+        self.__figures['rays3D'] = fig
+        ax = fig.add_subplot(111, projection='3d')
         ax.set_xlabel('z axis')
         ax.set_ylabel('y axis')
         ax.set_zlabel('x axis')
         ax.set_title('Ray Tracer 3D')
         
-        for ray in self.__rays:
-            points = ray.vertices()
-            if np.isnan(points[-1][0]): #Checking to see if any rays have been terminated
-                pass
-            else:
-                x, y, z = [], [], []
-                for i in points:
-                    x.append(i[0])
-                    y.append(i[1])
-                    z.append(i[2])
-                ax.plot3D(z, y, x, 'darkcyan')
+        #Only the rays which have not been terminated are plotted, all in a single collection of lines
+        paths = [np.asarray(points)[:, [2, 1, 0]] for points in self.shownPaths()]
+        ax.add_collection3d(Line3DCollection(paths, colors='darkcyan'))
+        if len(paths) > 0:
+            #The limits of the axes are not found automatically for a 3D collection
+            points = np.concatenate(paths)
+            ax.set_xlim(points[:, 0].min(), points[:, 0].max())
+            ax.set_ylim(points[:, 1].min(), points[:, 1].max())
+            ax.set_zlim(points[:, 2].min(), points[:, 2].max())
             
     def plotInput(self):
         """Plots the x and y postions of the rays at their initial positions"""
         
         fig = plt.figure()
+        self.__figures['input'] = fig
         ax = fig.add_subplot(111)
-        x, y = [], []
-        for ray in self.__rays:
-            points = ray.vertices()
-            x.append(points[0][0])
-            y.append(points[0][1])
+        points = self.inputPoints()
+        x, y = points[:, 0], points[:, 1]
         ax.set_xlabel('x axis')
         ax.set_ylabel('y axis')
         ax.set_title('Input Plane')
-        plt.grid(True)
-        ax.scatter(x, y)
+        ax.grid(True)
+        self.scatterOrDensity(fig, ax, x, y)
         
     def plotOutput(self):
         """Plots the x and y postions of the rays at their final positions (usually the output plane)"""
         
         fig = plt.figure()
+        self.__figures['output'] = fig
         ax = fig.add_subplot(111)
-        x, y = [], []
-        for ray in self.__rays:
-            points = ray.vertices()
-            if np.isnan(points[-1][0]):
-                pass
-            else:
-                x.append(points[-1][0])
-                y.append(points[-1][1])
+        points = self.outputPoints()
+        x, y = points[:, 0], points[:, 1]
         ax.set_xlabel('x axis')
         ax.set_ylabel('y axis')
         ax.set_title('Output Plane')
-        plt.grid(True)
-        ax.scatter(x, y)
+        ax.grid(True)
+        self.scatterOrDensity(fig, ax, x, y)
         
         RMS = self.rms()
         #The plot is annotated with the RMS spot radius of the output
         ax.annotate('RMS: %f'% RMS, xy = (0.7, 0.9), xycoords='axes fraction', xytext= (0.7, 0.9), textcoords ='axes fraction')
-        print 'RMS: ', RMS
         return RMS
\ No newline at end of file
@@ -0,0 +1,248 @@
+from __future__ import print_function
+import json
+import marshal
+import pstats
+import time
+import numpy as np
+import raytracer as rt
+import optics2 as op
+
+"""
+Opt-in instrumentation of the hot paths of a trace. While a Profiler is enabled, the instrumented methods of the optical elements and the vectorised kernels
+of optics2 are replaced by timing wrappers; when it is disabled the original functions are put back, so there is no overhead at all when not profiling.
+"""
+
+clock = getattr(time, 'perf_counter', time.time) #The most precise clock available
+
+class Profiler:
+    """A class which records, for every surface, the calls, time, rays in and out, rays lost and bytes produced by the instrumented hot paths of a trace"""
+    
+    def __init__(self):
+        self.__records = {}
+        self.__stack = [] #The keys of the instrumented calls in progress, so that the time of nested calls is only counted once as the caller's own time
+        self.__patched = []
+        self.__surface = None #The surface whose intercepts were found last, to which the refraction that follows is attributed
+        self.__hit = None #The rays which hit that surface, which are the only rays the refraction that follows does any work for
+    
+    def __enter__(self):
+        return self.enable()
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.disable()
+    
+    def targets(self):
+        """Returns the (owner, name, counter) of every function which is instrumented, where the counter reports the rays passing through a call"""
+        
+        targets = [
+            (op.SphericalRefraction, 'getIntercept', self.countIntercept),
+            (op.SphericalRefraction, 'refractRay', self.countRefraction),
+            (op.SphericalRefraction, 'propagateRay', self.countRay),
+            (op.SphericalRefraction, 'propagateBatch', self.countBatch),
+            (op.OutputPlane, 'propagateRay', self.countRay),
+            (op.OutputPlane, 'propagateBatch', self.countBatch),
+            (op.OpticalSystem, 'traceSurfaces', self.countBatch),
+            (op, 'sphereIntercepts', self.countIntercepts),
+            (op, 'snellRefraction', self.countRefractions)]
+        try:
+            import plotting as pt #Plotting needs matplotlib, so Plot.rms is only instrumented when it is available
+            targets.append((pt.Plot, 'rms', None))
+        except ImportError:
+            pass
+        return targets
+    
+    def enable(self):
+        """Starts recording by replacing the instrumented functions with timing wrappers"""
+        
+        if self.__patched:
+            raise Exception('The profiler is already enabled')
+        for owner, name, counter in self.targets():
+            original = getattr(owner, name)
+            self.__patched.append((owner, name, original))
+            setattr(owner, name, self.wrap(original, owner, name, counter))
+        return self
+    
+    def disable(self):
+        """Stops recording and restores the original functions"""
+        
+        for owner, name, original in reversed(self.__patched):
+            setattr(owner, name, original)
+        self.__patched = []
+        self.__stack = []
+        self.__hit = None
+    
+    def reset(self):
+        """Discards everything that has been recorded"""
+        
+        self.__records = {}
+    
+    def wrap(self, function, owner, name, counter):
+        """Returns a wrapper around a function which records each of its calls"""
+        
+        code = getattr(function, '__code__', None)
+        filename = code.co_filename if code is not None else '~'
+        line = code.co_firstlineno if code is not None else 0
+        qualified = name if owner is op else '%s.%s' % (owner.__name__, name)
+        profiler = self
+        
+        def wrapper(*args, **kwargs):
+            rays = counter(args, None, None) if counter is not None else None #The rays entering the call are counted before it changes them
+            key = (filename, line, '%s[%s]' % (qualified, profiler.surfaceLabel(name, args)))
+            caller = profiler.__stack[-1] if profiler.__stack else None
+            profiler.__stack.append(key)
+            begin = clock()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                elapsed = clock() - begin
+                profiler.__stack.pop()
+            counts = counter(args, result, rays) if counter is not None else {}
+            profiler.record(key, caller, elapsed, counts)
+            return result
+        
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    
+    def surfaceLabel(self, name, args):
+        """Returns a label for the surface that a call acts on"""
+        
+        if name == 'sphereIntercepts':
+            self.__surface = 'z0=%g' % args[2] #The kernels are not given their lens, but sphereIntercepts is given its z0
+            return self.__surface
+        if name == 'snellRefraction':
+            return self.__surface or '-'
+        element = args[0]
+        if isinstance(element, op.SphericalRefraction):
+            return 'z0=%g' % element.getz0()
+        if isinstance(element, op.OutputPlane):
+            return 'z=%g' % element.getz()
+        return '-'
+    
+    def record(self, key, caller, elapsed, counts):
+        """Adds a single call to the records"""
+        
+        record = self.entry(key)
+        record['calls'] += 1
+        record['time'] += elapsed
+        record['ownTime'] += elapsed
+        for field, value in counts.items():
+            record[field] += int(value)
+        if caller is not None:
+            self.entry(caller)['ownTime'] -= elapsed #The time of a nested call is taken off the own time of its caller
+            calls, total = record['callers'].get(caller, (0, 0.0))
+            record['callers'][caller] = (calls + 1, total + elapsed)
+    
+    def entry(self, key):
+        """Returns the record for a key, creating it if there is none yet"""
+        
+        record = self.__records.get(key)
+        if record is None:
+            record = {'calls': 0, 'time': 0.0, 'ownTime': 0.0, 'raysIn': 0, 'raysOut': 0, 'lostAperture': 0, 'lostTIR': 0, 'bytes': 0, 'callers': {}}
+            self.__records[key] = record
+        return record
+    
+    #The counters are called once before a call, with no count, to count the rays going in, and once after it with the result and that count
+    
+    def countIntercept(self, args, result, rays):
+        ray = args[1]
+        if rays is None:
+            return int(np.isfinite(ray.p()[0]))
+        return {'raysIn': rays, 'raysOut': int(result is not None), 'lostAperture': rays - int(result is not None), 'bytes': arrayBytes(result)}
+    
+    def countRefraction(self, args, result, rays):
+        if rays is None:
+            return 1
+        return {'raysIn': rays, 'raysOut': int(result is not None), 'lostTIR': rays - int(result is not None), 'bytes': arrayBytes(result)}
+    
+    def countRay(self, args, result, rays):
+        ray = args[1]
+        if rays is None:
+            return int(np.isfinite(ray.p()[0]))
+        alive = int(np.isfinite(ray.p()[0]))
+        counts = {'raysIn': rays, 'raysOut': alive, 'bytes': ray.p().nbytes + ray.k().nbytes}
+        if rays > alive:
+            #A ray lost at a lens has already been given its own batch by the lens, so its status can be read without detaching it
+            if ray.batch().status()[0] == rt.REFLECTED:
+                counts['lostTIR'] = 1
+            else:
+                counts['lostAperture'] = 1
+        return counts
+    
+    def countBatch(self, args, result, rays):
+        batch = args[1]
+        if rays is None:
+            return batch.alive().copy()
+        alive = batch.alive()
+        lost = rays & ~alive
+        status = batch.status()
+        return {'raysIn': rays.sum(), 'raysOut': alive.sum(), 'lostAperture': (lost & (status == rt.MISSED)).sum(),
+                'lostTIR': (lost & (status == rt.REFLECTED)).sum(), 'bytes': batch.p().nbytes + batch.k().nbytes}
+    
+    def countIntercepts(self, args, result, rays):
+        if rays is None:
+            return np.isfinite(args[0][:, 0]).sum()
+        hit = result[1]
+        self.__hit = hit
+        return {'raysIn': rays, 'raysOut': hit.sum(), 'lostAperture': rays - hit.sum(), 'bytes': arrayBytes(result)}
+    
+    def countRefractions(self, args, result, rays):
+        #Rays which missed the surface are still refracted as rows of the arrays, so only the rays which hit it, from the intercepts just before, are counted
+        alive = np.isfinite(args[0][:, 0]) & np.isfinite(args[1][:, 0])
+        if self.__hit is not None and len(self.__hit) == len(alive):
+            alive &= self.__hit
+        if rays is None:
+            return alive.sum()
+        self.__hit = None
+        refracted = result[1] & alive
+        return {'raysIn': rays, 'raysOut': refracted.sum(), 'lostTIR': rays - refracted.sum(), 'bytes': arrayBytes(result)}
+    
+    def records(self):
+        """Returns a list of the records, one for every instrumented function and surface, sorted by their total time"""
+        
+        records = []
+        for key, record in self.__records.items():
+            entry = dict((field, value) for field, value in record.items() if field != 'callers')
+            entry['function'] = key[2]
+            entry['file'] = key[0]
+            entry['line'] = key[1]
+            entry['callers'] = sorted(caller[2] for caller in record['callers'])
+            records.append(entry)
+        return sorted(records, key=lambda entry: -entry['time'])
+    
+    def toJSON(self, filename=None):
+        """Returns the records as a JSON string, and writes it to a file if a filename is given"""
+        
+        text = json.dumps(self.records(), indent=2)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(text)
+        return text
+    
+    def create_stats(self):
+        """Builds the stats dictionary in the form used by cProfile, so that pstats.Stats(profiler) can read the records directly"""
+        
+        self.stats = {}
+        for key, record in self.__records.items():
+            callers = dict((caller, (calls, calls, total, total)) for caller, (calls, total) in record['callers'].items())
+            self.stats[key] = (record['calls'], record['calls'], record['ownTime'], record['time'], callers)
+    
+    def dumpStats(self, filename):
+        """Writes the records to a file in the format of cProfile, which can be read by pstats or by tools such as snakeviz"""
+        
+        self.create_stats()
+        with open(filename, 'wb') as f:
+            marshal.dump(self.stats, f)
+    
+    def printStats(self, sort='cumulative'):
+        """Prints a cProfile style summary of the records"""
+        
+        pstats.Stats(self).sort_stats(sort).print_stats()
+
+def arrayBytes(result):
+    """Returns the total size in bytes of the arrays in a result, which may be an array, a tuple of arrays or None"""
+    
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, tuple):
+        return sum(arrayBytes(value) for value in result)
+    return 0
@@ -0,0 +1,239 @@
+import json
+import os
+import numpy as np
+import raytracer as rt
+import optics2 as op
+
+"""
+A memory-mapped on-disk format for traced ray sets.
+
+A ray set is a directory which contains a header and one raw binary file per column, so that every column can be appended to in chunks while a trace is
+streamed, and read back lazily with numpy.memmap without loading the whole set:
+
+    header.json      The format name and version, the number of rays and surfaces, the dtype of the float columns, the optical system
+                     (a list of elements, each a dictionary of its parameters) and the meaning of the status codes.
+    start            (N,3) initial positions of the rays, as little-endian floats of the header dtype.
+    startDirection   (N,3) initial unit direction vectors.
+    intercepts       (N,S,3) positions of the rays at each of the S surfaces of the system (including the output plane), NaN from the surface at which a ray was terminated.
+    direction        (N,3) final unit direction vectors, NaN for terminated rays.
+    status           (N,) int8 status codes: 0 alive, 1 missed a surface or its aperture, 2 totally internally reflected.
+
+Rows are in the order the rays were written, and every column holds the same rays.
+"""
+
+FORMAT = 'raytracer-rayset'
+VERSION = 1
+COLUMNS = ('start', 'startDirection', 'intercepts', 'direction', 'status')
+
+def describeSystem(system):
+    """Returns a list of dictionaries of the parameters of the elements of an optical system, which is stored in the header"""
+    
+    elements = system.getElements() if isinstance(system, op.OpticalSystem) else list(system)
+    description = []
+    for element in elements:
+        if isinstance(element, op.SphericalRefraction):
+            n1, n2 = element.getIndices()
+            description.append({'type': 'SphericalRefraction', 'z0': element.getz0(), 'aperture': element.getAperture(), 'curvature': element.getCurvature(), 'n1': n1, 'n2': n2})
+            if isinstance(element, op.AsphericRefraction):
+                description[-1].update({'type': 'AsphericRefraction', 'conic': element.getConic(), 'coefficients': element.getCoefficients()})
+        elif isinstance(element, op.OutputPlane):
+            description.append({'type': 'OutputPlane', 'z': element.getz()})
+        else:
+            description.append({'type': type(element).__name__})
+    return description
+    
+def buildSystem(description):
+    """Rebuilds the optical system described in a header"""
+    
+    elements = []
+    for element in description:
+        if element['type'] == 'SphericalRefraction':
+            elements.append(op.SphericalRefraction(element['z0'], element['aperture'], element['curvature'], element['n1'], element['n2']))
+        elif element['type'] == 'AsphericRefraction':
+            elements.append(op.AsphericRefraction(element['z0'], element['aperture'], element['curvature'], element['n1'], element['n2'], element['conic'], element['coefficients']))
+        elif element['type'] == 'OutputPlane':
+            elements.append(op.OutputPlane(element['z']))
+        else:
+            raise Exception('The element %s cannot be rebuilt from a ray set header' % element['type'])
+    return op.OpticalSystem(elements)
+    
+class RayFileWriter:
+    """A class which writes traced ray batches to a ray set directory, one chunk at a time.
+    The start, direction and status arrays of each batch are written from its buffers, and the intercepts are copied out of its vertex history, whose first vertex
+    is the start position of every ray. The header is updated with the number of rays whenever the writer is flushed or closed."""
+    
+    def __init__(self, path, system=None, dtype='float64', append=False):
+        self.__path = path
+        self.__dtype = np.dtype(dtype).newbyteorder('<')
+        self.__system = [] if system is None else describeSystem(system)
+        self.__rays = 0
+        self.__surfaces = None
+        if not(os.path.isdir(path)):
+            os.makedirs(path)
+        headerFile = os.path.join(path, 'header.json')
+        if append and os.path.exists(headerFile):
+            #Appending to an existing ray set continues after the rays which are already in its column files
+            existing = RayFile(path)
+            self.__dtype = existing.dtype()
+            self.__system = existing.header()['system']
+            self.__surfaces = existing.surfaces()
+            self.__rays = len(existing)
+        mode = 'ab' if append else 'wb'
+        self.__files = dict((column, open(os.path.join(path, column), mode)) for column in COLUMNS)
+        self.writeHeader()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exception):
+        self.close()
+        
+    def write(self, batch):
+        """Appends every ray of a batch. The batch must have recorded the same number of surfaces as the batches already written, using the 'vertices' or 'full' history."""
+        
+        if batch.history() == 'none':
+            raise Exception("Only batches with the 'vertices' or 'full' history record the intercepts at every surface")
+        intercepts = batch.vertices()[:, 1:]
+        if self.__surfaces is None:
+            self.__surfaces = intercepts.shape[1]
+        elif intercepts.shape[1] != self.__surfaces:
+            raise Exception('Every batch in a ray set must have passed through %d surfaces' % self.__surfaces)
+        #ascontiguousarray only copies an array which is not already laid out in the dtype of the file, which is always the case for the intercepts,
+        #since they are a strided slice of the vertices. The copy is made once, converting the dtype at the same time
+        for column, array in (('start', batch.start()), ('startDirection', batch.startDirections()), ('intercepts', intercepts), ('direction', batch.k())):
+            np.ascontiguousarray(array, dtype=self.__dtype).tofile(self.__files[column])
+        np.ascontiguousarray(batch.status(), dtype='int8').tofile(self.__files['status'])
+        self.__rays += len(batch)
+        return self
+        
+    def addBatch(self, batch):
+        """Writes a batch, so that the writer can be used as a reducer of a streamed trace"""
+        
+        return self.write(batch)
+        
+    def result(self):
+        """Closes the writer and returns the path of the ray set along with the number of rays in it"""
+        
+        self.close()
+        return {'path': self.__path, 'rays': self.__rays}
+        
+    def writeHeader(self):
+        """Writes the header of the ray set"""
+        
+        header = {'format': FORMAT, 'version': VERSION, 'rays': self.__rays, 'surfaces': self.__surfaces, 'dtype': self.__dtype.str, 'system': self.__system,
+                  'status': {'alive': rt.ALIVE, 'missed': rt.MISSED, 'reflected': rt.REFLECTED}, 'columns': list(COLUMNS)}
+        with open(os.path.join(self.__path, 'header.json'), 'w') as headerFile:
+            json.dump(header, headerFile, indent=1)
+            
+    def flush(self):
+        """Flushes the column files and brings the header up to date"""
+        
+        for columnFile in self.__files.values():
+            columnFile.flush()
+        self.writeHeader()
+        
+    def close(self):
+        """Closes the column files and writes the final header"""
+        
+        if all(columnFile.closed for columnFile in self.__files.values()):
+            return
+        for columnFile in self.__files.values():
+            columnFile.close()
+        self.writeHeader()
+        
+class RayFile:
+    """A class which reads a ray set lazily. Every column is a numpy.memmap, so rays can be sliced and filtered without reading the whole set into memory."""
+    
+    def __init__(self, path):
+        self.__path = path
+        with open(os.path.join(path, 'header.json')) as headerFile:
+            self.__header = json.load(headerFile)
+        if self.__header.get('format') != FORMAT:
+            raise Exception('%s is not a ray set' % path)
+        if self.__header['version'] > VERSION:
+            raise Exception('The ray set was written by a newer version (%d) of the format' % self.__header['version'])
+        self.__dtype = np.dtype(self.__header['dtype'])
+        self.__surfaces = self.__header['surfaces'] or 0
+        #The number of rays is taken from the status column, so that a ray set whose header was not updated after a crash can still be read
+        self.__rays = os.path.getsize(os.path.join(path, 'status'))
+        self.__columns = {}
+        
+    def __len__(self):
+        return self.__rays
+        
+    def header(self):
+        """Returns the header of the ray set"""
+        
+        return self.__header
+        
+    def dtype(self):
+        """Returns the dtype of the float columns"""
+        
+        return self.__dtype
+        
+    def surfaces(self):
+        """Returns the number of surfaces recorded for every ray"""
+        
+        return self.__surfaces
+        
+    def system(self):
+        """Returns the optical system that the rays were traced through"""
+        
+        return buildSystem(self.__header['system'])
+        
+    def column(self, name):
+        """Returns a column of the ray set as a read-only memory map, which is only opened the first time it is asked for"""
+        
+        if name not in self.__columns:
+            shapes = {'start': (3,), 'startDirection': (3,), 'intercepts': (self.__surfaces, 3), 'direction': (3,), 'status': ()}
+            dtype = np.dtype('int8') if name == 'status' else self.__dtype
+            shape = (self.__rays,) + shapes[name]
+            if self.__rays == 0 or 0 in shape:
+                self.__columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.__columns[name] = np.memmap(os.path.join(self.__path, name), dtype=dtype, mode='r', shape=shape)
+        return self.__columns[name]
+        
+    def start(self):
+        return self.column('start')
+        
+    def startDirections(self):
+        return self.column('startDirection')
+        
+    def intercepts(self):
+        return self.column('intercepts')
+        
+    def directions(self):
+        return self.column('direction')
+        
+    def status(self):
+        return self.column('status')
+        
+    def endpoints(self):
+        """Returns the final positions of the rays, as a memory map of the last intercept"""
+        
+        return self.column('intercepts')[:, -1]
+        
+    def alive(self, rows=slice(None)):
+        """Returns a boolean array which is True for every ray (of the given rows) that was not terminated"""
+        
+        return np.asarray(self.status()[rows]) == rt.ALIVE
+        
+    def aliveRows(self, chunksize=1000000):
+        """Returns the indices of the rays which were not terminated, reading the status column a chunk at a time"""
+        
+        rows = [np.flatnonzero(self.alive(slice(i, i + chunksize))) + i for i in range(0, self.__rays, chunksize)]
+        return np.concatenate(rows) if rows else np.zeros(0, dtype='int64')
+        
+    def chunks(self, chunksize=1000000, columns=('intercepts', 'status')):
+        """Yields dictionaries of the given columns for consecutive chunks of rays, as arrays read from the memory maps"""
+        
+        for i in range(0, self.__rays, chunksize):
+            yield dict((name, np.asarray(self.column(name)[i:i + chunksize])) for name in columns)
+            
+    def batch(self, rows=slice(None)):
+        """Reads the given rows (a slice, an index array or a boolean mask) into a RayBatch, which can be plotted or propagated further"""
+        
+        start = np.asarray(self.start()[rows])
+        vertices = np.concatenate((start[:, np.newaxis], np.asarray(self.intercepts()[rows])), axis=1)
+        return rt.RayBatch.fromArrays(vertices, self.startDirections()[rows], self.directions()[rows], self.status()[rows])
@@ -4,15 +4,256 @@ import numpy as np
 Optical Ray Tracer
 """
 
+#The status codes of the rays in a batch
+ALIVE = 0 #The ray is still being propagated
+MISSED = 1 #The ray missed a surface or fell outside its aperture
+REFLECTED = 2 #The ray was totally internally reflected
+
+#The amount of history that a batch records: 'none' keeps only the initial and current state of each ray,
+#'vertices' also keeps its position at every surface, and 'full' keeps its direction at every surface as well
+HISTORIES = ('none', 'vertices', 'full')
+
+#The working precision of a trace, as the dtypes of the positions and of the directions: 'mixed' keeps the positions in float64,
+#so the offsets from each surface vertex are exact, and does the rest of the arithmetic in float32
+PRECISIONS = {'float64': ('float64', 'float64'), 'float32': ('float32', 'float32'), 'mixed': ('float64', 'float32')}
+
+class RayBatch:
+    """A class which stores a collection of rays as contiguous (N,3) position and direction arrays, along with the status of every ray.
+    The history of the rays is kept in preallocated (N, vertices, 3) arrays, indexed by surface, of the chosen dtype."""
+    
+    def __init__(self, points, directions, history='vertices', dtype='float', capacity=1, precision='float64'):
+        points = np.array(points, dtype='float', ndmin=2)
+        directions = np.array(directions, dtype='float', ndmin=2)
+        
+        #An exception is raised if the position or direction vectors have more/less than 3 components
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise Exception('Your position vectors must have 3 components')
+            
+        if directions.ndim != 2 or directions.shape[1] != 3:
+            raise Exception('Your direction vectors must have 3 components')
+            
+        if history not in HISTORIES:
+            raise Exception('The history of a ray batch must be one of: %s' % ', '.join(HISTORIES))
+            
+        if precision not in PRECISIONS:
+            raise Exception('The precision of a ray batch must be one of: %s' % ', '.join(sorted(PRECISIONS)))
+            
+        norms = np.sqrt(np.einsum('ij,ij->i', directions, directions))
+        directions = directions / norms[:, np.newaxis] #The direction vectors are normalised once for the whole batch
+        if len(directions) == 1:
+            directions = np.repeat(directions, len(points), axis=0) #A single direction vector is normalised once, then shared by every ray in the batch
+        elif len(directions) != len(points):
+            raise Exception('You must give either one direction vector or one for each position vector')
+            
+        self.__history = history
+        self.__dtype = np.dtype(dtype)
+        self.__precision = precision
+        self.__pointType, self.__directionType = [np.dtype(name) for name in PRECISIONS[precision]]
+        self.__p = points.astype(self.__pointType, copy=False) #The current positions and directions of the rays, which are NaN once a ray has been terminated
+        self.__k = directions.astype(self.__directionType, copy=False) #They are replaced rather than written to by every append, so they can share the input arrays
+        self.__start = points.astype(self.__dtype) #The initial positions and directions are always kept, as a copy which stays independent of the current positions
+        self.__startDirections = directions
+        self.__status = np.zeros(len(points), dtype='int8')
+        self.__alive = np.ones(len(points), dtype='bool')
+        self.__lengths = np.ones(len(points), dtype='int32') #The number of vertices recorded for each ray before it was terminated
+        self.__count = 1 #The number of vertices recorded for the batch
+        self.__vertices = None
+        self.__directions = None
+        if history != 'none':
+            self.__vertices = np.empty((len(points), max(capacity, 1), 3), dtype=self.__dtype)
+            self.__vertices[:, 0] = points
+        if history == 'full':
+            self.__directions = np.empty((len(points), max(capacity, 1), 3), dtype=self.__dtype)
+            self.__directions[:, 0] = directions
+            
+    def __repr__(self):
+        """Returns a representation of the batch object along with its size"""
+        
+        return "%s(Rays = %d, Alive = %d, Vertices = %d)" % ("RayBatch", len(self), self.__alive.sum(), self.__count)
+        
+    def __len__(self):
+        return len(self.__alive)
+        
+    def __getitem__(self, index):
+        """Returns a Ray object which is a view onto a single ray in the batch"""
+        
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Ray index out of range')
+        return Ray.view(self, index)
+        
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Ray.view(self, index)
+            
+    def p(self):
+        """Returns the final positions of the rays as an (N,3) array"""
+        
+        return self.__p
+        
+    def k(self):
+        """Returns the final direction vectors of the rays as an (N,3) array"""
+        
+        return self.__k
+        
+    def alive(self):
+        """Returns a boolean array which is False for every ray that has been terminated"""
+        
+        return self.__alive
+        
+    def status(self):
+        """Returns the status code (ALIVE, MISSED or REFLECTED) of every ray"""
+        
+        return self.__status
+        
+    def lengths(self):
+        """Returns the number of vertices of every ray, up to the vertex before it was terminated"""
+        
+        return self.__lengths
+        
+    def history(self):
+        """Returns the history mode of the batch"""
+        
+        return self.__history
+        
+    def precision(self):
+        """Returns the working precision of the batch ('float64', 'float32' or 'mixed')"""
+        
+        return self.__precision
+        
+    def count(self):
+        """Returns the number of vertices recorded for the batch, including the initial positions"""
+        
+        return self.__count
+        
+    def reserve(self, vertices):
+        """Makes room in the history arrays for the given number of further vertices, so that a trace through a known number of surfaces never has to copy them"""
+        
+        if self.__vertices is None or self.__count + vertices <= self.__vertices.shape[1]:
+            return
+        capacity = self.__count + vertices
+        grown = np.empty((len(self), capacity, 3), dtype=self.__dtype)
+        grown[:, :self.__count] = self.__vertices[:, :self.__count]
+        self.__vertices = grown
+        if self.__directions is not None:
+            grown = np.empty((len(self), capacity, 3), dtype=self.__dtype)
+            grown[:, :self.__count] = self.__directions[:, :self.__count]
+            self.__directions = grown
+            
+    def append(self, points, directions, alive=None, status=MISSED):
+        """Appends new (N,3) arrays of positions and unit direction vectors to the batch.
+        Rays which are not alive are terminated: they are given the status code (a single code or an array of codes) and their current components become NaN."""
+        
+        points = np.array(points, dtype=self.__pointType)
+        directions = np.array(directions, dtype=self.__directionType)
+        if points.shape != (len(self), 3) or directions.shape != (len(self), 3):
+            raise Exception('Your position and direction arrays must have the shape (%d, 3)' % len(self))
+            
+        if alive is None:
+            alive = ~np.isnan(points[:, 0])
+        terminated = self.__alive & ~alive
+        self.__status[terminated] = np.broadcast_to(status, self.__status.shape)[terminated]
+        self.__alive = self.__alive & alive
+        dead = ~self.__alive
+        points[dead] = np.nan
+        directions[dead] = np.nan
+        self.__p = points
+        self.__k = directions
+        self.__lengths += self.__alive
+        
+        if self.__vertices is not None:
+            if self.__count == self.__vertices.shape[1]:
+                self.reserve(self.__count) #The history arrays double in size whenever they are full
+            self.__vertices[:, self.__count] = points
+            if self.__directions is not None:
+                self.__directions[:, self.__count] = directions
+        self.__count += 1
+        
+    def start(self):
+        """Returns the initial positions of the rays as an (N,3) array"""
+        
+        return self.__start
+        
+    def startDirections(self):
+        """Returns the initial direction vectors of the rays as an (N,3) array"""
+        
+        return self.__startDirections
+        
+    def vertices(self):
+        """Returns an (N, vertices, 3) array of the positions of the rays at every vertex. Without a recorded history, only the initial and final positions are given."""
+        
+        if self.__vertices is None:
+            return np.stack([self.__start, self.__p.astype(self.__dtype)], axis=1) if self.__count > 1 else self.__start[:, np.newaxis]
+        return self.__vertices[:, :self.__count]
+        
+    def directions(self):
+        """Returns an (N, vertices, 3) array of the directions of the rays at every vertex, which is only recorded with the 'full' history"""
+        
+        if self.__directions is None:
+            raise Exception("The directions of the rays are only recorded with the 'full' history")
+        return self.__directions[:, :self.__count]
+        
+    def rayVertices(self, index):
+        """Returns a (vertices, 3) array of the positions of a single ray up to the point where it was terminated, which is followed by a NaN vertex for a terminated ray"""
+        
+        vertices = self.vertices()[index]
+        length = min(self.__lengths[index], len(vertices))
+        if self.__alive[index]:
+            return vertices[:length]
+        return np.concatenate((vertices[:length], np.full((1, 3), np.nan, dtype=vertices.dtype)))
+        
+    def select(self, index):
+        """Returns a new batch which holds a copy of a single ray of this batch, including its history"""
+        
+        batch = RayBatch.__new__(RayBatch)
+        batch.__history = self.__history
+        batch.__dtype = self.__dtype
+        batch.__precision = self.__precision
+        batch.__pointType = self.__pointType
+        batch.__directionType = self.__directionType
+        batch.__p = self.__p[[index]].copy()
+        batch.__k = self.__k[[index]].copy()
+        batch.__start = self.__start[[index]].copy()
+        batch.__startDirections = self.__startDirections[[index]].copy()
+        batch.__status = self.__status[[index]].copy()
+        batch.__alive = self.__alive[[index]].copy()
+        batch.__lengths = self.__lengths[[index]].copy()
+        batch.__count = self.__count
+        batch.__vertices = None if self.__vertices is None else self.__vertices[[index]].copy()
+        batch.__directions = None if self.__directions is None else self.__directions[[index]].copy()
+        return batch
+        
+    @classmethod
+    def fromArrays(cls, vertices, startDirections, directions, status):
+        """Rebuilds a batch with the 'vertices' history from saved arrays: the (N, vertices, 3) positions, the initial and final (N,3) directions and the status codes.
+        The positions of a terminated ray must be NaN from the vertex at which it was terminated."""
+        
+        vertices = np.asarray(vertices)
+        status = np.array(status, dtype='int8')
+        batch = cls.__new__(cls)
+        batch.__history = 'vertices'
+        batch.__dtype = vertices.dtype
+        batch.__precision = 'float64'
+        batch.__pointType = batch.__directionType = np.dtype('float64')
+        batch.__alive = status == ALIVE
+        batch.__p = np.array(vertices[:, -1], dtype='float')
+        batch.__k = np.array(directions, dtype='float')
+        batch.__p[~batch.__alive] = np.nan
+        batch.__k[~batch.__alive] = np.nan
+        batch.__start = np.array(vertices[:, 0])
+        batch.__startDirections = np.array(startDirections, dtype='float')
+        batch.__status = status
+        batch.__lengths = np.count_nonzero(~np.isnan(vertices[:, :, 0]), axis=1).astype('int32')
+        batch.__count = vertices.shape[1]
+        batch.__vertices = np.array(vertices)
+        batch.__directions = None
+        return batch
+        
 class Ray:
     """A class which allows ray objects to be created with a position and direction vector"""
     
     def __init__(self, point, direction):
-        #The position and direction vectors are stored as numpy arrays in a list
-        self.__p = [np.array(point, dtype='float')]
-        self.__k = [np.array(direction, dtype='float') / \
-                    np.linalg.norm(np.array(direction, dtype='float'))] #The direction vector is normalised to a unit vector
-
         #An exception is raised if the position or direction vector has more/less than 3 components
         if len(point) != 3:
             raise Exception('Your position vector must have 3 components')
@@ -20,26 +261,49 @@ class Ray:
         if len(direction) != 3:
             raise Exception('Your direction vector must have 3 components')
             
+        #The ray is stored as a batch which contains a single ray
+        self.__batch = RayBatch([point], [direction])
+        self.__index = 0
+        
+    @classmethod
+    def view(cls, batch, index):
+        """Creates a ray object which reads its position and direction vectors from a row of a ray batch"""
+        
+        ray = cls.__new__(cls)
+        ray.__batch = batch
+        ray.__index = index
+        return ray
+        
     def __repr__(self):
         """Returns a representation of the ray object along with its parameters"""
         
-        return "%s(Point=[%g, %g, %g], Direction=[%g, %g, %g])" % ("Ray", self.__p[-1][0], self.__p[-1][1], self.__p[-1][2], self.__k[-1][0], self.__k[-1][1], self.__k[-1][2])
+        p, k = self.p(), self.k()
+        return "%s(Point=[%g, %g, %g], Direction=[%g, %g, %g])" % ("Ray", p[0], p[1], p[2], k[0], k[1], k[2])
 
     def __str__(self):
         """Prints the parameters of the ray object"""
         
-        return "(Point=[%g, %g, %g], Direction=[%g, %g, %g])" % (self.__p[-1][0], self.__p[-1][1], self.__p[-1][2], self.__k[-1][0], self.__k[-1][1], self.__k[-1][2])
+        p, k = self.p(), self.k()
+        return "(Point=[%g, %g, %g], Direction=[%g, %g, %g])" % (p[0], p[1], p[2], k[0], k[1], k[2])
         
         
     def p(self):
         """Returns the final position of the ray object"""
         
-        return self.__p[-1]
+        return self.__batch.p()[self.__index]
         
     def k(self):
         """Returns the final direction vector of the ray"""
         
-        return self.__k[-1]
+        return self.__batch.k()[self.__index]
+        
+    def batch(self):
+        """Returns the batch which holds this ray. If the ray is a view onto a larger batch, it is first copied into a batch of its own."""
+        
+        if len(self.__batch) != 1:
+            self.__batch = self.__batch.select(self.__index)
+            self.__index = 0
+        return self.__batch
         
     def append(self, p, k):
         """Appends a new position and direction vector to the ray object"""
@@ -50,23 +314,29 @@ class Ray:
         if len(k) != 3:
             raise Exception('Your direction vector must have 3 components')
         
-        self.__p.append(np.array(p, dtype='float'))
-        self.__k.append(np.array(k, dtype='float')/ \
-        np.linalg.norm(np.array(k, dtype='float'))) #The new direction vector must be normalised before it is appended
+        p = np.array(p, dtype='float')
+        k = np.array(k, dtype='float')/ \
+        np.linalg.norm(np.array(k, dtype='float')) #The new direction vector must be normalised before it is appended
+        self.batch().append(p[np.newaxis], k[np.newaxis])
         
     def vertices(self):
-        """Returns a list which contains all of the position vectors (as numpy arrays) along the ray"""
+        """Returns an array which contains all of the position vectors along the ray, read from the history of its batch"""
         
-        return self.__p
+        return self.__batch.rayVertices(self.__index)
         
 class Bundle:
     """A class which allows a collection of ray objects to be created with position and direction vectors"""
     
-    def __init__(self, n, rmax, m):
+    def __init__(self, n, rmax, m, sampling='rings', seed=None):
         self.n = n
         self.rmax = float(rmax)
         self.m = m
-        self.rays = [] #A list which contains all the ray objects in the bundle/beam
+        self.sampling = sampling #The layout of the rays across the beam: 'rings', 'hexagonal', 'square', 'fibonacci' or 'random'
+        self.seed = seed #The seed used for the 'random' sampling, so that the beam can be reproduced
+        self.rays = [] #The batch which contains all the rays in the bundle/beam
+        
+        if sampling not in self.samplings:
+            raise Exception('The beam sampling must be one of: %s' % ', '.join(sorted(self.samplings)))
         
     def rtuniform(self):
         """Generates the initial positions of the rays that are uniformly spaced in polar coordinates"""
@@ -82,14 +352,162 @@ class Bundle:
                     angle = angle + (2.0*np.pi)/(self.m*i)
                     yield radius, angle
                     
-    def getBundle(self, ray):
+    def size(self):
+        """Returns the number of rays in a concentric ring beam, 1 + m*n(n+1)/2"""
+        
+        return 1 + (self.m * self.n * (self.n + 1)) // 2
+        
+    def ringPoints(self):
+        """Returns an (N,3) array of the ray offsets across the beam, uniformly spaced in concentric rings.
+        This gives the same layout as rtuniform, calculated in closed form for all the rays at once."""
+        
+        rings = np.arange(1, self.n + 1)
+        counts = self.m * rings #Ring i contains m*i rays
+        ring = np.repeat(rings, counts)
+        step = np.arange(len(ring)) - np.repeat(np.cumsum(counts) - counts, counts) + 1 #The position of each ray around its ring, starting from 1
+        radius = np.concatenate(([0.0], (ring * self.rmax) / self.n))
+        angle = np.concatenate(([0.0], (2.0 * np.pi * step) / (self.m * ring)))
+        return self.polarPoints(radius, angle)
+        
+    def hexagonalPoints(self):
+        """Returns an (N,3) array of the ray offsets across the beam, placed on a hexagonal lattice with n points along each radius"""
+        
+        u, v = np.meshgrid(*self.latticeRange(True))
+        x, y = self.latticeXY(u.ravel(), v.ravel(), True)
+        return self.clipPoints(x, y)
+        
+    def squarePoints(self):
+        """Returns an (N,3) array of the ray offsets across the beam, placed on a square grid with n points along each radius"""
+        
+        u, v = np.meshgrid(*self.latticeRange(False))
+        x, y = self.latticeXY(u.ravel(), v.ravel(), False)
+        return self.clipPoints(x, y)
+        
+    def latticeRange(self, hexagonal):
+        """Returns the ranges of the lattice indices u and v which cover the beam, for the hexagonal or square lattice"""
+        
+        if not(hexagonal):
+            return np.arange(-self.n, self.n + 1), np.arange(-self.n, self.n + 1)
+        rows = int(np.ceil(2 * self.n / np.sqrt(3.0))) #Rows are sqrt(3)/2 spacings apart, so this many reach the edge of the beam
+        return np.arange(-self.n - rows, self.n + rows + 1), np.arange(-rows, rows + 1)
+        
+    def latticeXY(self, u, v, hexagonal):
+        """Returns the x and y offsets of the lattice points with indices u and v, for the hexagonal or square lattice"""
+        
+        spacing = self.rmax / self.n
+        if hexagonal:
+            return spacing * (u + 0.5 * v), spacing * (0.5 * np.sqrt(3.0) * v)
+        return spacing * u, spacing * v
+        
+    def fibonacciPoints(self):
+        """Returns an (N,3) array of the ray offsets across the beam, placed along a Fibonacci spiral so that each ray covers an equal area.
+        The beam contains the same number of rays as the concentric ring layout."""
+        
+        index = np.arange(self.size())
+        radius = self.rmax * np.sqrt(index / float(max(len(index) - 1, 1)))
+        angle = index * np.pi * (3.0 - np.sqrt(5.0)) #Successive rays are separated by the golden angle
+        return self.polarPoints(radius, angle)
+        
+    def randomPoints(self):
+        """Returns an (N,3) array of the ray offsets across the beam, drawn uniformly over the beam area using the seed of the bundle.
+        The first ray is always the central ray, and the beam contains the same number of rays as the concentric ring layout."""
+        
+        random = np.random.RandomState(self.seed)
+        count = self.size() - 1
+        radius = self.rmax * np.sqrt(random.uniform(0.0, 1.0, count)) #Taking the square root makes the density of rays uniform over the area
+        angle = random.uniform(0.0, 2.0 * np.pi, count)
+        return self.polarPoints(np.concatenate(([0.0], radius)), np.concatenate(([0.0], angle)))
+        
+    def polarPoints(self, radius, angle):
+        """Converts arrays of radii and angles into an (N,3) array of offsets in the plane of the beam"""
+        
+        points = np.zeros((len(radius), 3), dtype='float')
+        points[:, 0] = radius * np.cos(angle)
+        points[:, 1] = radius * np.sin(angle)
+        return points
+        
+    def clipPoints(self, x, y):
+        """Keeps only the lattice points that lie within the beam radius, ordered by their distance from the centre so that the central ray comes first"""
+        
+        radiusSquare = x**2 + y**2
+        order = np.argsort(radiusSquare, kind='mergesort')
+        order = order[radiusSquare[order] <= (self.rmax)**2 * (1 + 1e-9)]
+        points = np.zeros((len(order), 3), dtype='float')
+        points[:, 0] = x[order]
+        points[:, 1] = y[order]
+        return points
+        
+    def pointBlocks(self, size):
+        """Yields the ray offsets across the beam as (N,3) arrays of about size rays each, in the same order as points(), without generating the whole beam.
+        Concentric rings are generated ring by ring, the Fibonacci spiral in blocks of its index, and the lattices in annuli of equal area, each holding about
+        size lattice points. The 'random' sampling is drawn in full."""
+        
+        if self.sampling == 'rings':
+            yield np.zeros((1, 3), dtype='float')
+            for i in range(1, self.n + 1):
+                ring = np.full(self.m * i, i)
+                step = np.arange(1, self.m * i + 1)
+                yield self.polarPoints((ring * self.rmax) / self.n, (2.0 * np.pi * step) / (self.m * ring))
+        elif self.sampling == 'fibonacci':
+            count = self.size()
+            for start in range(0, count, size):
+                index = np.arange(start, min(start + size, count))
+                yield self.polarPoints(self.rmax * np.sqrt(index / float(max(count - 1, 1))), index * np.pi * (3.0 - np.sqrt(5.0)))
+        elif self.sampling in ('hexagonal', 'square'):
+            hexagonal = self.sampling == 'hexagonal'
+            uRange, vRange = self.latticeRange(hexagonal)
+            spacing = self.rmax / self.n
+            limit = (self.rmax)**2 * (1 + 1e-9)
+            estimate = np.pi * self.n**2 * (2 / np.sqrt(3.0) if hexagonal else 1.0) #The number of lattice points in the beam
+            bands = max(int(np.ceil(estimate / size)), 1)
+            shear = 0.5 if hexagonal else 0.0 #The u index of the point at x = 0 in row v is -shear*v
+            for band in range(bands):
+                inner, outer = limit * band / bands, limit * (band + 1) / bands
+                v = vRange
+                y = self.latticeXY(np.zeros(len(v)), v, hexagonal)[1]
+                v = v[y**2 <= outer]
+                y = y[y**2 <= outer]
+                #In each row the annulus covers |x| from sqrt(inner - y^2) to sqrt(outer - y^2), taken one index wider on every side and trimmed exactly below
+                xOuter = np.sqrt(outer - y**2) / spacing
+                xInner = np.sqrt(np.maximum(inner - y**2, 0.0)) / spacing
+                segments = []
+                for row, xo, xi in zip(v, xOuter, xInner):
+                    first = max(int(np.floor(-xo - shear * row)) - 1, uRange[0])
+                    last = min(int(np.ceil(xo - shear * row)) + 1, uRange[-1])
+                    gapFirst, gapLast = int(np.ceil(-xi - shear * row)) + 1, int(np.floor(xi - shear * row)) - 1
+                    if gapFirst > gapLast:
+                        segments.append((row, np.arange(first, last + 1)))
+                    else:
+                        segments.append((row, np.concatenate((np.arange(first, gapFirst), np.arange(gapLast + 1, last + 1)))))
+                u = np.concatenate([columns for row, columns in segments]) if segments else np.zeros(0, dtype='int64')
+                v = np.concatenate([np.full(len(columns), row) for row, columns in segments]) if segments else np.zeros(0, dtype='int64')
+                x, y = self.latticeXY(u, v, hexagonal)
+                radiusSquare = x**2 + y**2
+                keep = (radiusSquare >= inner) & ((radiusSquare < outer) if band < bands - 1 else (radiusSquare <= outer))
+                order = np.lexsort((u[keep], v[keep], radiusSquare[keep])) #The same order as clipPoints, by radius and then by row and column
+                points = np.zeros((len(order), 3), dtype='float')
+                points[:, 0] = x[keep][order]
+                points[:, 1] = y[keep][order]
+                yield points
+        else:
+            yield self.samplings[self.sampling](self)
+            
+    samplings = {'rings': ringPoints, 'hexagonal': hexagonalPoints, 'square': squarePoints, 'fibonacci': fibonacciPoints, 'random': randomPoints}
+    
+    def points(self, centre=(0, 0, 0)):
+        """Returns an (N,3) array of the initial positions of all the rays in the beam, centred around the given point"""
+        
+        return self.samplings[self.sampling](self) + np.array(centre, dtype='float')
+        
+    def stackPoints(self, centres):
+        """Returns an (F,N,3) array of the initial positions of F beams at once, each centred around one of an (F,3) array of points"""
+        
+        centres = np.array(centres, dtype='float', ndmin=2)
+        return self.samplings[self.sampling](self)[np.newaxis] + centres[:, np.newaxis, :]
+        
+    def getBundle(self, ray, history='vertices', dtype='float'):
         """Creates a beam of rays which have the same direction as the ray input into this function.
-        The beam is also centred around this initial ray."""
-        
-        rayPosition = ray.p()
-        rayDirection = ray.k()
-        for r, t in self.rtuniform():
-            point = [(r * np.cos(t)) + rayPosition[0], (r * np.sin(t)) + rayPosition[1], rayPosition[2]]
-            ray = Ray(point, rayDirection)
-            self.rays.append(ray)
-        return self.rays #Returns the list of rays once they have all been created
\ No newline at end of file
+        The beam is also centred around this initial ray. The history and dtype set how much of the path of the rays is recorded, and at what precision."""
+        
+        self.rays = RayBatch(self.points(ray.p()), ray.k(), history, dtype) #The rays are stored in a single batch, and each ray in it can be accessed as a Ray object
+        return self.rays #Returns the batch of rays once they have all been created
@@ -0,0 +1,179 @@
+import numpy as np
+
+"""
+Spot statistics of the rays at the output plane, calculated on (N,3) arrays of ray end points
+"""
+
+def spotStatistics(points, alive=None, chief=0, fractions=(0.5, 0.8, 0.9)):
+    """Calculates the statistics of the spot formed by an (N,3) array of ray end points in a single pass.
+    Terminated rays, given by the alive mask (or by NaN end points if no mask is given), are left out of every statistic apart from the vignetting.
+    The spot is measured about the chief ray, the ray at index chief, unless it has been terminated, in which case the centroid is used instead.
+    Returns a dictionary of the RMS spot radius about the chief ray and about the centroid, the geometric (maximum) spot radius,
+    the radii which encircle each of the given fractions of the rays, and the fraction of rays which have been vignetted."""
+    
+    points = np.asarray(points, dtype='float')
+    if alive is None:
+        alive = ~np.isnan(points[:, 0])
+    alive = np.asarray(alive, dtype='bool')
+    xy = points[alive, :2]
+    statistics = {'rays': len(points), 'alive': len(xy), 'vignetting': 1.0 - len(xy) / float(len(points)) if len(points) > 0 else 0.0}
+    if len(xy) == 0:
+        #If every ray has been terminated there is no spot to measure
+        statistics.update({'chief': np.array([np.nan, np.nan]), 'centroid': np.array([np.nan, np.nan]), 'rms': np.nan, 'rmsCentroid': np.nan, 'maxRadius': np.nan,
+                           'encircled': dict((fraction, np.nan) for fraction in fractions)})
+        return statistics
+        
+    centroid = xy.mean(axis=0)
+    centre = points[chief, :2] if alive[chief] else centroid #The spot is measured about the chief ray, as long as it reaches the output
+    offset = xy - centre
+    radiusSquare = np.einsum('ij,ij->i', offset, offset)
+    meanRadiusSquare = radiusSquare.mean()
+    shift = centroid - centre
+    statistics['chief'] = centre
+    statistics['centroid'] = centroid
+    statistics['rms'] = np.sqrt(meanRadiusSquare)
+    statistics['rmsCentroid'] = np.sqrt(max(meanRadiusSquare - np.dot(shift, shift), 0.0)) #The mean square radius about the centroid follows from the one about the chief ray
+    statistics['maxRadius'] = np.sqrt(radiusSquare.max())
+    statistics['encircled'] = encircledRadii(radiusSquare, fractions)
+    return statistics
+    
+def encircledRadii(radiusSquare, fractions):
+    """Returns a dictionary of the smallest radii which encircle each of the given fractions of the rays, given their squared radii"""
+    
+    radiusSquare = np.sort(radiusSquare)
+    radii = {}
+    for fraction in fractions:
+        index = min(max(int(np.ceil(fraction * len(radiusSquare))) - 1, 0), len(radiusSquare) - 1)
+        radii[fraction] = np.sqrt(radiusSquare[index])
+    return radii
+    
+class SpotAccumulator:
+    """A class which accumulates spot statistics over chunks of ray end points, so that very large numbers of rays never have to be held in memory at once.
+    The mean and spread of the spot are combined between chunks using Welford's (parallel) update, and the encircled energy is estimated from a radial histogram."""
+    
+    def __init__(self, chief=None, rmax=None, bins=1000, fractions=(0.5, 0.8, 0.9)):
+        #If the chief ray position is not given, it is taken from the first ray of the first chunk (or that chunk's centroid if the first ray was terminated)
+        self.__chief = None if chief is None else np.array(chief, dtype='float')[:2]
+        self.__rays = 0
+        self.__count = 0
+        self.__mean = np.zeros(2)
+        self.__m2 = 0.0 #The sum of the squared distances from the running mean
+        self.__radiusMean = 0.0 #The running mean of the squared radii about the chief ray, and the sum of their squared deviations, which give the error on the RMS
+        self.__radiusM2 = 0.0
+        self.__maxRadiusSquare = 0.0
+        self.__fractions = fractions
+        self.__edges = None
+        if rmax is not None:
+            self.__edges = np.linspace(0.0, float(rmax), bins + 1) #The radial bins about the chief ray used for the encircled energy
+            self.__histogram = np.zeros(bins, dtype='int64')
+            
+    def add(self, points, alive=None):
+        """Adds a chunk of (N,3) ray end points to the statistics"""
+        
+        points = np.asarray(points, dtype='float')
+        if alive is None:
+            alive = ~np.isnan(points[:, 0])
+        alive = np.asarray(alive, dtype='bool')
+        xy = points[alive, :2]
+        self.__rays += len(points)
+        if len(xy) == 0:
+            return self
+        if self.__chief is None:
+            self.__chief = points[0, :2].copy() if alive[0] else xy.mean(axis=0)
+            
+        count = len(xy)
+        mean = xy.mean(axis=0)
+        offset = xy - mean
+        m2 = np.einsum('ij,ij->', offset, offset)
+        chiefOffset = xy - self.__chief
+        radiusSquare = np.einsum('ij,ij->i', chiefOffset, chiefOffset)
+        radiusMean = radiusSquare.mean()
+        self.__combine(count, mean, m2, radiusMean, np.dot(radiusSquare - radiusMean, radiusSquare - radiusMean))
+        
+        self.__maxRadiusSquare = max(self.__maxRadiusSquare, radiusSquare.max())
+        if self.__edges is not None:
+            self.__histogram += np.histogram(np.sqrt(radiusSquare), self.__edges)[0]
+        return self
+        
+    def __combine(self, count, mean, m2, radiusMean, radiusM2):
+        """Combines the count, means and squared deviations of a new set of points with the running totals"""
+        
+        total = self.__count + count
+        weight = self.__count * count / float(total)
+        delta = mean - self.__mean
+        self.__mean = self.__mean + delta * (count / float(total))
+        self.__m2 = self.__m2 + m2 + np.dot(delta, delta) * weight
+        radiusDelta = radiusMean - self.__radiusMean
+        self.__radiusMean = self.__radiusMean + radiusDelta * (count / float(total))
+        self.__radiusM2 = self.__radiusM2 + radiusM2 + radiusDelta**2 * weight
+        self.__count = total
+        
+    def merge(self, other):
+        """Merges the statistics gathered by another accumulator, for example one which was filled by a separate process, into this one.
+        Both accumulators must measure the spot about the same chief ray position, and have the same radial bins."""
+        
+        state = other.state()
+        if self.__chief is not None and state['chief'] is not None and not(np.array_equal(self.__chief, state['chief'])):
+            raise Exception('Only accumulators with the same chief ray position can be merged')
+        edges = state['edges']
+        if (self.__edges is None) != (edges is None) or (edges is not None and not(np.array_equal(self.__edges, edges))):
+            raise Exception('Only accumulators with the same radial bins can be merged')
+        self.__rays += state['rays']
+        if state['count'] == 0:
+            return self
+        if self.__chief is None:
+            self.__chief = state['chief']
+        self.__combine(state['count'], state['mean'], state['m2'], state['radiusMean'], state['radiusM2'])
+        self.__maxRadiusSquare = max(self.__maxRadiusSquare, state['maxRadiusSquare'])
+        if self.__edges is not None:
+            self.__histogram += state['histogram']
+        return self
+        
+    def state(self):
+        """Returns the running totals of the accumulator"""
+        
+        return {'rays': self.__rays, 'count': self.__count, 'mean': self.__mean, 'm2': self.__m2, 'radiusMean': self.__radiusMean, 'radiusM2': self.__radiusM2,
+                'chief': self.__chief, 'maxRadiusSquare': self.__maxRadiusSquare, 'edges': self.__edges,
+                'histogram': self.__histogram if self.__edges is not None else None}
+        
+    def rms(self):
+        """Returns the RMS spot radius about the chief ray of the rays added so far"""
+        
+        if self.__count == 0:
+            return np.nan
+        return np.sqrt(self.__radiusMean)
+        
+    def rmsError(self):
+        """Returns the standard error on the RMS spot radius, estimated from the spread of the squared radii of the rays added so far"""
+        
+        if self.__count < 2 or self.__radiusMean == 0:
+            return np.inf if self.__count < 2 else 0.0
+        meanError = np.sqrt(self.__radiusM2 / (self.__count - 1) / self.__count) #The standard error on the mean squared radius
+        return meanError / (2 * np.sqrt(self.__radiusMean))
+        
+    def result(self):
+        """Returns the statistics of the accumulator, so that it can be used as a reducer of a streamed trace"""
+        
+        return self.statistics()
+        
+    def statistics(self):
+        """Returns the same dictionary of statistics as spotStatistics, for all the rays added so far.
+        The encircled radii are only measured if a maximum radius was set for the histogram, and are accurate to the width of one bin. Otherwise they are NaN."""
+        
+        statistics = {'rays': self.__rays, 'alive': self.__count, 'vignetting': 1.0 - self.__count / float(self.__rays) if self.__rays > 0 else 0.0}
+        if self.__count == 0:
+            statistics.update({'chief': np.array([np.nan, np.nan]), 'centroid': np.array([np.nan, np.nan]), 'rms': np.nan, 'rmsCentroid': np.nan, 'maxRadius': np.nan,
+                               'encircled': dict((fraction, np.nan) for fraction in self.__fractions)})
+            return statistics
+        statistics['chief'] = self.__chief
+        statistics['centroid'] = self.__mean
+        statistics['rms'] = self.rms()
+        statistics['rmsCentroid'] = np.sqrt(self.__m2 / self.__count)
+        statistics['maxRadius'] = np.sqrt(self.__maxRadiusSquare)
+        statistics['encircled'] = dict((fraction, np.nan) for fraction in self.__fractions)
+        if self.__edges is not None:
+            cumulative = np.cumsum(self.__histogram)
+            for fraction in self.__fractions:
+                index = np.searchsorted(cumulative, fraction * self.__count) #The first bin which contains the required fraction of the rays
+                statistics['encircled'][fraction] = self.__edges[index + 1] if index < len(cumulative) else np.inf
+        return statistics
@@ -0,0 +1,160 @@
+import time
+import numpy as np
+import optics2 as op
+import spots
+
+"""
+Streamed tracing, which pushes a beam through a lens system in fixed-size chunks so that the memory used depends on the chunk size rather than the number of rays
+"""
+
+def bundleChunks(bundle, chunksize, centre=(0, 0, 0), total=None):
+    """Returns an iterable of the initial positions of the rays of a bundle as (chunksize,3) arrays (see BundleChunks)"""
+    
+    return BundleChunks(bundle, chunksize, centre, total)
+    
+class BundleChunks:
+    """An iterable of the initial positions of the rays of a bundle as (chunksize,3) arrays, which records whether the chunks are independent random samples of the pupil.
+    A bundle with 'random' sampling is drawn chunk by chunk from its seed, indefinitely or until total rays have been yielded, so it never has to be held in memory.
+    The other samplings are generated a ring, block or annulus at a time by Bundle.pointBlocks, in the same order as Bundle.points, and regrouped into chunks.
+    Those beams run from the centre of the pupil outwards, so a chunk of them is not a fair sample of the whole pupil."""
+    
+    def __init__(self, bundle, chunksize, centre=(0, 0, 0), total=None):
+        self.__bundle = bundle
+        self.__chunksize = int(chunksize)
+        self.__centre = centre
+        self.__total = total
+        self.independent = bundle.sampling == 'random'
+        
+    def __iter__(self):
+        return generateChunks(self.__bundle, self.__chunksize, self.__centre, self.__total)
+        
+def generateChunks(bundle, chunksize, centre=(0, 0, 0), total=None):
+    """Yields the chunks of a BundleChunks"""
+    
+    centre = np.array(centre, dtype='float')
+    if bundle.sampling != 'random':
+        remaining = np.inf if total is None else total
+        pending, count = [], 0
+        for block in bundle.pointBlocks(chunksize):
+            pending.append(block + centre)
+            count += len(block)
+            if count < chunksize:
+                continue
+            points = np.concatenate(pending)
+            start = 0
+            while len(points) - start >= chunksize and remaining > 0:
+                size = int(min(chunksize, remaining))
+                yield points[start:start + size]
+                remaining -= size
+                start += chunksize
+            if remaining <= 0:
+                return
+            pending, count = [points[start:]], len(points) - start
+        if count > 0 and remaining > 0:
+            yield np.concatenate(pending)[:int(min(count, remaining))]
+        return
+        
+    random = np.random.RandomState(bundle.seed)
+    count = 0
+    first = True
+    while total is None or count < total:
+        size = chunksize if total is None else min(chunksize, total - count)
+        radius = bundle.rmax * np.sqrt(random.uniform(0.0, 1.0, size)) #Taking the square root makes the density of rays uniform over the area
+        angle = random.uniform(0.0, 2.0 * np.pi, size)
+        if first:
+            radius[0] = 0.0 #The first ray of the stream is the central (chief) ray
+            first = False
+        points = np.zeros((size, 3), dtype='float')
+        points[:, 0] = radius * np.cos(angle)
+        points[:, 1] = radius * np.sin(angle)
+        count += size
+        yield points + centre
+        
+class SpotHistogram:
+    """A reducer which counts the end points of the rays in a fixed 2D grid of bins across the output plane"""
+    
+    def __init__(self, extent, bins=256):
+        #The extent is (xmin, xmax, ymin, ymax) of the grid
+        self.__xedges = np.linspace(extent[0], extent[1], bins + 1)
+        self.__yedges = np.linspace(extent[2], extent[3], bins + 1)
+        self.__counts = np.zeros((bins, bins), dtype='int64')
+        
+    def add(self, points, alive):
+        """Adds the end points of the rays in a chunk to the histogram"""
+        
+        points = points[alive]
+        self.__counts += np.histogram2d(points[:, 0], points[:, 1], [self.__xedges, self.__yedges])[0].astype('int64')
+        return self
+        
+    def result(self):
+        """Returns the counts in each bin, along with the bin edges in x and y"""
+        
+        return {'counts': self.__counts, 'xedges': self.__xedges, 'yedges': self.__yedges}
+        
+class EndpointWriter:
+    """A reducer which writes the end points of the rays to a binary file of float64 x, y, z values, one row per ray.
+    The file is overwritten, unless append is True, in which case the rows are added after those already in it."""
+    
+    def __init__(self, filename, aliveOnly=True, append=False):
+        self.__filename = filename
+        self.__aliveOnly = aliveOnly #Terminated rays are only written (as NaN rows) if aliveOnly is False
+        self.__file = open(filename, 'ab' if append else 'wb')
+        self.__rows = 0
+        
+    def add(self, points, alive):
+        """Writes the end points of the rays in a chunk to the file"""
+        
+        if self.__aliveOnly:
+            points = points[alive]
+        np.ascontiguousarray(points, dtype='float64').tofile(self.__file)
+        self.__rows += len(points)
+        return self
+        
+    def result(self):
+        """Closes the file and returns its name along with the number of rows written"""
+        
+        if not(self.__file.closed):
+            self.__file.close()
+        return {'filename': self.__filename, 'rows': self.__rows}
+        
+class StreamTracer:
+    """A class which traces chunks of rays through a lens system and feeds the end points of every chunk to a set of reducers"""
+    
+    def __init__(self, system, direction=(0, 0, 1)):
+        if not(isinstance(system, op.OpticalSystem)):
+            system = op.OpticalSystem(system)
+        self.__system = system
+        self.__direction = np.array(direction, dtype='float')
+        
+    def run(self, chunks, reducers=(), tolerance=None, minimumRays=10000, history='none'):
+        """Traces every chunk of initial positions through the system with the given ray history, and passes the end points to each reducer's add method
+        (or the whole batch to its addBatch method, if it has one, as for rayfile.RayFileWriter).
+        The RMS spot radius is always accumulated. If a tolerance is given, the trace stops early once the standard error on the RMS falls below it (after at least minimumRays rays).
+        The standard error treats the rays as independent random samples of the pupil, so a tolerance is refused for chunks which say they are not (see BundleChunks).
+        Returns a report of the rays traced, the throughput in rays per second, whether the trace stopped early, and the spot statistics."""
+        
+        if tolerance is not None and not(getattr(chunks, 'independent', True)):
+            raise Exception("An early stop needs chunks which are independent random samples of the pupil, so a tolerance can only be given for a bundle with 'random' sampling")
+        accumulator = spots.SpotAccumulator()
+        reducers = list(reducers)
+        rays = 0
+        chunkCount = 0
+        stopped = False
+        began = time.time()
+        for points in chunks:
+            batch = self.__system.trace(points, self.__direction, history=history)
+            accumulator.add(batch.p(), batch.alive())
+            for reducer in reducers:
+                if hasattr(reducer, 'addBatch'):
+                    reducer.addBatch(batch)
+                else:
+                    reducer.add(batch.p(), batch.alive())
+            rays += len(points)
+            chunkCount += 1
+            if tolerance is not None and rays >= minimumRays and accumulator.rmsError() <= tolerance:
+                stopped = True #The RMS spot radius is known well enough, so the rest of the stream is not traced
+                break
+        elapsed = time.time() - began
+        return {'rays': rays, 'chunks': chunkCount, 'seconds': elapsed, 'raysPerSecond': rays / elapsed if elapsed > 0 else np.inf,
+                'stoppedEarly': stopped, 'rmsError': accumulator.rmsError(), 'statistics': accumulator.statistics(),
+                'results': [reducer.result() for reducer in reducers]}
@@ -0,0 +1,213 @@
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+import raytracer as rt
+import optics2 as op
+import spots
+import glass as gl
+import paraxial as px
+
+"""
+Design-space sweeps, which trace a lens design for every point of a parameter grid on a pool of worker processes
+"""
+
+#The metrics calculated for every point of a sweep, in the order they appear in the results
+METRICS = ['rms', 'rmsCentroid', 'paraxialFocus', 'focalLength', 'diffractionLimit', 'vignetting']
+
+def lensParameters(lens):
+    """Returns a dictionary of the constructor arguments of a SphericalRefraction lens, including the conic constant and coefficients of an AsphericRefraction lens"""
+    
+    n1, n2 = lens.getIndices()
+    parameters = {'z0': lens.getz0(), 'aperture': lens.getAperture(), 'curvature': lens.getCurvature(), 'n1': n1, 'n2': n2}
+    if isinstance(lens, op.AsphericRefraction):
+        parameters.update({'conic': lens.getConic(), 'coefficients': lens.getCoefficients()})
+    return parameters
+    
+def buildLens(lens):
+    """Builds a lens from a dictionary of its arguments, which is aspheric if it has a conic constant or coefficients"""
+    
+    if 'conic' in lens or 'coefficients' in lens:
+        return op.AsphericRefraction(lens['z0'], lens['aperture'], lens['curvature'], lens['n1'], lens['n2'], lens.get('conic', 0.0), lens.get('coefficients', ()))
+    return op.SphericalRefraction(lens['z0'], lens['aperture'], lens['curvature'], lens['n1'], lens['n2'])
+    
+def design(lenses, n=10, rmax=5, m=10, sampling='rings', output=None, wavelength=gl.REFERENCE):
+    """Creates the base design of a sweep from a list of lenses (SphericalRefraction objects or dictionaries of their arguments) and the bundle settings.
+    If output is None, the output plane is placed at the paraxial focus of each design. The units are mm, so the default wavelength is 588nm."""
+    
+    return {'lenses': [lensParameters(lens) if isinstance(lens, op.SphericalRefraction) else dict(lens) for lens in lenses],
+            'bundle': {'n': n, 'rmax': rmax, 'm': m, 'sampling': sampling}, 'output': output, 'wavelength': wavelength}
+    
+def gridPoints(grid):
+    """Expands a parameter grid into a list of points. The grid is either a dictionary of parameter names and lists of values, which is expanded into
+    every combination of them, or a list of dictionaries which each give one point.
+    Parameters are named 'lens1.curvature' (lenses are counted from 1, with any SphericalRefraction argument or the conic of an aspheric lens), 'bundle.rmax' (n, rmax, m or sampling), 'output' or 'wavelength'."""
+    
+    if isinstance(grid, dict):
+        names = sorted(grid)
+        return [dict(zip(names, values)) for values in itertools.product(*[np.atleast_1d(grid[name]).tolist() for name in names])]
+    return [dict(point) for point in grid]
+    
+def applyPoint(base, point):
+    """Returns a copy of the base design with the parameters of a grid point substituted in"""
+    
+    lenses = [dict(lens) for lens in base['lenses']]
+    settings = {'bundle': dict(base['bundle']), 'output': base['output'], 'wavelength': base['wavelength']}
+    for name, value in point.items():
+        if name.startswith('lens'):
+            lens, argument = name[4:].split('.')
+            lenses[int(lens) - 1][argument] = value
+        elif name.startswith('bundle.'):
+            settings['bundle'][name[7:]] = value
+        elif name in ('output', 'wavelength'):
+            settings[name] = value
+        else:
+            raise Exception('Unknown sweep parameter: %s' % name)
+    settings['lenses'] = lenses
+    return settings
+    
+def evaluate(base, point):
+    """Builds and traces the design for a single grid point, and returns its metrics"""
+    
+    settings = applyPoint(base, point)
+    lenses = [buildLens(lens) for lens in settings['lenses']]
+    system = op.OpticalSystem(lenses)
+    paraxialFocus = px.paraxialFocus(system) #The first-order properties come from the ray transfer matrices, without tracing a paraxial ray
+    focalLength = px.systemProperties(system)['focalLength'] if len(lenses) > 0 else None
+    output = settings['output'] if settings['output'] is not None else paraxialFocus
+    metrics = dict((name, np.nan) for name in METRICS)
+    metrics['paraxialFocus'] = np.nan if paraxialFocus is None else paraxialFocus
+    metrics['focalLength'] = np.nan if focalLength is None or not(np.isfinite(focalLength)) else focalLength
+    if output is None:
+        return metrics #Without a paraxial focus or a given output plane there is nowhere to measure the spot
+        
+    bundle = settings['bundle']
+    start = min(0.0, lenses[0].getz0()) if len(lenses) > 0 else 0.0
+    rays = rt.Bundle(int(bundle['n']), bundle['rmax'], int(bundle['m']), bundle.get('sampling', 'rings')).getBundle(rt.Ray([0, 0, start], [0, 0, 1]))
+    op.OpticalSystem(lenses + [op.OutputPlane(output)]).propagateBatch(rays)
+    statistics = spots.spotStatistics(rays.p(), rays.alive())
+    metrics['rms'] = statistics['rms']
+    metrics['rmsCentroid'] = statistics['rmsCentroid']
+    metrics['vignetting'] = statistics['vignetting']
+    metrics['diffractionLimit'] = metrics['focalLength'] * settings['wavelength'] / (2 * float(bundle['rmax'])) #The diffraction scale for the diameter of the beam
+    return metrics
+    
+def evaluateChunk(base, chunk):
+    """Evaluates a chunk of (index, point) pairs, returning a list of result records"""
+    
+    records = []
+    for index, point in chunk:
+        record = {'index': index}
+        record.update(point)
+        record.update(evaluate(base, point))
+        records.append(record)
+    return records
+    
+class Sweep:
+    """A class which sweeps a lens design over a grid of parameters, tracing every point on a pool of worker processes"""
+    
+    def __init__(self, base):
+        self.__base = base
+        
+    def run(self, grid, workers=None, chunksize=16, ordered=True, results=None):
+        """Traces the design at every point of the grid and returns a structured array with a row of parameters and metrics for each point.
+        workers is the number of processes (None uses every core, and 0 or 1 runs in this process), and the points are scheduled in chunks of chunksize.
+        If ordered is True the rows follow the order of the grid, otherwise they are in the order they were finished.
+        If a results file is given, every finished row is appended to it as a line of JSON, and points which are already in the file are not traced again.
+        The first line of the file is a header holding a hash of the design and the grid points, and a file written for a different design or grid is refused."""
+        
+        if int(chunksize) < 1:
+            raise Exception('The chunksize of a sweep must be at least 1, not %s' % chunksize)
+        chunksize = int(chunksize)
+        points = gridPoints(grid)
+        signature = self.signature(points)
+        records, headed = self.__load(results, len(points), signature)
+        done = set(record['index'] for record in records)
+        pending = [(index, point) for index, point in enumerate(points) if index not in done]
+        chunks = [pending[i:i + chunksize] for i in range(0, len(pending), chunksize)]
+        
+        output = None
+        if results is not None:
+            output = open(results, 'a')
+            if output.tell() > 0 and not(self.__endsWithNewline(results)):
+                output.write('\n') #A partly written final line is closed off so that it does not run into the new records
+            if not(headed):
+                output.write(json.dumps({'header': {'signature': signature, 'points': len(points)}}) + '\n')
+        try:
+            if workers is not None and workers <= 1:
+                for chunk in chunks:
+                    records.extend(self.__save(output, evaluateChunk(self.__base, chunk)))
+            else:
+                import concurrent.futures
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(evaluateChunk, self.__base, chunk) for chunk in chunks]
+                    for future in concurrent.futures.as_completed(futures):
+                        records.extend(self.__save(output, future.result()))
+        finally:
+            if output is not None:
+                output.close()
+                
+        if ordered:
+            records.sort(key=lambda record: record['index'])
+        return self.__toArray(records, points)
+        
+    def signature(self, points):
+        """Returns a hash of the base design and the grid points, which identifies the sweep that a results file was written for"""
+        
+        convert = lambda value: value.tolist() if isinstance(value, (np.generic, np.ndarray)) else str(value)
+        text = json.dumps({'design': self.__base, 'points': points}, sort_keys=True, default=convert)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+        
+    def __load(self, results, count, signature):
+        """Reads the records which have already been written to a results file, after checking that its header matches the signature of this sweep.
+        Returns the records and whether the file has a header. A partly written final line is ignored."""
+        
+        records = []
+        if results is None or not(os.path.exists(results)):
+            return records, False
+        with open(results) as resultsFile:
+            header = None
+            for line in resultsFile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if header is None:
+                    header = record.get('header', {})
+                    if header.get('signature') != signature:
+                        raise Exception('The results file %s was written for a different design or grid, so the sweep cannot be resumed from it' % results)
+                    continue
+                if record.get('index', count) < count:
+                    records.append(record)
+        return records, header is not None
+        
+    def __endsWithNewline(self, results):
+        """Checks whether the last line of a results file was written completely"""
+        
+        with open(results, 'rb') as resultsFile:
+            resultsFile.seek(-1, os.SEEK_END)
+            return resultsFile.read(1) == b'\n'
+            
+    def __save(self, output, records):
+        """Appends records to the results file, if there is one, and returns them"""
+        
+        if output is not None:
+            for record in records:
+                output.write(json.dumps(dict((name, value.item() if isinstance(value, np.generic) else value) for name, value in record.items())) + '\n')
+            output.flush()
+        return records
+        
+    def __toArray(self, records, points):
+        """Converts a list of records into a structured array, with a column for the index, every swept parameter and every metric"""
+        
+        names = sorted(set(name for point in points for name in point))
+        fields = [('index', 'int64')]
+        for name in names:
+            values = [point[name] for point in points if name in point]
+            fields.append((name, 'U32' if any(isinstance(value, str) for value in values) else 'float'))
+        fields.extend([(name, 'float') for name in METRICS])
+        array = np.zeros(len(records), dtype=fields)
+        for row, record in enumerate(records):
+            array[row] = tuple(record.get(name, np.nan) for name, dtype in fields)
+        return array
@@ -0,0 +1,16 @@
+import numpy as np
+
+import optics2 as op
+import raytracer as rt
+import nonsequential as ns
+
+def test_tree_bounds_live_rays():
+    system = ns.NonSequentialSystem([op.SphericalRefraction(100, 20, 0.02, 1, 1.5168), op.SphericalRefraction(105, 20, -0.02, 1.5168, 1), op.OutputPlane(200)])
+    points = rt.Bundle(20, 5, 6).points()
+    maxLive, maxGenerations = 100, 8
+    tree = system.traceTree(points, [0, 0, 1], threshold=1e-9, maxGenerations=maxGenerations, maxLive=maxLive)
+    energy = tree['energy']
+    assert np.isclose(energy['detected'] + energy['escaped'] + energy['pruned'] + energy['capped'], energy['input'])
+    assert tree['peakLive'] > len(points) + maxLive #The bound is per generation, so more than maxLive rays are held at once
+    assert tree['peakLive'] <= len(points) + 2 * maxLive * maxGenerations
+    assert np.any(tree['reflections'] == 2) #Ghosts from double reflections reach the detector
@@ -0,0 +1,69 @@
+import numpy as np
+
+import optics2 as op
+import plotting as pt
+import raytracer as rt
+
+def baselinePoints(n, rmax, m):
+    """Returns the initial positions of a Bundle(n, rmax, m) as the original per-ray Bundle.rtuniform generated them"""
+
+    points = []
+    for i in range(0, n + 1):
+        radius = (i * rmax) / float(n)
+        angle = 0.0
+        if i == 0:
+            points.append([radius, 0.0, 0.0])
+        for x in range(0, m * i):
+            angle = angle + (2.0 * np.pi) / (m * i)
+            points.append([radius * np.cos(angle), radius * np.sin(angle), 0.0])
+    return np.array(points)
+
+def baselineSurface(position, direction, z0, aperture, curvature, n1, n2):
+    """Traces one ray through a spherical surface as the original SphericalRefraction.propagateRay did, returning None for a terminated ray"""
+
+    radius = 1.0 / curvature
+    centre = np.array([0, 0, z0 + radius])
+    r = position - centre
+    factor = np.dot(r, direction)**2 - (np.dot(r, r) - radius**2)
+    if factor < 0:
+        return None
+    length = -np.dot(r, direction) - np.sqrt(factor) if curvature > 0 else -np.dot(r, direction) + np.sqrt(factor)
+    intercept = position + length * direction
+    if np.round(np.hypot(intercept[0], intercept[1]), 6) > aperture:
+        return None
+    normal = intercept - centre if curvature > 0 else centre - intercept
+    normal = normal / np.linalg.norm(normal)
+    cosine = -np.dot(direction, normal)
+    relativeIndex = n1 / n2
+    if np.sin(np.arccos(cosine)) > 1 / relativeIndex:
+        return None
+    refracted = relativeIndex * direction + (relativeIndex * cosine - np.sqrt(1 - relativeIndex**2 * (1 - cosine**2))) * normal
+    return intercept, refracted / np.linalg.norm(refracted)
+
+def test_batch_matches_per_ray_baseline():
+    surfaces = [(100, 20, 0.02, 1, 1.5168), (105, 20, -0.02, 1.5168, 1)]
+    output = 200
+    ends = []
+    for point in baselinePoints(10, 5, 10):
+        ray = (point, np.array([0.0, 0.0, 1.0]))
+        for surface in surfaces:
+            ray = baselineSurface(ray[0], ray[1], *surface)
+        ends.append(ray[0] + (output - ray[0][2]) / ray[1][2] * ray[1])
+    ends = np.array(ends)
+    baselineRms = np.sqrt(np.mean(np.sum((ends[:, :2] - ends[0, :2])**2, axis=1)))
+
+    bundle = rt.Bundle(10, 5, 10)
+    assert np.allclose(bundle.points(), baselinePoints(10, 5, 10), rtol=0, atol=1e-12)
+    system = op.OpticalSystem([op.SphericalRefraction(*surface) for surface in surfaces] + [op.OutputPlane(output)])
+    batch = bundle.getBundle(rt.Ray([0, 0, 0], [0, 0, 1]))
+    system.propagateBundle(batch)
+    assert batch.alive().all()
+    assert np.allclose(batch.p(), ends, rtol=0, atol=1e-9)
+    assert np.isclose(pt.Plot(batch).rms(), baselineRms, rtol=1e-9, atol=0)
+
+    rays = [rt.Ray(ray.p(), ray.k()) for ray in rt.Bundle(10, 5, 10).getBundle(rt.Ray([0, 0, 0], [0, 0, 1]))] #The same beam as separate Ray objects, traced one ray at a time
+    for ray in rays:
+        for element in system.getElements():
+            element.propagateRay(ray)
+    assert np.allclose([ray.p() for ray in rays], ends, rtol=0, atol=1e-9)
+    assert np.isclose(pt.Plot(rays).rms(), baselineRms, rtol=1e-9, atol=0)
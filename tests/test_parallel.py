@@ -0,0 +1,11 @@
+import raytracer as rt
+import optics2 as op
+import parallel
+
+def test_parallel_matches_sequential():
+    lenses = [op.SphericalRefraction(100, 20, 0.02, 1, 1.5168), op.SphericalRefraction(105, 20, 0, 1.5168, 1), op.OutputPlane(200)]
+    points = rt.Bundle(100, 10, 6).points() #Some rays miss the lenses, so terminated rays are compared as well
+    for direction in ([0, 0, 1], [0, 0.1, 1]):
+        sequential = parallel.ParallelTracer(lenses, 1).trace(points, direction)
+        with parallel.ParallelTracer(lenses, 2) as tracer:
+            assert parallel.identical(sequential, tracer.trace(points, direction))
@@ -0,0 +1,23 @@
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+import raytracer as rt
+import plotting as pt
+
+def test_decimate_at_most_max_rays():
+    plot = pt.Plot([], maxRays=1000)
+    for rings in (10, 18, 19, 20, 25, 60):
+        starts = rt.Bundle(rings, 5, 6).points()
+        indices = plot.decimate(starts)
+        assert len(indices) == min(len(starts), 1000)
+        assert len(np.unique(indices)) == len(indices)
+        assert indices[0] == 0 #The central ray is always drawn
+        
+def test_decimate_sizes():
+    random = np.random.RandomState(0)
+    for count in (1051, 1201, 5000, 20000):
+        starts = np.zeros((count, 3))
+        starts[1:, :2] = random.uniform(-5, 5, (count - 1, 2))
+        for maxRays in (1, 10, 100, 1000):
+            assert len(pt.Plot([], maxRays=maxRays).decimate(starts)) <= maxRays
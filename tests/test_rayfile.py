@@ -0,0 +1,30 @@
+import numpy as np
+
+import optics2 as op
+import raytracer as rt
+import rayfile
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'rays')
+    system = op.OpticalSystem([op.SphericalRefraction(100, 4, 0.03, 1, 1.5168), op.SphericalRefraction(105, 20, -0.02, 1.5168, 1), op.OutputPlane(200)])
+    batches = []
+    with rayfile.RayFileWriter(path, system, dtype='float32') as writer:
+        for centre in ([0, 0, 0], [0, 1, 0]):
+            batch = system.trace(rt.Bundle(6, 5, 6).points(centre), [0, 0, 1], history='vertices')
+            writer.write(batch)
+            batches.append(batch)
+            
+    rays = rayfile.RayFile(path)
+    assert len(rays) == sum(len(batch) for batch in batches)
+    assert rays.surfaces() == 3
+    assert isinstance(rays.intercepts(), np.memmap) and isinstance(rays.status(), np.memmap)
+    assert rays.intercepts().dtype == np.dtype('<f4')
+    intercepts = np.concatenate([batch.vertices()[:, 1:] for batch in batches])
+    assert np.array_equal(rays.intercepts(), intercepts.astype('float32'), equal_nan=True)
+    assert np.array_equal(rays.start(), np.concatenate([batch.start() for batch in batches]).astype('float32'))
+    assert np.array_equal(rays.status(), np.concatenate([batch.status() for batch in batches]))
+    assert 0 < rays.alive().sum() < len(rays) #The small aperture of the first surface terminates the outer rays
+    assert np.array_equal(rays.endpoints(), intercepts[:, -1].astype('float32'), equal_nan=True)
+    assert [element.getz0() for element in rays.system().getElements()[:2]] == [100, 105]
+    alive = rays.batch(rays.aliveRows())
+    assert np.allclose(alive.p(), intercepts[:, -1][rays.alive()], atol=1e-4)
@@ -0,0 +1,29 @@
+import numpy as np
+
+import raytracer as rt
+
+def loeschianCount(n):
+    """Counts the points a + b*w of the hexagonal lattice (w = exp(i*pi/3)) within n spacings of the origin, where |a + b*w|^2 = a^2 + ab + b^2"""
+    
+    a, b = np.meshgrid(np.arange(-2 * n, 2 * n + 1), np.arange(-2 * n, 2 * n + 1))
+    return int(np.count_nonzero(a**2 + a * b + b**2 <= n**2))
+    
+def test_hexagonal_count():
+    for n in (1, 2, 7, 10, 20):
+        assert len(rt.Bundle(n, 5.0, 6, 'hexagonal').points()) == loeschianCount(n)
+        
+def test_hexagonal_coverage():
+    points = rt.Bundle(7, 5.0, 6, 'hexagonal').points()
+    spacing = 5.0 / 7
+    assert np.allclose(points[0], 0.0)
+    assert np.all(np.hypot(points[:, 0], points[:, 1]) <= 5.0 * (1 + 1e-9))
+    assert points[:, 1].max() > 5.0 - spacing #The rows reach the top and bottom of the beam
+    assert points[:, 1].min() < -5.0 + spacing
+        
+def test_point_blocks_match_points():
+    for sampling in ('rings', 'fibonacci', 'hexagonal', 'square'):
+        bundle = rt.Bundle(20, 5.0, 6, sampling)
+        blocks = list(bundle.pointBlocks(100))
+        assert np.array_equal(np.concatenate(blocks), bundle.points())
+        if sampling != 'rings':
+            assert max(len(block) for block in blocks) < 300 #The beam is never generated in full
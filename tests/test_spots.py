@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import spots
+
+def spot(seed, size=1000):
+    """Returns an (N,3) array of random end points, some of them terminated"""
+    
+    random = np.random.RandomState(seed)
+    points = np.zeros((size, 3))
+    points[:, :2] = random.normal(0.0, 0.1, (size, 2))
+    points[random.uniform(size=size) < 0.1] = np.nan
+    points[0] = 0.0
+    return points
+    
+def test_accumulator_matches_spot_statistics():
+    points = spot(1)
+    expected = spots.spotStatistics(points)
+    for rmax in (None, 1.0):
+        accumulator = spots.SpotAccumulator(rmax=rmax, bins=10000)
+        for chunk in np.array_split(points, 7):
+            accumulator.add(chunk)
+        statistics = accumulator.statistics()
+        assert sorted(statistics) == sorted(expected)
+        for name in ('rays', 'alive', 'vignetting', 'rms', 'rmsCentroid', 'maxRadius'):
+            assert np.isclose(statistics[name], expected[name])
+        assert sorted(statistics['encircled']) == sorted(expected['encircled'])
+        for fraction, radius in statistics['encircled'].items():
+            if rmax is None:
+                assert np.isnan(radius)
+            else:
+                assert abs(radius - expected['encircled'][fraction]) <= 2 * rmax / 10000
+                
+def test_merge():
+    first, second = spot(1), spot(2)
+    merged = spots.SpotAccumulator(chief=(0, 0), rmax=1.0).add(first).merge(spots.SpotAccumulator(chief=(0, 0), rmax=1.0).add(second))
+    whole = spots.SpotAccumulator(chief=(0, 0), rmax=1.0).add(np.concatenate((first, second)))
+    assert np.isclose(merged.rms(), whole.rms())
+    assert merged.statistics()['encircled'] == whole.statistics()['encircled']
+    
+def test_merge_refuses_other_chief():
+    with pytest.raises(Exception, match='chief'):
+        spots.SpotAccumulator().add(spot(1)).merge(spots.SpotAccumulator().add(spot(2) + 1.0))
+    with pytest.raises(Exception, match='radial bins'):
+        spots.SpotAccumulator(chief=(0, 0)).merge(spots.SpotAccumulator(chief=(0, 0), rmax=1.0))
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import raytracer as rt
+import optics2 as op
+import paraxial as px
+import stream
+
+def planoConvex():
+    lenses = [op.SphericalRefraction(100, 20, 0.02, 1, 1.5168), op.SphericalRefraction(105, 20, 0, 1.5168, 1)]
+    return op.OpticalSystem(lenses + [px.outputPlane(lenses)])
+
+def test_early_stop_matches_full_trace():
+    system = planoConvex()
+    full = stream.StreamTracer(system).run(stream.bundleChunks(rt.Bundle(100, 5, 6, 'hexagonal'), 5000))
+    early = stream.StreamTracer(system).run(stream.bundleChunks(rt.Bundle(100, 5, 6, 'random', seed=1), 5000), tolerance=5e-5)
+    assert early['stoppedEarly'] and early['rays'] < full['rays']
+    assert abs(early['statistics']['rms'] - full['statistics']['rms']) < 4 * early['rmsError']
+    
+def test_early_stop_refuses_structured_beams():
+    for sampling in ('rings', 'hexagonal', 'square', 'fibonacci'):
+        chunks = stream.bundleChunks(rt.Bundle(100, 5, 6, sampling), 5000)
+        with pytest.raises(Exception):
+            stream.StreamTracer(planoConvex()).run(chunks, tolerance=1e-4)
+    
+def test_endpoint_writer(tmp_path):
+    filename = str(tmp_path / 'endpoints.bin')
+    points = np.arange(12, dtype='float').reshape(4, 3)
+    alive = np.array([True, False, True, True])
+    for append in (False, False, True):
+        stream.EndpointWriter(filename, append=append).add(points, alive).result()
+    written = np.fromfile(filename, dtype='float64').reshape(-1, 3)
+    assert np.array_equal(written, np.concatenate((points[alive], points[alive]))) #Writing again overwrote the file, and only the last writer appended to it
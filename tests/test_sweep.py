@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pytest
+
+import sweep
+
+def biconvex():
+    """Returns the base design of a biconvex pair with a fixed output plane, swept over the curvature of the first surface"""
+    
+    lenses = [{'z0': 100, 'aperture': 20, 'curvature': 0.02, 'n1': 1, 'n2': 1.5168}, {'z0': 105, 'aperture': 20, 'curvature': -0.02, 'n1': 1.5168, 'n2': 1}]
+    return sweep.design(lenses, n=5, rmax=5, m=6, output=200)
+    
+GRID = {'lens1.curvature': [0.015, 0.02, 0.025], 'bundle.rmax': [2, 5]}
+
+def test_structured_result():
+    results = sweep.Sweep(biconvex()).run(GRID, workers=0, chunksize=4)
+    assert results.dtype.names == ('index', 'bundle.rmax', 'lens1.curvature') + tuple(sweep.METRICS)
+    assert np.array_equal(results['index'], np.arange(6))
+    assert np.array_equal(results['lens1.curvature'], [0.015, 0.02, 0.025, 0.015, 0.02, 0.025])
+    assert np.all(np.isfinite(results['rms']))
+    
+def test_parallel_matches_sequential():
+    sequential = sweep.Sweep(biconvex()).run(GRID, workers=0, chunksize=1)
+    parallel = sweep.Sweep(biconvex()).run(GRID, workers=2, chunksize=2)
+    assert np.array_equal(sequential, parallel)
+    
+def test_chunksize_refused():
+    with pytest.raises(Exception, match='chunksize'):
+        sweep.Sweep(biconvex()).run(GRID, workers=0, chunksize=0)
+        
+def test_resume(tmp_path):
+    results = str(tmp_path / 'sweep.jsonl')
+    full = sweep.Sweep(biconvex()).run(GRID, workers=0, results=results)
+    with open(results) as resultsFile:
+        lines = resultsFile.readlines()
+    with open(results, 'w') as resultsFile:
+        resultsFile.writelines(lines[:4] + [lines[4][:10]]) #The header, three finished rows and a partly written row
+    resumed = sweep.Sweep(biconvex()).run(GRID, workers=0, results=results)
+    assert np.array_equal(resumed, full)
+    indices = []
+    with open(results) as resultsFile:
+        for line in resultsFile.readlines()[1:]:
+            try:
+                indices.append(json.loads(line)['index'])
+            except ValueError:
+                continue #The partly written row is left in the file, but is not read
+    assert sorted(indices) == list(range(6)) #Only the unfinished points were traced again
+    
+def test_resume_refuses_other_grid(tmp_path):
+    results = str(tmp_path / 'sweep.jsonl')
+    sweep.Sweep(biconvex()).run(GRID, workers=0, results=results)
+    with pytest.raises(Exception, match='different design or grid'):
+        sweep.Sweep(biconvex()).run({'lens1.curvature': [0.03]}, workers=0, results=results)
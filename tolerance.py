@@ -0,0 +1,249 @@
+import concurrent.futures
+import statistics
+import time
+import numpy as np
+import raytracer as rt
+import optics2 as op
+import paraxial as px
+import optimise
+
+"""
+Monte-Carlo tolerance analysis of the RMS spot radius under manufacturing errors in the curvature, position, glass index and decentre of each lens.
+
+The perturbed systems are traced as stacks (systems x rays) with optics2.traceStack, a chunk of trials at a time, on a pool of worker processes.
+Every trial is drawn from the seed in the parent process before any tracing, as a Latin hypercube (or plain random) sample of quantiles, and the trials are
+split into the same chunks whatever the number of workers, so the results do not depend on the number of workers. A different chunk size traces the same
+systems, but its stacks can round the RMS spot radii differently in the last bit. The same quantiles and the same pupil sample are used for every run with the same seed and
+number of trials (common random numbers), so two tolerance budgets or designs can be compared without the noise of different draws.
+"""
+
+#The parameters which can be toleranced, and the distributions the perturbations are drawn from
+PARAMETERS = ['curvature', 'z0', 'index', 'decentreX', 'decentreY']
+DISTRIBUTIONS = ['normal', 'uniform']
+
+def normalQuantiles(unit):
+    """Returns the quantiles of the standard normal distribution at the given probabilities"""
+    
+    inverse = np.vectorize(statistics.NormalDist().inv_cdf, otypes=['float'])
+    return inverse(np.clip(unit, 1e-12, 1 - 1e-12))
+
+def latinHypercube(trials, dimensions, random):
+    """Returns a (trials, dimensions) Latin hypercube sample of the unit cube, with one point in each of the trials equal strata of every dimension"""
+    
+    strata = np.argsort(random.random_sample((dimensions, trials)), axis=1).T #An independent random permutation of the strata for each dimension
+    return (strata + random.random_sample((trials, dimensions))) / float(trials)
+
+def traceChunk(analysis, perturbations):
+    """Returns the RMS spot radius of each system in a chunk of perturbations, for the worker processes"""
+    
+    return analysis.traceRMS(perturbations)
+
+class Tolerance:
+    """A class which describes the tolerance on one parameter of one lens: its size is the standard deviation of a normal error or the half width of a uniform one.
+    The index tolerance perturbs the glass after the surface, so the n2 of the surface and the n1 of the next one."""
+    
+    def __init__(self, surface, parameter, size, distribution='normal'):
+        if parameter not in PARAMETERS:
+            raise Exception('The parameter must be one of: %s' % ', '.join(PARAMETERS))
+        if distribution not in DISTRIBUTIONS:
+            raise Exception('The distribution must be one of: %s' % ', '.join(DISTRIBUTIONS))
+        self.__surface = int(surface)
+        self.__parameter = parameter
+        self.__size = float(size)
+        self.__distribution = distribution
+    
+    def __repr__(self):
+        return 'Tolerance(%d, %r, %g, %r)' % (self.__surface, self.__parameter, self.__size, self.__distribution)
+    
+    def getSurface(self):
+        return self.__surface
+    
+    def getParameter(self):
+        return self.__parameter
+    
+    def getSize(self):
+        return self.__size
+    
+    def getDistribution(self):
+        return self.__distribution
+    
+    def name(self):
+        """Returns the name of the tolerance, such as 'lens1.curvature' (lenses are counted from 1, as in a sweep)"""
+        
+        return 'lens%d.%s' % (self.__surface + 1, self.__parameter)
+    
+    def values(self, unit):
+        """Returns the perturbations at the given probabilities (quantiles of the unit interval)"""
+        
+        if self.__distribution == 'uniform':
+            return self.__size * (2 * np.asarray(unit, dtype='float') - 1)
+        return self.__size * normalQuantiles(unit)
+
+class ToleranceAnalysis:
+    """A class which finds the distribution of the RMS spot radius of a lens design over randomly perturbed systems, along with its yield and sensitivities"""
+    
+    def __init__(self, lenses, tolerances, output=None, bundle=None, start=(0, 0, 0), refocus=False):
+        #The output plane is at the given z, or at the paraxial focus of the nominal design. If refocus is True, each perturbed system is measured at its own paraxial focus instead.
+        system = op.OpticalSystem(lenses)
+        if not(system.isSpherical()):
+            raise Exception('Tolerance analysis can only trace systems of spherical lenses')
+        self.__constants = system.getConstants()
+        self.__tolerances = list(tolerances)
+        if not self.__tolerances:
+            raise Exception('At least one tolerance must be given')
+        surfaces = len(self.__constants['z0'])
+        for tolerance in self.__tolerances:
+            if not(0 <= tolerance.getSurface() < surfaces):
+                raise Exception('%s refers to a lens which is not in the system' % tolerance.name())
+        if output is None:
+            output = px.paraxialFocus(system)
+            if output is None:
+                raise Exception('The system has no paraxial focus, so the output plane must be given')
+        self.__output = float(output)
+        self.__refocus = refocus
+        if bundle is None:
+            bundle = rt.Bundle(10, 5, 10)
+        self.__points = bundle.points(start) #The same pupil sample is traced through every system
+        self.__direction = np.array([0, 0, 1], dtype='float')
+        self.__nominal = None
+    
+    def getTolerances(self):
+        return self.__tolerances
+    
+    def getOutput(self):
+        return self.__output
+    
+    def sample(self, trials, seed=None, method='lhs'):
+        """Returns a (trials, tolerances) array of the probabilities at which every tolerance is sampled in each trial, as a Latin hypercube ('lhs') or a plain
+        random ('random') sample. The same seed always gives the same sample."""
+        
+        random = np.random.RandomState(seed)
+        if method == 'lhs':
+            return latinHypercube(int(trials), len(self.__tolerances), random)
+        if method == 'random':
+            return random.random_sample((int(trials), len(self.__tolerances)))
+        raise Exception("The sampling method must be 'lhs' or 'random'")
+    
+    def perturbations(self, unit):
+        """Returns the (trials, tolerances) perturbations at an array of probabilities from sample"""
+        
+        unit = np.atleast_2d(unit)
+        return np.stack([tolerance.values(unit[:, i]) for i, tolerance in enumerate(self.__tolerances)], axis=1).reshape(len(unit), len(self.__tolerances))
+    
+    def systems(self, perturbations):
+        """Returns the (M,S) z0, curvature, aperture, n1 and n2 arrays, the (M,S,2) decentres and the (M,) output planes of the perturbed systems"""
+        
+        perturbations = np.atleast_2d(perturbations)
+        count = len(perturbations)
+        z0, curvature, aperture, n1, n2 = [np.repeat(self.__constants[name][np.newaxis, :], count, axis=0) for name in ('z0', 'curvature', 'aperture', 'n1', 'n2')]
+        decentre = np.zeros(z0.shape + (2,))
+        for i, tolerance in enumerate(self.__tolerances):
+            s, parameter, value = tolerance.getSurface(), tolerance.getParameter(), perturbations[:, i]
+            if parameter == 'curvature':
+                curvature[:, s] += value
+            elif parameter == 'z0':
+                z0[:, s] += value
+            elif parameter == 'index':
+                n2[:, s] += value
+                if s + 1 < z0.shape[1]:
+                    n1[:, s + 1] += value
+            else:
+                decentre[:, s, 0 if parameter == 'decentreX' else 1] += value
+        output = np.full(count, self.__output)
+        if self.__refocus:
+            focus = px.firstOrder(z0, curvature, n1, n2)['focus']
+            output = np.where(np.isfinite(focus), focus, output) #Systems without a focus stay at the nominal output plane
+        return z0, curvature, aperture, n1, n2, decentre, output
+    
+    def traceRMS(self, perturbations):
+        """Traces the pupil sample through every perturbed system as one stack and returns the RMS spot radius of each"""
+        
+        z0, curvature, aperture, n1, n2, decentre, output = self.systems(perturbations)
+        points, alive = op.traceStack(self.__points, self.__direction, z0, curvature, aperture, n1 / n2, output, decentre=decentre)
+        return optimise.stackRMS(points, alive)
+    
+    def nominal(self):
+        """Returns the RMS spot radius of the unperturbed design"""
+        
+        if self.__nominal is None:
+            self.__nominal = float(self.traceRMS(np.zeros((1, len(self.__tolerances))))[0])
+        return self.__nominal
+    
+    def sensitivity(self):
+        """Returns the sensitivity table: the change in the RMS spot radius when each parameter alone is moved to plus and minus its tolerance.
+        Every row of the table is traced in a single stack."""
+        
+        count = len(self.__tolerances)
+        perturbations = np.zeros((2 * count, count))
+        for i, tolerance in enumerate(self.__tolerances):
+            perturbations[2 * i, i] = tolerance.getSize()
+            perturbations[2 * i + 1, i] = -tolerance.getSize()
+        rms = self.traceRMS(perturbations)
+        nominal = self.nominal()
+        table = []
+        for i, tolerance in enumerate(self.__tolerances):
+            plus, minus = rms[2 * i] - nominal, rms[2 * i + 1] - nominal
+            table.append({'tolerance': tolerance.name(), 'size': tolerance.getSize(), 'plus': plus, 'minus': minus, 'worst': np.nanmax([abs(plus), abs(minus)])})
+        return table
+    
+    def run(self, trials=1000, seed=0, method='lhs', specification=None, workers=None, chunksize=256):
+        """Traces trials perturbed systems, chunksize systems per stack, on workers processes (None uses every core, and 0 or 1 runs in this process).
+        Returns a dictionary of:
+            rms              The (trials,) RMS spot radius of every perturbed system (NaN if it lost every ray).
+            perturbations    The (trials, tolerances) perturbations of every system.
+            nominal          The RMS spot radius of the unperturbed design.
+            statistics       The mean, standard deviation and standard error of the mean, and the 50th, 90th and 99th percentiles, of the RMS spot radius.
+            yield            If a specification is given (a largest acceptable RMS spot radius or a list of them), a table of the fraction of systems which meet
+                             each specification, with its standard error.
+            contributions    The linear sensitivity of the RMS spot radius to each tolerance found by regression over the trials, and the share of the variance each explains.
+            sensitivity      The table of changes at plus and minus each tolerance (see sensitivity).
+            seconds          The time the trials took."""
+        
+        began = time.time()
+        perturbations = self.perturbations(self.sample(trials, seed, method))
+        chunks = [perturbations[i:i + chunksize] for i in range(0, len(perturbations), max(int(chunksize), 1))]
+        if workers is not None and workers <= 1:
+            rms = [traceChunk(self, chunk) for chunk in chunks]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                rms = list(pool.map(traceChunk, [self] * len(chunks), chunks)) #The chunks come back in order, whichever worker traced them
+        rms = np.concatenate(rms) if rms else np.empty(0)
+        
+        finite = rms[np.isfinite(rms)]
+        summary = {'trials': len(rms), 'lostSystems': len(rms) - len(finite)}
+        if len(finite) > 0:
+            summary.update({'mean': finite.mean(), 'std': finite.std(), 'standardError': finite.std() / np.sqrt(len(finite)),
+                               'p50': np.percentile(finite, 50), 'p90': np.percentile(finite, 90), 'p99': np.percentile(finite, 99)})
+        result = {'rms': rms, 'perturbations': perturbations, 'nominal': self.nominal(), 'statistics': summary, 'contributions': self.contributions(perturbations, rms),
+                  'sensitivity': self.sensitivity(), 'seconds': time.time() - began}
+        if specification is not None:
+            result['yield'] = yieldTable(rms, specification)
+        return result
+    
+    def contributions(self, perturbations, rms):
+        """Fits the RMS spot radius of the trials as a linear function of the perturbations, and returns for each tolerance the change in the RMS spot radius
+        per standard deviation of its perturbation and the fraction of the variance of the RMS spot radius it explains"""
+        
+        finite = np.isfinite(rms)
+        x, y = perturbations[finite], rms[finite]
+        table = []
+        if len(y) <= len(self.__tolerances) + 1:
+            return table #There are too few trials for the fit
+        spread = x.std(axis=0)
+        scaled = (x - x.mean(axis=0)) / np.where(spread > 0, spread, 1.0)
+        design = np.column_stack([np.ones(len(y)), scaled])
+        coefficients = np.linalg.lstsq(design, y, rcond=None)[0][1:]
+        variance = y.var()
+        for i, tolerance in enumerate(self.__tolerances):
+            table.append({'tolerance': tolerance.name(), 'slope': coefficients[i], 'varianceShare': coefficients[i]**2 / variance if variance > 0 else 0.0})
+        return table
+
+def yieldTable(rms, specifications):
+    """Returns the fraction of systems whose RMS spot radius meets each specification (systems which lost every ray fail), with its binomial standard error"""
+    
+    rms = np.asarray(rms, dtype='float')
+    table = []
+    for specification in np.atleast_1d(specifications):
+        passed = np.mean(np.where(np.isfinite(rms), rms, np.inf) <= specification) if len(rms) > 0 else np.nan
+        table.append({'specification': float(specification), 'yield': passed, 'standardError': np.sqrt(passed * (1 - passed) / max(len(rms), 1))})
+    return table